@@ -0,0 +1,135 @@
+from __future__ import unicode_literals
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from elasticsearch.helpers import scan
+
+from servicematcher.utils import get_logging, transliterate
+
+log = get_logging(__name__)
+
+REBUILD_INTERVAL = getattr(settings, "SERVICEMATCHER_LOCAL_AUTOCOMPLETE_REBUILD_INTERVAL", 3600)
+ALL_LEVEL1S = ""
+
+
+def tokenize(text):
+    """
+    "Ladies Cut & Blow-Dry" -> ["ladies", "cut", "blow", "dry"]
+    """
+    text = transliterate(text).lower()
+    return "".join(c if c.isalnum() else " " for c in text).split()
+
+
+class PrefixIndex(object):
+    """
+    Inverted index of every prefix of every word of the level5 of some index elements
+    """
+
+    def __init__(self, index_elements):
+        """
+        :param index_elements: list of dict, formatted with format_index_element_from_elastic_hit
+        """
+        self.index_elements = index_elements
+        self.words = []
+        self.prefixes = defaultdict(set)
+        for position, index_element in enumerate(index_elements):
+            words = tokenize(index_element["level5"])
+            self.words.append(set(words))
+            for word in words:
+                for i in range(1, len(word) + 1):
+                    self.prefixes[word[:i]].add(position)
+
+    def search(self, search_string, size=10, skip=0):
+        """
+        Like the multi_match of the elastic query: an index element matching more words of the search ranks first,
+        a whole word counts more than a prefix, and shorter names win ties.
+        :return: list of dict, index_elements with their score
+        """
+        scores = defaultdict(float)
+        for word in tokenize(search_string):
+            for position in self.prefixes.get(word, ()):
+                scores[position] += 2. if word in self.words[position] else 1.
+        ranked = sorted(scores, key=lambda p: (-scores[p], len(self.words[p]), self.index_elements[p]["level5"]))
+        hits = []
+        for position in ranked[skip:skip + size]:
+            hit = dict(self.index_elements[position])
+            hit["score"] = scores[position]
+            hits.append(hit)
+        return hits
+
+
+class LocalAutocompleter(object):
+    """
+    In-memory autocomplete over the index elements of each elastic index, partitioned by level1_id.
+    Built from one scan of the index_element documents, rebuilt in the background every REBUILD_INTERVAL
+    or when the catalogue version changes.
+    """
+
+    def __init__(self, es, doc_type, format_hit, rebuild_interval=REBUILD_INTERVAL):
+        self.es = es
+        self.doc_type = doc_type
+        self.format_hit = format_hit
+        self.rebuild_interval = rebuild_interval
+        self.partitions = {}
+        self.built = {}
+        self.rebuilding = set()
+        self.lock = threading.Lock()
+
+    def build(self, index, version):
+        start = time.time()
+        by_level1 = defaultdict(list)
+        for hit in scan(self.es, index=index, doc_type=self.doc_type, query={"query": {"match_all": {}}}):
+            index_element = self.format_hit(hit)
+            by_level1[hit["_source"].get("level1_id", "")].append(index_element)
+            by_level1[ALL_LEVEL1S].append(index_element)
+        partitions = dict((level1_id, PrefixIndex(elements)) for level1_id, elements in by_level1.items())
+        with self.lock:
+            self.partitions[index] = partitions
+            self.built[index] = (time.time(), version)
+            self.rebuilding.discard(index)
+        log.info("Built the local autocomplete of {} with {} index elements in {}ms".format(
+            index, len(by_level1[ALL_LEVEL1S]), int((time.time() - start) * 1000)))
+
+    def rebuild_in_background(self, index, version):
+        with self.lock:
+            if index in self.rebuilding:
+                return
+            self.rebuilding.add(index)
+
+        def rebuild():
+            try:
+                self.build(index, version)
+            except Exception:
+                log.exception("Could not rebuild the local autocomplete of {}".format(index))
+                with self.lock:
+                    self.rebuilding.discard(index)
+        thread = threading.Thread(target=rebuild, name="servicematcher-autocomplete")
+        thread.daemon = True
+        thread.start()
+
+    def get_partition(self, index, level1_id, version):
+        if index not in self.partitions:
+            self.build(index, version)
+        else:
+            built_time, built_version = self.built[index]
+            if built_version != version or time.time() - built_time > self.rebuild_interval:
+                # keep answering from the previous build meanwhile
+                self.rebuild_in_background(index, version)
+        return self.partitions[index].get(level1_id or ALL_LEVEL1S)
+
+    def search(self, index, search_string, size=10, skip=0, level1_id="", version=0):
+        """
+        :param index: str, elastic index of the country
+        :param search_string: str,
+        :param size: int,
+        :param skip: int,
+        :param level1_id: str, "" for all the level1s
+        :param version: int, version of the catalogue, a new version rebuilds the index
+        :return: list of dict, index_elements
+        """
+        partition = self.get_partition(index, level1_id, version)
+        if partition is None:
+            return []
+        return partition.search(search_string, size=size, skip=skip)
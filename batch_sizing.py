@@ -0,0 +1,130 @@
+from __future__ import unicode_literals
+import threading
+import time
+
+from django.conf import settings
+
+from servicematcher import models
+from servicematcher.cache import LRUCache
+from servicematcher.metrics import registry
+from servicematcher.utils import get_logging
+
+log = get_logging(__name__)
+
+# Size the batches from the pace of each matcher instead of the batch_size sent by the frontend
+ADAPTIVE_BATCH_SIZE = getattr(settings, "SERVICEMATCHER_ADAPTIVE_BATCH_SIZE", False)
+# Seconds a batch should last, well under the lease of its services
+BATCH_WINDOW = getattr(settings, "SERVICEMATCHER_BATCH_WINDOW", 1800)
+MIN_BATCH_SIZE = getattr(settings, "SERVICEMATCHER_MIN_BATCH_SIZE", 3)
+MAX_BATCH_SIZE = getattr(settings, "SERVICEMATCHER_MAX_BATCH_SIZE", 50)
+# The pace of a matcher is computed from that many of their last matches, the frontend batch_size is used below
+HISTORY = getattr(settings, "SERVICEMATCHER_BATCH_SIZE_HISTORY", 50)
+MIN_HISTORY = 5
+# Seconds the pace of a matcher is cached
+PACE_TTL = 60
+# get_batch_unmatch_service, the elastic queue and the warehouse lease the services for 1 hour
+LEASE_LENGTH = getattr(settings, "SERVICEMATCHER_LEASE_LENGTH", 3600)
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return float(values[middle])
+    return (values[middle - 1] + values[middle]) / 2.
+
+
+def get_pace(user_id):
+    """
+    Seconds a matcher needs per service: the median time_spent of their last matches, or the pace of their
+    current session if it is slower, since it also counts the time between the services
+    :param user_id: int,
+    :return: float or None, None without enough matches
+    """
+    times_spent = list(models.Match.objects
+                       .filter(user_id=user_id)
+                       .order_by("-id")
+                       .values_list("time_spent", flat=True)[:HISTORY])
+    if len(times_spent) < MIN_HISTORY:
+        return None
+    # time_spent is sent by the frontend in ms
+    pace = median(times_spent) / 1000.
+    one_hour_before = models.timezone.now() - models.timezone.timedelta(hours=1)
+    session = models.SessionMetric.objects \
+        .filter(user_id=user_id) \
+        .filter(end_time__gt=one_hour_before) \
+        .order_by("-end_time") \
+        .first()
+    if session is not None and session.match_counter >= MIN_HISTORY:
+        session_pace = (session.end_time - session.start_time).total_seconds() / (session.match_counter - 1)
+        pace = max(pace, session_pace)
+    return pace
+
+
+class BatchSizer(object):
+    """
+    Choose the size of the batch of each matcher so that it lasts about BATCH_WINDOW: slow matchers do not hold
+    services until their lease expires and fast ones do not fetch every few services.
+    Also count, by sizing mode, the leases of the served services that ended with a submit in time, with a submit
+    after they expired, or unsubmitted when their matcher fetched another batch, to compare both modes.
+    The served batches are kept in this process, a submit answered by another one is not counted.
+    """
+
+    def __init__(self, adaptive=ADAPTIVE_BATCH_SIZE, window=BATCH_WINDOW, min_size=MIN_BATCH_SIZE,
+                 max_size=MAX_BATCH_SIZE, lease_length=LEASE_LENGTH):
+        self.adaptive = adaptive
+        self.window = window
+        self.min_size = min_size
+        self.max_size = max_size
+        self.lease_length = lease_length
+        self.paces = LRUCache(max_size=10000, ttl=PACE_TTL)
+        # user id: {service key: (served time, sizing mode)}
+        self.leases = {}
+        self.lock = threading.Lock()
+
+    def get_batch_size(self, user_id, requested_size):
+        """
+        :param user_id: int,
+        :param requested_size: int, the batch_size sent by the frontend
+        :return: tuple, (batch size, sizing mode) the mode being "adaptive" or "client"
+        """
+        if not self.adaptive:
+            return requested_size, "client"
+        pace = self.paces.get(user_id)
+        if pace is None:
+            # cached as 0 when there is not enough history yet
+            pace = get_pace(user_id) or 0.
+            self.paces.set(user_id, pace)
+        if not pace:
+            return requested_size, "client"
+        size = max(self.min_size, min(self.max_size, int(self.window / pace)))
+        log.info("Batch size of {}: {} for {:.1f}s per service".format(user_id, size, pace))
+        return size, "adaptive"
+
+    def served(self, user_id, datas, mode):
+        """
+        Record the batch served to a matcher, the services of their previous batch not submitted are counted
+        """
+        now = time.time()
+        with self.lock:
+            previous = self.leases.get(user_id, {})
+            self.leases[user_id] = dict((data["service"]["key"], (now, mode)) for data in datas)
+        for _, previous_mode in previous.values():
+            registry.increment("servicematcher_leases_total", mode=previous_mode, outcome="unsubmitted")
+        registry.increment("servicematcher_batches_total", mode=mode)
+        registry.increment("servicematcher_batch_services_total", len(datas), mode=mode)
+
+    def submitted(self, user_id, service_key):
+        with self.lock:
+            lease = self.leases.get(user_id, {}).pop(service_key, None)
+        if lease is None:
+            return
+        served_time, mode = lease
+        outcome = "expired" if time.time() - served_time > self.lease_length else "in_time"
+        registry.increment("servicematcher_leases_total", mode=mode, outcome=outcome)
+
+    def stats(self):
+        stats = self.paces.stats()
+        with self.lock:
+            stats["leased"] = sum(len(leases) for leases in self.leases.values())
+        return stats
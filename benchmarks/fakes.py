@@ -0,0 +1,364 @@
+from __future__ import unicode_literals
+import gzip
+import json
+import random
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict, defaultdict
+from io import BytesIO
+from uuid import uuid4
+
+from django.conf import settings
+
+from servicematcher.elastic_api import CHILD_DOC_TYPE
+from servicematcher.mappings import level1_to_warehouse_category_id
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+SEARCH_DATA = {
+    "city": "London",
+    "level1_id": "01000",
+    "level1": "Hair & Beauty",
+    "country": "gb",
+}
+NOT_ENOUGH_INFO_WIZARD = "00000_00000_00000_00000_00000"
+WORDS = ["ladies", "gents", "cut", "blow", "dry", "colour", "highlights", "balayage", "fringe", "trim",
+         "manicure", "pedicure", "gel", "nails", "lashes", "brows", "wax", "facial", "massage", "tan"]
+CATEGORIES = ["Hair", "Nails", "Lashes & Brows", "Waxing", "Face", "Body"]
+# The lease of the warehouse when time_limit is not sent
+WAREHOUSE_TIME_LIMIT = 600
+
+
+def find_values(body, key):
+    """
+    :param body: dict or list, an elastic query
+    :param key: str,
+    :return: list, the values of every occurrence of the key, at any depth
+    """
+    values = []
+    if isinstance(body, dict):
+        for k, v in body.items():
+            if k == key:
+                values.append(v)
+            values += find_values(v, key)
+    elif isinstance(body, list):
+        for item in body:
+            values += find_values(item, key)
+    return values
+
+
+def build_url(host, port, path):
+    return "http://{}:{}/{}".format(host, port, path.lstrip("/"))
+
+
+def generate_index_elements(level1_id, level1, size=60):
+    """
+    :return: list of dict, the fields of IndexElement, plus the one of the not enough info flag
+    """
+    rng = random.Random(level1_id)
+    elements = [{
+        "wizard": NOT_ENOUGH_INFO_WIZARD,
+        "level1_id": NOT_ENOUGH_INFO_WIZARD[:5],
+        "level1": "Not enough info",
+        "level2": "", "level3": "", "level4": "", "level5": "",
+    }]
+    for i in range(size):
+        category = CATEGORIES[i % len(CATEGORIES)]
+        elements.append({
+            "wizard": "{}_{:05d}_{:05d}_{:05d}_{:05d}".format(level1_id, (i % len(CATEGORIES) + 1) * 100,
+                                                              i // len(CATEGORIES) * 100 + 100, 100, 100),
+            "level1_id": level1_id,
+            "level1": level1,
+            "level2": category,
+            "level3": category,
+            "level4": category,
+            "level5": " ".join(rng.sample(WORDS, 3)).title(),
+        })
+    return elements
+
+
+def generate_warehouse_services(level1_id, size, seed=0):
+    """
+    :return: list of dict, services as sent by the warehouse, 5 per venue
+    """
+    rng = random.Random(seed)
+    category_ids = [str(category_id) for category_id in level1_to_warehouse_category_id[level1_id]]
+    services = []
+    for i in range(size):
+        services.append({
+            "key": "benchmark-service-{}".format(i),
+            "description": " ".join(rng.sample(WORDS, rng.randint(2, 5))).capitalize(),
+            "category": rng.choice(CATEGORIES),
+            "venue_category": rng.choice(CATEGORIES),
+            "venue_category_id": rng.choice(category_ids),
+            "venue_name": "Benchmark venue {}".format(i // 5),
+            "subdomain": "benchmark-venue-{}".format(i // 5),
+        })
+    return services
+
+
+class FakeWarehouse(object):
+    """
+    In-process stand-in of the warehouse endpoints used by the matcher: unmatched services with their lease,
+    venue counts, datasource upload and service lock, served over HTTP on a local port.
+    """
+
+    def __init__(self, services, latency=0., time_limit=WAREHOUSE_TIME_LIMIT):
+        """
+        :param services: list of dict, services as sent by the warehouse
+        :param latency: float, seconds added to every response
+        :param time_limit: float, seconds of the lease when the request does not send one
+        """
+        self.services = OrderedDict((service["key"], service) for service in services)
+        self.latency = latency
+        self.time_limit = time_limit
+        self.leases = {}
+        self.locked = set()
+        self.datasources = defaultdict(list)
+        # (service key, start, end) of every lease given, for the stress test
+        self.lease_log = []
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.server = None
+        self.paths = {}
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.paths = {
+            settings.WAREHOUSE_UNMATCHED_SERVICES_PATH.strip("/"): self.get_unmatched_services,
+            settings.WAREHOUSE_UNMATCHED_VENUE_COUNT_PATH.strip("/"): self.get_venue_count,
+            settings.WAREHOUSE_UPLOAD_PATH.strip("/"): self.upload,
+            settings.WAREHOUSE_LOCK_SERVICE_PATH.strip("/"): self.lock_services,
+        }
+        if getattr(settings, "WAREHOUSE_UNMATCHED_VENUE_COUNTS_PATH", None):
+            self.paths[settings.WAREHOUSE_UNMATCHED_VENUE_COUNTS_PATH.strip("/")] = self.get_venue_counts
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), make_warehouse_handler(self))
+        thread = threading.Thread(target=self.server.serve_forever, name="servicematcher-fake-warehouse")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def handle(self, method, url, headers, body):
+        """
+        :return: tuple, status code and body of the response
+        """
+        parsed = urlparse(url)
+        handler = self.paths.get(parsed.path.strip("/"))
+        if handler is None:
+            return 404, ""
+        with self.lock:
+            self.calls[handler.__name__] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        params = dict((key, values[0]) for key, values in parse_qs(parsed.query).items())
+        if headers.get("Content-Encoding") == "gzip":
+            body = gzip.GzipFile(fileobj=BytesIO(body)).read()
+        return handler(params, body)
+
+    def is_available(self, key, now):
+        return key not in self.locked and key not in self.datasources and self.leases.get(key, 0) <= now
+
+    def filter_services(self, params):
+        category_ids = set(params["category_id"].split(",")) if params.get("category_id") else None
+        return [key for key, service in self.services.items()
+                if category_ids is None or service["venue_category_id"] in category_ids]
+
+    def get_unmatched_services(self, params, body):
+        size = int(params.get("batch_size", 10))
+        time_limit = float(params.get("time_limit", self.time_limit))
+        now = time.time()
+        with self.lock:
+            keys = [key for key in self.filter_services(params) if self.is_available(key, now)][:size]
+            for key in keys:
+                self.leases[key] = now + time_limit
+                self.lease_log.append((key, now, now + time_limit))
+        return 200, json.dumps([self.services[key] for key in keys])
+
+    def get_venue_count(self, params, body):
+        now = time.time()
+        with self.lock:
+            keys = [key for key in self.filter_services(params) if self.is_available(key, now)]
+        return 200, str(len(set(self.services[key]["subdomain"] for key in keys)))
+
+    def get_venue_counts(self, params, body):
+        counts = []
+        for category_ids in params.get("category_groups", "").split(";"):
+            _, count = self.get_venue_count(dict(params, category_id=category_ids), body)
+            counts.append(int(count))
+        return 200, json.dumps(counts)
+
+    def upload(self, params, body):
+        datasources = json.loads(body.decode("utf-8") if isinstance(body, bytes) else body)
+        with self.lock:
+            for datasource in datasources:
+                self.datasources[datasource["informs"][0]].append(datasource)
+        return 200, ""
+
+    def lock_services(self, params, body):
+        with self.lock:
+            self.locked.update(params.get("product_key", "").split(","))
+        return 200, ""
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_warehouse_handler(warehouse):
+
+    class WarehouseHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def respond(self, method):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+            status, content = warehouse.handle(method, self.path, self.headers, body)
+            content = content.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            self.respond("GET")
+
+        def do_PUT(self):
+            self.respond("PUT")
+
+        def log_message(self, *args):
+            pass
+
+    return WarehouseHandler
+
+
+class FakeElasticsearch(object):
+    """
+    Stand-in of the elasticsearch client with the calls of ElasticServices: the top3 and autocomplete
+    searches return index elements in an order derived from the query, the service documents are kept
+    in memory so the 2nd match queue and its leases work like in elastic.
+    """
+
+    def __init__(self, index_elements, latency=0.):
+        """
+        :param index_elements: list of dict, fields of the index elements
+        :param latency: float, seconds added to every call
+        """
+        self.parents = OrderedDict()
+        for element in index_elements:
+            if element["wizard"] != NOT_ENOUGH_INFO_WIZARD:
+                self.parents[element["wizard"]] = dict(element, picture1="", picture2="")
+        self.wizards = list(self.parents)
+        self.children = OrderedDict()
+        self.latency = latency
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def record(self, method):
+        with self.lock:
+            self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_parent_hit(self, wizard, score=1.):
+        return {"_id": wizard, "_type": "index_element", "_score": score, "found": True,
+                "_source": self.parents[wizard]}
+
+    def rank(self, body):
+        sizes = find_values(body, "size")
+        size = int(sizes[0]) if sizes else 10
+        seed = zlib.crc32(json.dumps(body, sort_keys=True).encode("utf-8"))
+        wizards = random.Random(seed).sample(self.wizards, min(size, len(self.wizards)))
+        hits = [self.get_parent_hit(wizard, score=10. - i) for i, wizard in enumerate(wizards)]
+        return {"hits": {"total": len(hits), "hits": hits}}
+
+    def search_children(self, body):
+        tokens = [term["lock_token"] for term in find_values(body, "term") if "lock_token" in term]
+        size = int(find_values(body, "size")[0])
+        with self.lock:
+            hits = [dict(child) for child in self.children.values()
+                    if tokens and child["_source"].get("lock_token") == tokens[0]][:size]
+        return {"hits": {"total": len(hits), "hits": hits}}
+
+    def search(self, index=None, doc_type=None, body=None, **kwargs):
+        self.record("search")
+        if doc_type == CHILD_DOC_TYPE:
+            return self.search_children(body)
+        return self.rank(body)
+
+    def search_template(self, index=None, doc_type=None, body=None, **kwargs):
+        self.record("search_template")
+        return self.rank(body)
+
+    def msearch(self, index=None, doc_type=None, body=None, **kwargs):
+        self.record("msearch")
+        return {"responses": [self.rank(query) for query in body[1::2]]}
+
+    def msearch_template(self, index=None, doc_type=None, body=None, **kwargs):
+        self.record("msearch_template")
+        return {"responses": [self.rank(query) for query in body[1::2]]}
+
+    def get(self, index=None, id=None, doc_type=None, **kwargs):
+        self.record("get")
+        return self.get_parent_hit(id)
+
+    def mget(self, index=None, doc_type=None, body=None, **kwargs):
+        self.record("mget")
+        return {"docs": [self.get_parent_hit(wizard) if wizard in self.parents else {"_id": wizard, "found": False}
+                         for wizard in body["ids"]]}
+
+    def index(self, index=None, doc_type=None, body=None, parent=None, **kwargs):
+        self.record("index")
+        if doc_type == CHILD_DOC_TYPE:
+            child_id = uuid4().hex
+            with self.lock:
+                self.children[child_id] = {"_id": child_id, "_type": doc_type, "_parent": parent,
+                                           "_source": dict(body)}
+        return {"created": True}
+
+    def update(self, index=None, doc_type=None, id=None, body=None, **kwargs):
+        self.record("update")
+        if doc_type == CHILD_DOC_TYPE:
+            with self.lock:
+                self.children[id]["_source"].update(body.get("doc", {}))
+        return {"result": "updated"}
+
+    def update_by_query(self, index=None, doc_type=None, body=None, size=None, **kwargs):
+        self.record("update_by_query")
+        before_time = find_values(body, "lte")[0]
+        user_ids = [term["user_id"] for term in find_values(body, "term") if "user_id" in term]
+        params = body["script"]["params"]
+        updated = 0
+        with self.lock:
+            for child in self.children.values():
+                source = child["_source"]
+                if not source.get("check_flag") or source["last_fetch_date"] > before_time:
+                    continue
+                if source.get("user_id") in user_ids:
+                    continue
+                source.update(params)
+                updated += 1
+                if size is not None and updated >= size:
+                    break
+        return {"updated": updated}
+
+    def put_template(self, id=None, body=None, **kwargs):
+        self.record("put_template")
+
+    def delete_template(self, id=None, **kwargs):
+        self.record("delete_template")
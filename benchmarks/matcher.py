@@ -0,0 +1,423 @@
+from __future__ import unicode_literals
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from servicematcher import models
+from servicematcher.benchmarks.fakes import (SEARCH_DATA, WAREHOUSE_TIME_LIMIT, FakeElasticsearch, FakeWarehouse,
+                                             build_url, generate_index_elements, generate_warehouse_services)
+from servicematcher.metrics import clock
+from servicematcher.utils import get_logging
+
+log = get_logging(__name__)
+
+SQL_LEASE_LENGTH = 3600
+
+
+def percentile(values, p):
+    """
+    :param values: list of float, sorted
+    :param p: float, between 0 and 100
+    :return: float, nearest-rank percentile, 0 if there are no values
+    """
+    if not values:
+        return 0.
+    return values[min(len(values) - 1, int(len(values) * p / 100.))]
+
+
+class Benchmark(object):
+    """
+    Run the real views of the matcher against FakeWarehouse and FakeElasticsearch, with several matchers
+    fetching, searching and submitting at the same time on their own threads.
+    Needs a database of its own, e.g. the test database created by the benchmark_matcher command.
+    """
+
+    ENDPOINTS = ("business_types", "fetch_batch", "index_elements", "submit")
+
+    def __init__(self, matchers=4, batches=5, batch_size=10, services=500, second_matches=100, search_rate=0.3,
+                 not_enough_info_rate=0.05, elastic_latency=0., warehouse_latency=0., lease_length=WAREHOUSE_TIME_LIMIT,
+                 seed=0):
+        self.matchers = matchers
+        self.batches = batches
+        self.batch_size = batch_size
+        self.services = services
+        self.second_matches = second_matches
+        self.search_rate = search_rate
+        self.not_enough_info_rate = not_enough_info_rate
+        self.lease_length = lease_length
+        self.seed = seed
+        self.index_elements = generate_index_elements(SEARCH_DATA["level1_id"], SEARCH_DATA["level1"])
+        self.warehouse = FakeWarehouse(generate_warehouse_services(SEARCH_DATA["level1_id"], services, seed),
+                                       latency=warehouse_latency, time_limit=lease_length)
+        self.elastic = FakeElasticsearch(self.index_elements, latency=elastic_latency)
+        self.factory = APIRequestFactory()
+        self.views = {}
+        self.users = []
+        self.timings = defaultdict(list)
+        self.query_counts = defaultdict(list)
+        self.errors = Counter()
+        # (user id, service key, origin, time) of every service fetched
+        self.fetched = []
+        # user id: requested_at of their last fetch_batch
+        self.requested_at = {}
+        # batch_size of every fetch_batch response
+        self.batch_sizes = []
+        # (user id, service key, time) of every match saved
+        self.submitted = []
+        self.lock = threading.Lock()
+
+    def create_user(self, name):
+        User = get_user_model()
+        email = "{}@benchmark.local".format(name)
+        fields = {User.USERNAME_FIELD: email}
+        if User.USERNAME_FIELD != "email":
+            fields["email"] = email
+        return User.objects.create(**fields)
+
+    def seed_database(self):
+        """
+        Create the index elements, the matchers, and services matched once waiting for their 2nd match
+        """
+        models.IndexElement.objects.bulk_create([models.IndexElement(**element) for element in self.index_elements])
+        self.users = [self.create_user("matcher{}".format(i)) for i in range(self.matchers)]
+        if not self.second_matches:
+            return
+        first_matcher = self.create_user("first-matcher")
+        session = models.SessionMetric.objects.create(user=first_matcher, match_counter=self.second_matches)
+        rng = random.Random(self.seed + 1)
+        elements = list(models.IndexElement.objects.filter(level1_id=SEARCH_DATA["level1_id"]))
+        datas = generate_warehouse_services(SEARCH_DATA["level1_id"], self.second_matches, self.seed + 1)
+        for data in datas:
+            venue, _ = models.Venue.objects.get_or_create(
+                wh_key="sql-" + data["subdomain"],
+                defaults={"name": data["venue_name"], "category_name": data["venue_category"],
+                          "category_id": data["venue_category_id"]})
+            service = models.Service.objects.create(
+                venue=venue,
+                description=data["description"],
+                category=data["category"],
+                wh_key="sql-" + data["key"],
+                search_level1_id=SEARCH_DATA["level1_id"],
+                search_level1=SEARCH_DATA["level1"],
+                search_city=SEARCH_DATA["city"],
+                search_country=SEARCH_DATA["country"],
+            )
+            models.Match.objects.create(service=service, session=session, user=first_matcher,
+                                        match_index=rng.choice(elements), time_spent=rng.randint(2000, 30000),
+                                        match_backend_version=2)
+
+    def call(self, endpoint, user, data):
+        """
+        Call the view of an endpoint like the frontend would, and record its time and number of queries
+        :return: Response or None if the view failed
+        """
+        if endpoint in ("business_types", "index_elements"):
+            request = self.factory.get("/matcher/{}".format(endpoint), data)
+        else:
+            request = self.factory.post("/matcher/{}".format(endpoint), data, format="json")
+        force_authenticate(request, user=user)
+        with CaptureQueriesContext(connection) as queries:
+            start = clock()
+            try:
+                response = self.views[endpoint](request)
+            except Exception:
+                log.exception("{} failed".format(endpoint))
+                response = None
+            elapsed = clock() - start
+        with self.lock:
+            self.timings[endpoint].append(elapsed)
+            self.query_counts[endpoint].append(len(queries))
+            if response is None or response.status_code >= 400:
+                self.errors[endpoint] += 1
+        return response
+
+    def get_submit_payload(self, data, rng, time_spent=None):
+        """
+        :param time_spent: float, seconds spent on the service, random if None
+        """
+        wizards = [element["wizard"] for element in data.get("index_elements") or []]
+        if not wizards:
+            wizards = [rng.choice(self.elastic.wizards)]
+        service_fields = ("key", "description", "category", "elastic_service_id", "elastic_index_element_id")
+        venue_fields = ("key", "name", "category_id", "category_name")
+        return {
+            "service": dict((field, data["service"][field]) for field in service_fields if field in data["service"]),
+            "venue": dict((field, data["venue"][field]) for field in venue_fields if field in data["venue"]),
+            "search_data": SEARCH_DATA,
+            "country": SEARCH_DATA["country"],
+            "match_data": {
+                "matched_index_element_id": wizards[0],
+                "unmatched_index_element_ids": wizards[1:],
+                "wizard": wizards[0],
+                "used_search": False,
+                "not_enough_info": rng.random() < self.not_enough_info_rate,
+                "time_spent": str(int(time_spent * 1000) if time_spent is not None else rng.randint(2000, 30000)),
+            },
+        }
+
+    def fetch(self, user):
+        """
+        :return: list of dict, the services of the batch
+        """
+        # in ms like the frontend, increasing for every matcher so the prefetched batches are served
+        requested_at = max(int(time.time() * 1000), self.requested_at.get(user.id, 0) + 1)
+        self.requested_at[user.id] = requested_at
+        response = self.call("fetch_batch", user, {
+            "search_data": SEARCH_DATA,
+            "requested_at": requested_at,
+            "batch_size": self.batch_size,
+        })
+        if response is None or not isinstance(response.data, dict):
+            return []
+        datas = response.data["results"]
+        now = time.time()
+        with self.lock:
+            self.fetched += [(user.id, data["service"]["key"], data["origin"], now) for data in datas]
+            self.batch_sizes.append(response.data.get("batch_size", self.batch_size))
+        return datas
+
+    def match(self, user, data, rng, time_spent=None):
+        if rng.random() < self.search_rate:
+            words = data["service"]["description"].split()
+            self.call("index_elements", user, {
+                "search_string": words[0][:4] if words else "cut",
+                "level1": SEARCH_DATA["level1"],
+                "country": SEARCH_DATA["country"],
+            })
+        response = self.call("submit", user, self.get_submit_payload(data, rng, time_spent))
+        if response is not None and response.status_code < 400:
+            with self.lock:
+                self.submitted.append((user.id, data["service"]["key"], time.time()))
+
+    def run_matcher(self, user, rng):
+        try:
+            self.call("business_types", user, {"city": SEARCH_DATA["city"]})
+            for _ in range(self.batches):
+                datas = self.fetch(user)
+                if not datas:
+                    break
+                for data in datas:
+                    self.match(user, data, rng)
+        finally:
+            connection.close()
+
+    def run_matchers(self, target):
+        threads = [threading.Thread(target=target, args=(user, random.Random(self.seed + i)),
+                                    name="servicematcher-benchmark-{}".format(i))
+                   for i, user in enumerate(self.users)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def run(self, target=None):
+        """
+        :param target: function, run by every matcher with its user and a random generator, run_matcher by default
+        :return: dict, the report
+        """
+        self.seed_database()
+        self.warehouse.start()
+        try:
+            with override_settings(SERVICEMATCHER_IN_TEST_MODE=False,
+                                   WAREHOUSE_HOST="127.0.0.1",
+                                   WAREHOUSE_PORT=self.warehouse.port,
+                                   BUILD_URL=build_url):
+                # imported here, the views load the index elements of the database when imported
+                from servicematcher import views
+                from servicematcher.taxonomy import index_elements
+                index_elements.refresh(force=True)
+                self.views = {
+                    "business_types": views.FetchBusinessType.as_view(),
+                    "fetch_batch": views.FetchBatchService.as_view(),
+                    "index_elements": views.SearchService.as_view(),
+                    "submit": views.SubmitService.as_view(),
+                }
+                es_client = views.es.es
+                views.es.es = self.elastic
+                views.es.top3_cache.clear()
+                views.es.autocomplete_cache.clear()
+                start = clock()
+                try:
+                    self.run_matchers(target or self.run_matcher)
+                finally:
+                    views.es.es = es_client
+                elapsed = clock() - start
+        finally:
+            self.warehouse.stop()
+        return self.get_report(elapsed)
+
+    def get_report(self, elapsed):
+        endpoints = {}
+        for endpoint in self.ENDPOINTS:
+            timings = sorted(self.timings[endpoint])
+            if not timings:
+                continue
+            query_counts = self.query_counts[endpoint]
+            endpoints[endpoint] = {
+                "requests": len(timings),
+                "errors": self.errors[endpoint],
+                "p50_ms": percentile(timings, 50) * 1000,
+                "p95_ms": percentile(timings, 95) * 1000,
+                "p99_ms": percentile(timings, 99) * 1000,
+                "queries_per_request": sum(query_counts) / float(len(query_counts)),
+                "max_queries": max(query_counts),
+            }
+        requests = sum(endpoint["requests"] for endpoint in endpoints.values())
+        return {
+            "settings": {
+                "matchers": self.matchers,
+                "batches": self.batches,
+                "batch_size": self.batch_size,
+                "services": self.services,
+                "second_matches": self.second_matches,
+            },
+            "seconds": elapsed,
+            "submits_per_second": len(self.timings["submit"]) / elapsed if elapsed else 0.,
+            "endpoints": endpoints,
+            "warehouse_calls": dict(self.warehouse.calls),
+            "elastic_calls": dict(self.elastic.calls),
+            "outbound_calls_per_request": (sum(self.warehouse.calls.values()) + sum(self.elastic.calls.values()))
+            / float(max(requests, 1)),
+        }
+
+
+class StressTest(Benchmark):
+    """
+    Many matchers fetching and submitting for a fixed time, some of them abandoning their batch,
+    to measure how the leases of SQL, elastic and the warehouse hold under contention
+    """
+
+    def __init__(self, duration=60, think_time=0.5, abandon_rate=0.05, **kwargs):
+        """
+        :param duration: float, seconds of the run
+        :param think_time: float, average seconds spent by a matcher on a service
+        :param abandon_rate: float, chance that a matcher leaves the rest of its batch after a service
+        """
+        super(StressTest, self).__init__(**kwargs)
+        self.duration = duration
+        self.think_time = think_time
+        self.abandon_rate = abandon_rate
+        self.end = None
+
+    def run_matcher(self, user, rng):
+        try:
+            while clock() < self.end:
+                datas = self.fetch(user)
+                if not datas:
+                    time.sleep(0.1)
+                    continue
+                for data in datas:
+                    start = clock()
+                    if self.think_time:
+                        time.sleep(min(rng.expovariate(1. / self.think_time), max(0, self.end - clock())))
+                    # the real time spent, for the adaptive batch size
+                    self.match(user, data, rng, time_spent=clock() - start)
+                    if clock() >= self.end or rng.random() < self.abandon_rate:
+                        break
+        finally:
+            connection.close()
+
+    def run_matchers(self, target):
+        self.end = clock() + self.duration
+        super(StressTest, self).run_matchers(target)
+
+    def get_lease_length(self, origin):
+        if origin == "warehouse":
+            return self.lease_length
+        # get_batch_unmatch_service and the elastic queue fetch the services again after 1 hour
+        return SQL_LEASE_LENGTH
+
+    def get_claim_end(self, fetched_time, end, origin):
+        """
+        :param end: float or None, when the matcher saved the service, None if they never did
+        :return: float, the end of the claim, when the service is saved or its lease expires
+        """
+        lease_end = fetched_time + self.get_lease_length(origin)
+        return lease_end if end is None else min(end, lease_end)
+
+    def get_lease_stats(self, elapsed):
+        submits = defaultdict(list)
+        for user_id, key, submitted_time in self.submitted:
+            submits[key].append((submitted_time, user_id))
+        claims = defaultdict(list)
+        for user_id, key, origin, fetched_time in sorted(self.fetched, key=lambda claim: claim[3]):
+            # a claim ends when its matcher saves the service, it is never released otherwise
+            ends = [submitted_time for submitted_time, submitter in submits.get(key, [])
+                    if submitter == user_id and submitted_time >= fetched_time]
+            claims[key].append((fetched_time, min(ends) if ends else None, origin))
+        duplicates = expired = abandoned = 0
+        for key_claims in claims.values():
+            for i, (fetched_time, end, origin) in enumerate(key_claims):
+                # an earlier claim is open until its submit or the end of its lease, claiming the service again
+                # once its lease expired is expected
+                if any(self.get_claim_end(previous_fetched_time, previous_end, previous_origin) > fetched_time
+                       for previous_fetched_time, previous_end, previous_origin in key_claims[:i]):
+                    duplicates += 1
+                if end is None:
+                    abandoned += 1
+                elif end - fetched_time > self.get_lease_length(origin):
+                    expired += 1
+        waits = []
+        for key_submits in submits.values():
+            key_submits.sort()
+            first_time, first_user = key_submits[0]
+            second_times = [submitted_time for submitted_time, user_id in key_submits[1:] if user_id != first_user]
+            if second_times:
+                waits.append(second_times[0] - first_time)
+        waits.sort()
+        total = len(self.fetched)
+        return {
+            "claims": total,
+            "claims_per_second": total / elapsed if elapsed else 0.,
+            "duplicate_claims": duplicates,
+            "duplicate_claim_rate": duplicates / float(max(total, 1)),
+            "expired_leases": expired,
+            "abandoned_leases": abandoned,
+            "wasted_lease_rate": (expired + abandoned) / float(max(total, 1)),
+            "expired_lease_rate": expired / float(max(total, 1)),
+            "mean_batch_size": sum(self.batch_sizes) / float(max(len(self.batch_sizes), 1)),
+            "warehouse_leases": len(self.warehouse.lease_log),
+            "double_matched": len(waits),
+            "second_match_wait_p50_s": percentile(waits, 50),
+            "second_match_wait_p95_s": percentile(waits, 95),
+            "second_match_wait_max_s": waits[-1] if waits else 0.,
+        }
+
+    def get_report(self, elapsed):
+        report = super(StressTest, self).get_report(elapsed)
+        report["settings"].update(duration=self.duration, think_time=self.think_time,
+                                  abandon_rate=self.abandon_rate, lease_length=self.lease_length)
+        report["leases"] = self.get_lease_stats(elapsed)
+        return report
+
+
+def compare_to_baseline(report, baseline, tolerance=0.2):
+    """
+    :param report: dict, from Benchmark.run
+    :param baseline: dict, a previous report
+    :param tolerance: float, relative slowdown allowed
+    :return: list of str, the regressions
+    """
+    regressions = []
+    for endpoint, stats in sorted(report["endpoints"].items()):
+        base = baseline["endpoints"].get(endpoint)
+        if base is None:
+            continue
+        for stat in ("p50_ms", "p95_ms", "p99_ms"):
+            # 1ms of slack so the fastest endpoints do not flap
+            if stats[stat] > base[stat] * (1 + tolerance) + 1:
+                regressions.append("{} {}: {:.1f} instead of {:.1f}".format(endpoint, stat, stats[stat], base[stat]))
+        if stats["queries_per_request"] > base["queries_per_request"] + 0.5:
+            regressions.append("{} queries per request: {:.1f} instead of {:.1f}".format(
+                endpoint, stats["queries_per_request"], base["queries_per_request"]))
+    if report["outbound_calls_per_request"] > baseline["outbound_calls_per_request"] * (1 + tolerance):
+        regressions.append("outbound calls per request: {:.2f} instead of {:.2f}".format(
+            report["outbound_calls_per_request"], baseline["outbound_calls_per_request"]))
+    return regressions
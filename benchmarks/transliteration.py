@@ -0,0 +1,49 @@
+from __future__ import unicode_literals
+import random
+
+from unidecode import unidecode
+
+from servicematcher.benchmarks.fakes import SEARCH_DATA, generate_warehouse_services
+from servicematcher.metrics import clock
+from servicematcher.utils import get_transliteration_stats, transliterate, transliterations
+
+
+def benchmark_transliteration(batches=1000, batch_size=10, venues=200, accented_rate=0.2, seed=0):
+    """
+    Time the transliteration of the 4 fields formatted for each warehouse service, with unidecode on
+    every string against transliterate, on batches where the venues come back like in a city
+    :param accented_rate: float, share of the venue names and descriptions with accents
+    :return: dict, microseconds per batch of both and the stats of the cache
+    """
+    rng = random.Random(seed)
+    accents = ["Caf\xe9", "Cr\xe8me", "S\xf8ren", "\xc9l\xe9gance", "Ni\xf1a", "Fa\xe7ade", "Sch\xf6n"]
+    services = generate_warehouse_services(SEARCH_DATA["level1_id"], batches * batch_size, seed)
+    for service in services:
+        venue = rng.randint(0, venues - 1)
+        service["venue_name"] = "Venue {}".format(venue)
+        if rng.random() < accented_rate:
+            service["venue_name"] = "{} {}".format(accents[venue % len(accents)], venue)
+        if rng.random() < accented_rate:
+            service["description"] = "{} {}".format(rng.choice(accents), service["description"])
+    batches = [services[i:i + batch_size] for i in range(0, len(services), batch_size)]
+    fields = ("description", "category", "venue_category", "venue_name")
+
+    def run(function):
+        start = clock()
+        for batch in batches:
+            for service in batch:
+                for field in fields:
+                    function(service[field])
+        return (clock() - start) / len(batches) * 1e6
+
+    unidecode_us = run(unidecode)
+    transliterations.clear()
+    transliterate_us = run(transliterate)
+    return {
+        "batches": len(batches),
+        "batch_size": batch_size,
+        "unidecode_us_per_batch": unidecode_us,
+        "transliterate_us_per_batch": transliterate_us,
+        "saving_us_per_batch": unidecode_us - transliterate_us,
+        "cache": get_transliteration_stats(),
+    }
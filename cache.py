@@ -0,0 +1,62 @@
+from __future__ import unicode_literals
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Thread-safe LRU cache whose entries also expire after ttl seconds
+    """
+
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or (self.ttl is not None and entry[0] < time.time()):
+                self.misses += 1
+                return default
+            # move it to the most recently used end
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        expire_time = time.time() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (expire_time, value)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete_where(self, predicate):
+        """
+        :param predicate: function, called with each key, the entries for which it is True are deleted
+        :return: int, number of entries deleted
+        """
+        with self.lock:
+            keys = [key for key in self.entries if predicate(key)]
+            for key in keys:
+                del self.entries[key]
+        return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / float(requests) if requests else 0.,
+        }
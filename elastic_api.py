@@ -1,13 +1,20 @@
 from __future__ import unicode_literals
 from logging import NullHandler
+from uuid import uuid4
 from datetime import datetime, timedelta
 from random import shuffle
 
 from django.conf import settings
 from elasticsearch import Elasticsearch, RequestsHttpConnection
+from elasticsearch.helpers import bulk, scan
 
 from servicematcher import queries as eq
-from servicematcher.utils import get_logging, get_unix_time
+from servicematcher.cache import LRUCache
+from servicematcher.autocomplete import LocalAutocompleter
+from servicematcher.local_scorer import LocalScorer
+from servicematcher.metrics import span
+from servicematcher.taxonomy import index_elements
+from servicematcher.utils import get_logging
 
 tracer = get_logging('elasticsearch.trace')
 tracer.addHandler(NullHandler())
@@ -18,6 +25,20 @@ PARENT_DOC_TYPE = "index_element"
 CHILD_DOC_TYPE = "service"
 NEGATIVE_CHILD_DOC_TYPE = "negative_service"
 SEARCHED_CHILD_DOC_TYPE = "searched_service"
+AUTOCOMPLETE_CACHE_SIZE = getattr(settings, "SERVICEMATCHER_AUTOCOMPLETE_CACHE_SIZE", 10000)
+AUTOCOMPLETE_CACHE_TTL = getattr(settings, "SERVICEMATCHER_AUTOCOMPLETE_CACHE_TTL", 300)
+TOP3_CACHE_SIZE = getattr(settings, "SERVICEMATCHER_TOP3_CACHE_SIZE", 20000)
+TOP3_CACHE_TTL = getattr(settings, "SERVICEMATCHER_TOP3_CACHE_TTL", 3600)
+# level1 ids whose top3 is scored in memory instead of with the has_child query
+LOCAL_SCORER_LEVEL1_IDS = getattr(settings, "SERVICEMATCHER_LOCAL_SCORER_LEVEL1_IDS", ())
+# "has_child" or "aliases" to only query the alias fields denormalized on the index elements by denormalize_aliases
+TOP3_QUERY = getattr(settings, "SERVICEMATCHER_TOP3_QUERY", "has_child")
+# Keep the alias fields up to date when a service is saved, to be set before switching TOP3_QUERY to "aliases"
+MAINTAIN_ALIASES = getattr(settings, "SERVICEMATCHER_MAINTAIN_ALIASES", False) or TOP3_QUERY == "aliases"
+# Send only the id and params of the templates stored with register_search_templates
+USE_SEARCH_TEMPLATES = getattr(settings, "SERVICEMATCHER_USE_SEARCH_TEMPLATES", False)
+# "elastic" or "local" to answer the autocomplete from memory, elastic is then only used when nothing matched
+AUTOCOMPLETE_ENGINE = getattr(settings, "SERVICEMATCHER_AUTOCOMPLETE_ENGINE", "elastic")
 
 
 def format_service_for_frontend_from_elastic_hit(hit):
@@ -39,6 +60,7 @@ def format_service_for_frontend_from_elastic_hit(hit):
             "category_name": hit["_source"]["venue_category"],
             "category_id": hit["_source"]["venue_category_id"],
         },
+        "wizard": hit["_parent"],
         "origin": "elastic",
     }
     return data
@@ -87,6 +109,56 @@ def format_service_for_elastic_from_request(service, venue, user, time_spent):
     return new
 
 
+def normalize_search_string(search_string):
+    """
+    "  Hair  Cu" and "hair cu" are the same search
+    """
+    return " ".join(search_string.lower().split())
+
+
+def get_top3_cache_key(data, level1_id, country):
+    """
+    Chains send the same service for all their venues, they share the same top3
+    """
+    return (
+        country,
+        level1_id,
+        normalize_search_string(data["service"]["description"]),
+        normalize_search_string(data["service"]["category"]),
+        normalize_search_string(data["venue"]["category_name"]),
+    )
+
+
+def get_aliases_from_child(child):
+    """
+    :param child: dict, service child saved in elastic
+    :return: dict, alias field of the parent -> normalized text
+    """
+    return dict(
+        (alias_field, normalize_search_string(child[child_field]))
+        for child_field, alias_field in eq.CHILD_FIELD_TO_ALIAS_FIELD.items()
+        if child.get(child_field)
+    )
+
+
+def merge_top3_hits(hits):
+    """
+    Keep the 1st matcher result (if any) in front, drop its duplicate or the last match and shuffle
+    :param hits: list of dict, index_elements, the 1st matcher result first
+    :return: list of dict, at most 3 index_elements
+    """
+    if len(hits) > 3:
+        # delete duplicate or last match
+        hit1_wizard = hits[0]["id"]
+        for i in range(1, 4):
+            if hits[i]["id"] == hit1_wizard:
+                hits.pop(i)
+                break
+        hits = hits[:3]
+    shuffle(hits)
+    return hits
+
+
 class ElasticServices(object):
 
     def __init__(self):
@@ -97,6 +169,14 @@ class ElasticServices(object):
             connection_class=RequestsHttpConnection,
             send_get_body_as='POST')
         log.info("Using Elastic {}".format(self.es))
+        self.autocomplete_cache = LRUCache(AUTOCOMPLETE_CACHE_SIZE, AUTOCOMPLETE_CACHE_TTL)
+        self.autocomplete_cache_version = index_elements.version
+        self.top3_cache = LRUCache(TOP3_CACHE_SIZE, TOP3_CACHE_TTL)
+        self.index_element_docs = LRUCache(TOP3_CACHE_SIZE, TOP3_CACHE_TTL)
+        self.local_scorer = LocalScorer(LOCAL_SCORER_LEVEL1_IDS) if LOCAL_SCORER_LEVEL1_IDS else None
+        self.local_autocompleter = None
+        if AUTOCOMPLETE_ENGINE == "local":
+            self.local_autocompleter = LocalAutocompleter(self.es, PARENT_DOC_TYPE, format_index_element_from_elastic_hit)
 
     def autocompleter(self, country, search_string, range_size=10, skip=0, level1_id=""):
         """
@@ -108,12 +188,46 @@ class ElasticServices(object):
         :param level1_id: str, for filter in elastic, e.g. "Hair & Beauty"
         :return: list of dict, index_elements
         """
-        query = eq.query_get_index_elements_from_search_string(search_string, size=range_size, skip=skip, level1_id=level1_id)
+        if self.local_autocompleter is not None:
+            hits = self.local_autocompleter.search(country_to_index[country], search_string, size=range_size, skip=skip,
+                                                   level1_id=level1_id, version=index_elements.version)
+            if hits or skip:
+                return hits
+            # nothing starts with these words, let elastic try a fuzzier match
+        if self.autocomplete_cache_version != index_elements.version:
+            # the catalogue changed
+            self.autocomplete_cache.clear()
+            self.autocomplete_cache_version = index_elements.version
+        key = (country, level1_id, normalize_search_string(search_string), skip, range_size)
+        hits = self.autocomplete_cache.get(key)
+        if hits is not None:
+            return hits
         index = country_to_index[country]
-        res = self.es.search(index=index, doc_type=PARENT_DOC_TYPE, body=query)
+        if USE_SEARCH_TEMPLATES:
+            query = eq.template_get_index_elements_from_search_string(search_string, size=range_size, skip=skip, level1_id=level1_id)
+            res = self.es.search_template(index=index, doc_type=PARENT_DOC_TYPE, body=query)
+        else:
+            query = eq.query_get_index_elements_from_search_string(search_string, size=range_size, skip=skip, level1_id=level1_id)
+            res = self.es.search(index=index, doc_type=PARENT_DOC_TYPE, body=query)
         hits = [format_index_element_from_elastic_hit(hit) for hit in res['hits']['hits']]
+        self.autocomplete_cache.set(key, hits)
         return hits
 
+    @staticmethod
+    def get_top3_query(data, level1_id, query_type=None):
+        """
+        :param data: dict, containing "service" and "venue"
+        :param level1_id: str,
+        :param query_type: str, "has_child" or "aliases", TOP3_QUERY if None
+        :return: dict, query or template body
+        """
+        aliases = (query_type or TOP3_QUERY) == "aliases"
+        if USE_SEARCH_TEMPLATES:
+            return eq.template_get_index_elements_from_service(data["service"], data["venue"], level1_id, aliases=aliases)
+        if aliases:
+            return eq.query_get_index_elements_from_aliases(data["service"], data["venue"], level1_id)
+        return eq.query_get_index_elements_from_service(data["service"], data["venue"], level1_id)
+
     def get_top3_index_elements_from_service(self, data, level1_id, country, get_1st_match=True):
         """
         This send top 3 matched parents to the frontend and frontend should
@@ -123,37 +237,205 @@ class ElasticServices(object):
         :param get_1st_match: boolean, get the match of the 1st matcher if it's the second matcher fetching
         :return: dict, parent, triplet and the user_dictionary
         """
-        query = eq.query_get_index_elements_from_service(data["service"], data["venue"], level1_id)
+        if self.local_scorer is not None and self.local_scorer.handles(level1_id):
+            return self.get_top3_index_elements_from_services([data], level1_id, country, get_1st_match)[0]
         index = country_to_index[country]
+        with span("elastic") as s:
+            hits = self.search_top3_index_elements(data, level1_id, country, index, get_1st_match)
+        log.info("Fetching top3 took: {}ms".format(s.ms))
+        return hits
+
+    def search_top3_index_elements(self, data, level1_id, country, index, get_1st_match):
         hits = []
-        log.info("START fetching top3")
-        time = get_unix_time()
         if get_1st_match and "wizard" in data:
             # 2nd matcher - fetch the 1st matcher result
             hit = self.es.get(index=index, id=data["wizard"], doc_type=PARENT_DOC_TYPE)
             hits += [format_index_element_from_elastic_hit(hit)]
-        try:
-            res = self.es.search(index=index, body=query, doc_type=PARENT_DOC_TYPE)
-            if res['hits']['total'] > 0:
-                hits += [format_index_element_from_elastic_hit(hit) for hit in res['hits']['hits']]
-            log.info("Elastic returned top3 for: {} {}".format(data["service"]["key"], data["venue"]["key"]))
-        except:
-            log.warning("No service were found for this service: {} {}".format(data["service"]["key"], data["venue"]["key"]))
-        log.info("STOP fetching top3. It took: {}ms".format(get_unix_time() - time))
-        if len(hits) > 3:
-            # delete duplicate or last match
-            hit1_wizard = hits[0]["id"]
-            for i in range(1, 4):
-                if hits[i]["id"] == hit1_wizard:
-                    hits.pop(i)
-                    break
-            hits = hits[:3]
-        shuffle(hits)
-        return hits
+        key = get_top3_cache_key(data, level1_id, country)
+        cached_hits = self.top3_cache.get(key)
+        if cached_hits is not None:
+            hits += cached_hits
+        else:
+            try:
+                query = self.get_top3_query(data, level1_id)
+                if USE_SEARCH_TEMPLATES:
+                    res = self.es.search_template(index=index, body=query, doc_type=PARENT_DOC_TYPE)
+                else:
+                    res = self.es.search(index=index, body=query, doc_type=PARENT_DOC_TYPE)
+                top3_hits = [format_index_element_from_elastic_hit(hit) for hit in res['hits']['hits']]
+                self.top3_cache.set(key, top3_hits)
+                hits += top3_hits
+                log.info("Elastic returned top3 for: {} {}".format(data["service"]["key"], data["venue"]["key"]))
+            except:
+                log.warning("No service were found for this service: {} {}".format(data["service"]["key"], data["venue"]["key"]))
+        return merge_top3_hits(hits)
+
+    def get_top3_index_elements_from_services(self, datas, level1_id, country, get_1st_match=True):
+        """
+        Batch version of get_top3_index_elements_from_service: one mget for the 1st matcher results
+        and one msearch for all the top3 queries, whatever the size of the batch
+        :param datas: list of dict, containing "service" and "venue", and "wizard" if the service is for 2nd matcher
+        :param level1_id: str, for filter in elastic, e.g. "01000"
+        :param country: str,
+        :param get_1st_match: boolean, get the match of the 1st matcher if it's the second matcher fetching
+        :return: list of list of dict, the index_elements for each service, in the same order as datas
+        """
+        if not datas:
+            return []
+        index = country_to_index[country]
+        first_hits = [[] for _ in datas]
+        if get_1st_match:
+            wizards = [data["wizard"] for data in datas if "wizard" in data]
+            if wizards:
+                res = self.es.mget(index=index, doc_type=PARENT_DOC_TYPE, body={"ids": wizards})
+                found = dict((doc["_id"], doc) for doc in res["docs"] if doc.get("found"))
+                for i, data in enumerate(datas):
+                    if data.get("wizard") in found:
+                        first_hits[i] = [format_index_element_from_elastic_hit(found[data["wizard"]])]
+        keys = [get_top3_cache_key(data, level1_id, country) for data in datas]
+        top3_hits = {}
+        missing_datas = {}
+        for key, data in zip(keys, datas):
+            cached_hits = self.top3_cache.get(key)
+            if cached_hits is not None:
+                top3_hits[key] = cached_hits
+            else:
+                # the same service sent by several venues of a chain is only searched once
+                missing_datas.setdefault(key, data)
+        scored = None
+        if missing_datas and self.local_scorer is not None and self.local_scorer.handles(level1_id):
+            missing_keys = list(missing_datas)
+            # None while the partition is built, elastic answers meanwhile
+            scored = self.local_scorer.top_k([missing_datas[key] for key in missing_keys], level1_id, country)
+        if scored is not None:
+            docs = self.get_index_elements(set(wizard for hits in scored for wizard, _ in hits), country)
+            for key, hits in zip(missing_keys, scored):
+                top3_hits[key] = [dict(docs[wizard], score=score) for wizard, score in hits if wizard in docs]
+                self.top3_cache.set(key, top3_hits[key])
+        elif missing_datas:
+            missing_keys = list(missing_datas)
+            body = []
+            for key in missing_keys:
+                body.append({})
+                body.append(self.get_top3_query(missing_datas[key], level1_id))
+            if USE_SEARCH_TEMPLATES:
+                res = self.es.msearch_template(index=index, doc_type=PARENT_DOC_TYPE, body=body)
+            else:
+                res = self.es.msearch(index=index, doc_type=PARENT_DOC_TYPE, body=body)
+            for key, response in zip(missing_keys, res["responses"]):
+                if "error" in response:
+                    data = missing_datas[key]
+                    log.warning("No service were found for this service: {} {}".format(data["service"]["key"], data["venue"]["key"]))
+                    continue
+                top3_hits[key] = [format_index_element_from_elastic_hit(hit) for hit in response['hits']['hits']]
+                self.top3_cache.set(key, top3_hits[key])
+        results = []
+        for key, hits in zip(keys, first_hits):
+            results.append(merge_top3_hits(hits + top3_hits.get(key, [])))
+        return results
+
+    def get_index_elements(self, index_element_ids, country):
+        """
+        :param index_element_ids: iterable of str,
+        :param country: str,
+        :return: dict, id -> index_element for frontend, cached as they hardly ever change
+        """
+        index = country_to_index[country]
+        found = {}
+        missing_ids = []
+        for index_element_id in index_element_ids:
+            doc = self.index_element_docs.get((index, index_element_id))
+            if doc is not None:
+                found[index_element_id] = doc
+            else:
+                missing_ids.append(index_element_id)
+        if missing_ids:
+            res = self.es.mget(index=index, doc_type=PARENT_DOC_TYPE, body={"ids": missing_ids})
+            for doc in res["docs"]:
+                if doc.get("found"):
+                    found[doc["_id"]] = format_index_element_from_elastic_hit(doc)
+                    self.index_element_docs.set((index, doc["_id"]), found[doc["_id"]])
+        return found
+
+    def denormalize_aliases(self, country):
+        """
+        Aggregate the texts of all the service children on the alias fields of their index_element parent
+        :param country: str,
+        :return: int, number of index elements updated
+        """
+        index = country_to_index[country]
+        child_mapping = self.es.indices.get_mapping(index=index, doc_type=CHILD_DOC_TYPE)[index]["mappings"][CHILD_DOC_TYPE]
+        # same analyzers as the child fields the has_child clauses query
+        properties = dict(
+            (alias_field, child_mapping["properties"][child_field])
+            for child_field, alias_field in eq.CHILD_FIELD_TO_ALIAS_FIELD.items()
+        )
+        self.es.indices.put_mapping(index=index, doc_type=PARENT_DOC_TYPE, body={"properties": properties})
+        aliases = {}
+        children = scan(self.es, index=index, doc_type=CHILD_DOC_TYPE, query={"query": {"match_all": {}}},
+                        _source=list(eq.CHILD_FIELD_TO_ALIAS_FIELD))
+        for hit in children:
+            parent_aliases = aliases.setdefault(hit["_parent"], {})
+            for alias_field, text in get_aliases_from_child(hit["_source"]).items():
+                parent_aliases.setdefault(alias_field, set()).add(text)
+        actions = (
+            {
+                "_op_type": "update",
+                "_index": index,
+                "_type": PARENT_DOC_TYPE,
+                "_id": index_element_id,
+                "doc": dict((field, sorted(texts)) for field, texts in parent_aliases.items()),
+            }
+            for index_element_id, parent_aliases in aliases.items()
+        )
+        updated, _ = bulk(self.es, actions, raise_on_error=False)
+        log.info("Denormalized the aliases of {} index elements in {}".format(updated, index))
+        return updated
+
+    def compare_top3_queries(self, datas, level1_id, country):
+        """
+        Run the has_child and the aliases top3 queries side by side
+        :param datas: list of dict, containing "service" and "venue"
+        :return: dict, query type -> list of the elastic "took" in ms, and the share of identical top3
+        """
+        index = country_to_index[country]
+        tooks = {"has_child": [], "aliases": []}
+        same = 0
+        search = self.es.search_template if USE_SEARCH_TEMPLATES else self.es.search
+        for data in datas:
+            ids = {}
+            for query_type in tooks:
+                res = search(index=index, doc_type=PARENT_DOC_TYPE, body=self.get_top3_query(data, level1_id, query_type))
+                tooks[query_type].append(res["took"])
+                ids[query_type] = [hit["_id"] for hit in res["hits"]["hits"]]
+            if ids["has_child"] == ids["aliases"]:
+                same += 1
+        tooks["same_top3_ratio"] = same / float(len(datas)) if datas else 0.
+        return tooks
+
+    def register_search_templates(self, delete_old=False):
+        """
+        Store the templates of the current SEARCH_TEMPLATE_VERSION in elastic
+        :param delete_old: Boolean, also delete the templates of the previous versions
+        :return: list of str, the ids of the templates stored
+        """
+        templates = eq.get_search_templates()
+        for template_id, source in templates.items():
+            self.es.put_template(id=template_id, body={"template": source})
+            log.info("Stored the search template {}".format(template_id))
+        if delete_old:
+            for version in range(1, eq.SEARCH_TEMPLATE_VERSION):
+                for name in (eq.TOP3_TEMPLATE, eq.TOP3_ALIASES_TEMPLATE, eq.AUTOCOMPLETE_TEMPLATE):
+                    for level1_id in ("", "level1_id"):
+                        template_id = eq.get_search_template_id(name, level1_id, version)
+                        self.es.delete_template(id=template_id, ignore=404)
+        return sorted(templates)
 
     def get_batch_unmatched_service(self, country, level1_id, user_id, size=10):
         """
-        Search the child index for the 2nd junior
+        Search the child index for the 2nd junior.
+        The batch is leased in one update_by_query with a token unique to this call, so two matchers
+        can never get the same service: the loser of a race gets a version conflict on that document.
         :param country: str
         :param level1_id: str, "01000"
         :param user_id: int, dont retrieve from this user
@@ -161,27 +443,24 @@ class ElasticServices(object):
         :return: list of dic, containing query, child and parent documents.
         """
         current_time = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-        query_before = (datetime.utcnow() - timedelta(hours=1)).strftime("%Y-%m-%d %H:%M:%S")
-        query = eq.query_get_unmatched_service(user_id=user_id,
-                                               before_time=query_before,
-                                               level1_id=level1_id,
-                                               size=size)
+        if settings.SERVICEMATCHER_IN_TEST_MODE:
+            query_before = (datetime.utcnow() - timedelta(minutes=1)).strftime("%Y-%m-%d %H:%M:%S")
+        else:
+            query_before = (datetime.utcnow() - timedelta(hours=1)).strftime("%Y-%m-%d %H:%M:%S")
+        claim_token = uuid4().hex
+        query = eq.query_claim_unmatched_service(user_id=user_id,
+                                                 before_time=query_before,
+                                                 claim_time=current_time,
+                                                 claim_token=claim_token,
+                                                 level1_id=level1_id)
         index = country_to_index[country]
+        res = self.es.update_by_query(index=index, doc_type=CHILD_DOC_TYPE, body=query, size=size,
+                                      conflicts="proceed", refresh=True)
+        if not res["updated"]:
+            return []
+        query = eq.query_get_claimed_service(claim_token, size=size)
         res = self.es.search(index=index, body=query, doc_type=CHILD_DOC_TYPE)
-        hits = res['hits']['hits']
-        for hit in hits:
-            # idea to improve : use elastic script to update all docs at once
-            # https://www.elastic.co/guide/en/elasticsearch/reference/current/docs-update-by-query.html
-            service_id = hit["_id"]
-            index_element_id = hit["_parent"]
-            update_service = {
-                "doc": {
-                    "last_fetch_date": current_time,
-                },
-                "_source": True
-            }
-            self.es.update(index=index, doc_type=CHILD_DOC_TYPE, id=service_id, body=update_service, routing=index_element_id)
-        hits = [format_service_for_frontend_from_elastic_hit(hit) for hit in hits]
+        hits = [format_service_for_frontend_from_elastic_hit(hit) for hit in res['hits']['hits']]
         return hits
 
     def save_service(self, service, venue, user, country, matched_index_element_id="", unmatched_index_element_ids=(),
@@ -212,6 +491,33 @@ class ElasticServices(object):
             new["check_flag"] = check_flag
             new["last_fetch_date"] = "2011-11-11 11:11:11"  # Random date to not leave emtpy
             self.es.index(index=index, body=new, parent=matched_index_element_id, doc_type=CHILD_DOC_TYPE)
+            self.invalidate_top3_cache(new, matched_index_element_id, country)
+            if MAINTAIN_ALIASES:
+                self.es.update(index=index, doc_type=PARENT_DOC_TYPE, id=matched_index_element_id,
+                               body=eq.query_add_aliases(get_aliases_from_child(new)), retry_on_conflict=3)
+            if self.local_scorer is not None:
+                self.local_scorer.add_match(country, matched_index_element_id,
+                                            [service["description"], service["category"]])
+
+    def invalidate_top3_cache(self, child, index_element_id, country):
+        """
+        A new service child changes the score of its parent for every service sharing a word with its description,
+        category or venue category, in its level1 and in all the level1s (a falsy level1_id).
+        The cache is per process: the other workers keep their entries until the TTL of the cache.
+        :param child: dict, service saved in elastic
+        :param index_element_id: str, its parent, the wizard of the index element
+        :param country: str,
+        """
+        level1_id = index_element_id[:5]
+        words = set()
+        for field in ("product_description", "product_category", "venue_category"):
+            words.update(normalize_search_string(child[field]).split())
+
+        def is_affected(key):
+            if key[0] != country or (key[1] and key[1] != level1_id):
+                return False
+            return any(words.intersection(text.split()) for text in key[2:])
+        self.top3_cache.delete_where(is_affected)
 
     def get_wizard_from_index_element_id(self, index_element_id, country):
         """
@@ -219,10 +525,30 @@ class ElasticServices(object):
         :param country: str,
         :return: str, wizard
         """
+        # the index elements are saved in elastic with their wizard as id
+        index_element = index_elements.get_by_wizard(index_element_id)
+        if index_element is not None:
+            return index_element.wizard
         index = country_to_index[country]
         res = self.es.get(index=index, id=index_element_id)
         return res["_source"]["wizard"]
 
+    def release_service(self, service_id, index_element_id, country):
+        """
+        End the lease of a service claimed by get_batch_unmatched_service, so another matcher can fetch it at once
+        :param service_id: str,
+        :param index_element_id: str, its parent
+        :param country: str,
+        """
+        release = {
+            "doc": {
+                "last_fetch_date": "2011-11-11 11:11:11",
+                "lock_token": "",
+            }
+        }
+        index = country_to_index[country]
+        self.es.update(index=index, doc_type=CHILD_DOC_TYPE, id=service_id, body=release, routing=index_element_id)
+
     def update_1st_match_flag(self, service_id, index_element_id, country):
         """
         :param service_id: str,
@@ -0,0 +1,239 @@
+from __future__ import unicode_literals
+import threading
+import time
+import zlib
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+
+from servicematcher import models
+from servicematcher.autocomplete import tokenize
+from servicematcher.taxonomy import index_elements
+from servicematcher.utils import get_logging
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = sparse = None
+
+log = get_logging(__name__)
+
+# Number of hashed character trigram features, the matrix never grows when new texts come in
+DIMENSION = 2 ** 18
+NGRAM_SIZE = 3
+DESCRIPTION_WEIGHT = 2.
+# Seconds between two updates of the rows of the index elements matched meanwhile
+UPDATE_INTERVAL = getattr(settings, "SERVICEMATCHER_LOCAL_SCORER_UPDATE_INTERVAL", 30)
+
+
+def get_ngram_counts(text, counts=None, weight=1.):
+    """
+    "Cut" -> counts of the hashed trigrams " cu", "cut", "ut "
+    :param text: str,
+    :param counts: dict, feature -> count to add to
+    :param weight: float,
+    :return: dict, feature -> count
+    """
+    if counts is None:
+        counts = defaultdict(float)
+    for word in tokenize(text):
+        word = " {} ".format(word)
+        for i in range(max(1, len(word) - NGRAM_SIZE + 1)):
+            gram = word[i:i + NGRAM_SIZE].encode("utf-8")
+            counts[(zlib.crc32(gram) & 0xffffffff) % DIMENSION] += weight
+    return counts
+
+
+def get_service_counts(data):
+    counts = get_ngram_counts(data["service"]["description"], weight=DESCRIPTION_WEIGHT)
+    get_ngram_counts(data["service"]["category"], counts)
+    get_ngram_counts(data["venue"]["category_name"], counts)
+    return counts
+
+
+def to_matrix(rows, idf=None):
+    """
+    :param rows: list of dict, feature -> count
+    :param idf: numpy array, weight of each feature
+    :return: scipy CSR matrix, one L2 normalized row per dict
+    """
+    row_ids, col_ids, values = [], [], []
+    for i, counts in enumerate(rows):
+        row_ids += [i] * len(counts)
+        col_ids += counts.keys()
+        values += counts.values()
+    matrix = sparse.csr_matrix((values, (row_ids, col_ids)), shape=(len(rows), DIMENSION), dtype=np.float64)
+    if idf is not None:
+        matrix = matrix.multiply(idf).tocsr()
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.
+    return sparse.diags(1. / norms).dot(matrix).tocsr()
+
+
+class ScorerPartition(object):
+    """
+    TF-IDF matrix of the index elements of one (country, level1_id): each row holds the names of the index element
+    and the descriptions and categories of the services matched to it.
+    """
+
+    def __init__(self, wizards, counts):
+        """
+        :param wizards: list of str,
+        :param counts: list of dict, feature -> count of each index element
+        """
+        self.wizards = wizards
+        self.positions = dict((wizard, i) for i, wizard in enumerate(wizards))
+        self.counts = counts
+        document_frequencies = np.zeros(DIMENSION)
+        for row in counts:
+            document_frequencies[list(row.keys())] += 1
+        self.idf = np.log((len(counts) + 1.) / (document_frequencies + 1.)) + 1.
+        self.matrix = to_matrix(counts, self.idf)
+        self.dirty = set()
+        self.last_update = time.time()
+        self.lock = threading.Lock()
+
+    def add_texts(self, wizard, texts):
+        """
+        Count the texts of a new match in the row of its index element, the idf stays the one of the last build
+        """
+        position = self.positions.get(wizard)
+        if position is None:
+            return
+        with self.lock:
+            for text in texts:
+                get_ngram_counts(text, self.counts[position])
+            self.dirty.add(position)
+
+    def update_matrix(self, force=False):
+        """
+        Replace the rows of the index elements matched since the last update, at most every UPDATE_INTERVAL,
+        with sparse products instead of a conversion of the whole matrix per row
+        """
+        if not self.dirty or (not force and time.time() - self.last_update < UPDATE_INTERVAL):
+            return
+        positions = sorted(self.dirty)
+        self.dirty = set()
+        self.last_update = time.time()
+        updated = to_matrix([self.counts[i] for i in positions], self.idf)
+        kept = np.ones(len(self.wizards))
+        kept[positions] = 0.
+        # puts the i-th updated row at positions[i]
+        placement = sparse.csr_matrix((np.ones(len(positions)), (positions, range(len(positions)))),
+                                      shape=(len(self.wizards), len(positions)))
+        self.matrix = (sparse.diags(kept).dot(self.matrix) + placement.dot(updated)).tocsr()
+
+    def top_k(self, datas, k=3):
+        """
+        :param datas: list of dict, services for frontend
+        :param k: int,
+        :return: list of list of (wizard, score), the best index elements of each service
+        """
+        with self.lock:
+            self.update_matrix()
+            matrix = self.matrix
+        queries = to_matrix([get_service_counts(data) for data in datas], self.idf)
+        scores = queries.dot(matrix.T).toarray()
+        k = min(k, len(self.wizards))
+        results = []
+        for row in scores:
+            best = np.argpartition(-row, k - 1)[:k]
+            best = best[np.argsort(-row[best])]
+            results.append([(self.wizards[i], float(row[i])) for i in best if row[i] > 0])
+        return results
+
+
+class LocalScorer(object):
+    """
+    Top3 index elements by cosine similarity of character trigrams, for a whole batch in a few sparse products,
+    instead of the has_child query of elastic.
+    The partition of a (country, level1_id) is built in the background on its first use, elastic answers meanwhile.
+    """
+
+    def __init__(self, level1_ids):
+        if np is None:
+            raise ImproperlyConfigured("numpy and scipy are needed by SERVICEMATCHER_LOCAL_SCORER_LEVEL1_IDS")
+        self.level1_ids = set(level1_ids)
+        self.partitions = {}
+        self.building = set()
+        self.lock = threading.Lock()
+
+    def handles(self, level1_id):
+        return level1_id in self.level1_ids
+
+    def build(self, country, level1_id):
+        start = time.time()
+        index_elements.refresh()
+        elements = [element for element in index_elements.by_wizard.values() if element.level1_id == level1_id]
+        counts = {}
+        for element in elements:
+            row = get_ngram_counts(element.level5, weight=DESCRIPTION_WEIGHT)
+            for level in (element.level2, element.level3, element.level4):
+                get_ngram_counts(level, row)
+            counts[element.wizard] = row
+        matches = models.Match.objects\
+            .filter(match_index__level1_id=level1_id)\
+            .filter(service__search_country=country)\
+            .filter(not_enough_info=False)\
+            .values_list("match_index__wizard", "service__description", "service__category")
+        for wizard, description, category in matches.iterator():
+            if wizard in counts:
+                get_ngram_counts(description, counts[wizard])
+                get_ngram_counts(category, counts[wizard])
+        wizards = sorted(counts)
+        partition = ScorerPartition(wizards, [counts[wizard] for wizard in wizards])
+        log.info("Built the local scorer of {} {} with {} index elements in {}ms".format(
+            country, level1_id, len(wizards), int((time.time() - start) * 1000)))
+        return partition
+
+    def build_in_background(self, key):
+        try:
+            partition = self.build(*key)
+            with self.lock:
+                self.partitions[key] = partition
+        except Exception:
+            log.exception("Could not build the local scorer of {} {}".format(*key))
+        finally:
+            with self.lock:
+                self.building.discard(key)
+            connection.close()
+
+    def get_partition(self, country, level1_id):
+        """
+        :return: ScorerPartition or None, None while it is built
+        """
+        key = (country, level1_id)
+        partition = self.partitions.get(key)
+        if partition is not None:
+            return partition
+        with self.lock:
+            if key in self.partitions or key in self.building:
+                return self.partitions.get(key)
+            self.building.add(key)
+        thread = threading.Thread(target=self.build_in_background, args=(key,), name="servicematcher-local-scorer")
+        thread.daemon = True
+        thread.start()
+        return None
+
+    def top_k(self, datas, level1_id, country, k=3):
+        """
+        :return: list of list of (wizard, score), in the same order as datas, or None while the partition is built
+        """
+        partition = self.get_partition(country, level1_id)
+        if partition is None:
+            return None
+        return partition.top_k(datas, k)
+
+    def add_match(self, country, wizard, texts):
+        """
+        Learn the texts of a new match, when its partition is already built
+        :param country: str,
+        :param wizard: str, the index element matched
+        :param texts: list of str, description and categories of the service
+        """
+        partition = self.partitions.get((country, wizard[:5]))
+        if partition is not None:
+            partition.add_texts(wizard, texts)
@@ -0,0 +1,102 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.runner import DiscoverRunner
+
+from servicematcher.benchmarks.fakes import WAREHOUSE_TIME_LIMIT
+from servicematcher.benchmarks.matcher import Benchmark, StressTest, compare_to_baseline
+
+
+class Command(BaseCommand):
+    help = "Run fetch/search/submit workloads of concurrent matchers against a fake warehouse and elastic, " \
+           "in a test database, and report the latencies, queries and outbound calls of every endpoint"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--matchers", type=int, default=4, help="Matchers working at the same time")
+        parser.add_argument("--batches", type=int, default=5, help="Batches fetched by each matcher")
+        parser.add_argument("--batch-size", type=int, default=10)
+        parser.add_argument("--services", type=int, default=500, help="Unmatched services in the warehouse")
+        parser.add_argument("--second-matches", type=int, default=100,
+                            help="Services in SQL waiting for their 2nd match")
+        parser.add_argument("--search-rate", type=float, default=0.3, help="Share of services searched for")
+        parser.add_argument("--elastic-latency", type=float, default=0., help="Seconds added to every elastic call")
+        parser.add_argument("--warehouse-latency", type=float, default=0.,
+                            help="Seconds added to every warehouse call")
+        parser.add_argument("--lease-length", type=float, default=WAREHOUSE_TIME_LIMIT,
+                            help="Seconds of the warehouse leases")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--stress", action="store_true",
+                            help="Run the matchers for --duration seconds and report the claims and leases")
+        parser.add_argument("--duration", type=float, default=60)
+        parser.add_argument("--think-time", type=float, default=0.5, help="Average seconds spent on a service")
+        parser.add_argument("--abandon-rate", type=float, default=0.05,
+                            help="Chance that a matcher leaves the rest of its batch")
+        parser.add_argument("--max-duplicate-rate", type=float, default=0.,
+                            help="Fail the stress test above that share of services claimed twice at once")
+        parser.add_argument("--output", help="Write the report to that file, e.g. to use it as the next baseline")
+        parser.add_argument("--baseline", help="Report of a previous run to compare with")
+        parser.add_argument("--tolerance", type=float, default=0.2, help="Relative slowdown allowed")
+        parser.add_argument("--keepdb", action="store_true", help="Keep the test database between runs")
+
+    def handle(self, *args, **options):
+        kwargs = dict(
+            matchers=options["matchers"],
+            batches=options["batches"],
+            batch_size=options["batch_size"],
+            services=options["services"],
+            second_matches=options["second_matches"],
+            search_rate=options["search_rate"],
+            elastic_latency=options["elastic_latency"],
+            warehouse_latency=options["warehouse_latency"],
+            lease_length=options["lease_length"],
+            seed=options["seed"],
+        )
+        if options["stress"]:
+            benchmark = StressTest(duration=options["duration"], think_time=options["think_time"],
+                                   abandon_rate=options["abandon_rate"], **kwargs)
+        else:
+            benchmark = Benchmark(**kwargs)
+        report = self.run(benchmark, options["keepdb"])
+        self.write_report(report)
+        if "leases" in report:
+            self.write_leases(report["leases"])
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+        if options["baseline"]:
+            with open(options["baseline"]) as f:
+                regressions = compare_to_baseline(report, json.load(f), options["tolerance"])
+            if regressions:
+                raise CommandError("Slower than {}:\n{}".format(options["baseline"], "\n".join(regressions)))
+            self.stdout.write("No regression compared to {}".format(options["baseline"]))
+        if "leases" in report and report["leases"]["duplicate_claim_rate"] > options["max_duplicate_rate"]:
+            raise CommandError("{duplicate_claims} services were claimed by 2 matchers at once".format(**report["leases"]))
+
+    def run(self, benchmark, keepdb):
+        runner = DiscoverRunner(interactive=False, keepdb=keepdb, verbosity=0)
+        old_config = runner.setup_databases()
+        try:
+            return benchmark.run()
+        finally:
+            runner.teardown_databases(old_config)
+
+    def write_report(self, report):
+        self.stdout.write("{:<16}{:>10}{:>8}{:>10}{:>10}{:>10}{:>10}".format(
+            "endpoint", "requests", "errors", "p50 ms", "p95 ms", "p99 ms", "queries"))
+        for endpoint, stats in sorted(report["endpoints"].items()):
+            self.stdout.write("{:<16}{requests:>10}{errors:>8}{p50_ms:>10.1f}{p95_ms:>10.1f}{p99_ms:>10.1f}"
+                              "{queries_per_request:>10.1f}".format(endpoint, **stats))
+        self.stdout.write("{submits_per_second:.1f} submits/s, {outbound_calls_per_request:.2f} outbound calls "
+                          "per request".format(**report))
+        self.stdout.write("warehouse calls: {}".format(report["warehouse_calls"]))
+        self.stdout.write("elastic calls: {}".format(report["elastic_calls"]))
+
+    def write_leases(self, leases):
+        self.stdout.write("{claims} claims, {claims_per_second:.1f} claims/s, "
+                          "{duplicate_claims} duplicate claims ({duplicate_claim_rate:.2%})".format(**leases))
+        self.stdout.write("{expired_leases} leases expired before the submit ({expired_lease_rate:.2%}), "
+                          "{abandoned_leases} abandoned ({wasted_lease_rate:.2%} wasted), {warehouse_leases} "
+                          "warehouse leases, {mean_batch_size:.1f} services per batch".format(**leases))
+        self.stdout.write("{double_matched} services matched twice, wait between the matches: "
+                          "p50 {second_match_wait_p50_s:.1f}s, p95 {second_match_wait_p95_s:.1f}s, "
+                          "max {second_match_wait_max_s:.1f}s".format(**leases))
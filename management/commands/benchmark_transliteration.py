@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from servicematcher.benchmarks.transliteration import benchmark_transliteration
+
+
+class Command(BaseCommand):
+    help = "Compare the time spent transliterating the warehouse batches with unidecode and with the cached " \
+           "utils.transliterate"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batches", type=int, default=1000)
+        parser.add_argument("--batch-size", type=int, default=10)
+        parser.add_argument("--venues", type=int, default=200, help="Distinct venues in the city")
+        parser.add_argument("--accented-rate", type=float, default=0.2,
+                            help="Share of the venue names and descriptions with accents")
+
+    def handle(self, *args, **options):
+        report = benchmark_transliteration(batches=options["batches"], batch_size=options["batch_size"],
+                                           venues=options["venues"], accented_rate=options["accented_rate"])
+        self.stdout.write("unidecode: {unidecode_us_per_batch:.0f}us per batch of {batch_size}, "
+                          "transliterate: {transliterate_us_per_batch:.0f}us, "
+                          "saving: {saving_us_per_batch:.0f}us".format(**report))
+        self.stdout.write("cache: {}".format(report["cache"]))
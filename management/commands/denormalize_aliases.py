@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+
+from servicematcher import models
+from servicematcher.elastic_api import ElasticServices
+from servicematcher.mappings import level1_to_level1_id
+
+
+def percentile(values, ratio):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))] if values else 0
+
+
+class Command(BaseCommand):
+    help = "Copy the texts of the service children on the alias fields of their index element, " \
+           "needed before setting SERVICEMATCHER_TOP3_QUERY to 'aliases'"
+
+    def add_arguments(self, parser):
+        parser.add_argument("country")
+        parser.add_argument("--skip-denormalize", action="store_true", help="Only run the comparison")
+        parser.add_argument("--compare", type=int, default=0,
+                            help="Compare the latency of both top3 queries on that many matched services")
+        parser.add_argument("--level1", default="Hair & Beauty", help="Level1 of the services compared")
+
+    def handle(self, *args, **options):
+        es = ElasticServices()
+        if not options["skip_denormalize"]:
+            updated = es.denormalize_aliases(options["country"])
+            self.stdout.write("Denormalized the aliases of {} index elements".format(updated))
+        if options["compare"]:
+            level1_id = level1_to_level1_id[options["level1"]]
+            services = models.Service.objects\
+                .select_related("venue")\
+                .filter(search_country=options["country"])\
+                .filter(search_level1_id=level1_id)\
+                .order_by("-id")[:options["compare"]]
+            datas = [
+                {
+                    "service": {"description": service.description, "category": service.category},
+                    "venue": {"category_name": service.venue.category_name},
+                }
+                for service in services
+            ]
+            report = es.compare_top3_queries(datas, level1_id, options["country"])
+            for query_type in ("has_child", "aliases"):
+                tooks = report[query_type]
+                self.stdout.write("{}: avg {:.1f}ms p50 {}ms p95 {}ms over {} queries".format(
+                    query_type, sum(tooks) / float(max(len(tooks), 1)), percentile(tooks, 0.5),
+                    percentile(tooks, 0.95), len(tooks)))
+            self.stdout.write("Same top3 for {:.0%} of the services".format(report["same_top3_ratio"]))
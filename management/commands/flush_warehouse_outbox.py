@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from servicematcher.outbox import OutboxFlusher, get_backlog
+from servicematcher.warehouse_api import WarehouseServiceMatcherAPI
+
+
+class Command(BaseCommand):
+    help = "Send the pending warehouse writes of /matcher/submit, until the backlog is empty or only retries are left"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100)
+
+    def handle(self, *args, **options):
+        flusher = OutboxFlusher(WarehouseServiceMatcherAPI(), batch_size=options["batch_size"])
+        total = 0
+        while True:
+            sent = flusher.flush()
+            total += sent
+            if sent < options["batch_size"]:
+                break
+        self.stdout.write("Sent {} warehouse writes, backlog: {}".format(total, get_backlog()))
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+
+from servicematcher.elastic_api import ElasticServices
+from servicematcher.mappings import level1_to_level1_id
+from servicematcher.prematch import PREMATCH_TIME_LIMIT, PrematchPipeline
+from servicematcher.warehouse_api import WarehouseServiceMatcherAPI
+
+
+class Command(BaseCommand):
+    help = "Compute the top3 of the unmatched services of a city and level1 ahead of matching, " \
+           "run it again to resume an interrupted run"
+
+    def add_arguments(self, parser):
+        parser.add_argument("country")
+        parser.add_argument("city")
+        parser.add_argument("level1", help="Name of the level1, e.g. 'Hair & Beauty'")
+        parser.add_argument("--limit", type=int, default=None, help="Maximum number of services to compute")
+        parser.add_argument("--page-size", type=int, default=100, help="Services fetched per warehouse request")
+        parser.add_argument("--chunk-size", type=int, default=20, help="Top3 queries per msearch")
+        parser.add_argument("--concurrency", type=int, default=4, help="msearch sent at the same time")
+        parser.add_argument("--time-limit", type=int, default=PREMATCH_TIME_LIMIT,
+                            help="Seconds the fetched services stay leased in the warehouse")
+
+    def handle(self, *args, **options):
+        pipeline = PrematchPipeline(
+            ElasticServices(),
+            WarehouseServiceMatcherAPI(),
+            options["country"],
+            options["city"],
+            level1_to_level1_id[options["level1"]],
+            page_size=options["page_size"],
+            chunk_size=options["chunk_size"],
+            concurrency=options["concurrency"],
+            time_limit=options["time_limit"],
+        )
+        report = pipeline.run(limit=options["limit"])
+        self.stdout.write("Computed {computed} of {fetched} services fetched in {seconds:.1f}s: "
+                          "{services_per_second:.1f} services/s".format(**report))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from servicematcher.elastic_api import ElasticServices
+from servicematcher.queries import SEARCH_TEMPLATE_VERSION
+
+
+class Command(BaseCommand):
+    help = "Store the top3 and autocomplete queries as elasticsearch search templates, needed before turning on " \
+           "SERVICEMATCHER_USE_SEARCH_TEMPLATES"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--delete-old", action="store_true", help="Delete the templates of the previous versions")
+
+    def handle(self, *args, **options):
+        template_ids = ElasticServices().register_search_templates(delete_old=options["delete_old"])
+        self.stdout.write("Stored version {} of the search templates: {}".format(
+            SEARCH_TEMPLATE_VERSION, ", ".join(template_ids)))
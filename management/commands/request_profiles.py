@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from servicematcher.profiling import PROFILES_DIR, list_profiles, load_profile
+
+
+class Command(BaseCommand):
+    help = "List the profiles of the requests recorded with SERVICEMATCHER_PROFILING or print one of them"
+
+    def add_arguments(self, parser):
+        parser.add_argument("profile", nargs="?", help="file name of the profile, the latest one with --latest")
+        parser.add_argument("--latest", action="store_true")
+        parser.add_argument("--queries", action="store_true", help="also print the SQL queries")
+
+    def handle(self, *args, **options):
+        if PROFILES_DIR is None:
+            raise CommandError("SERVICEMATCHER_PROFILING_DIR is not set")
+        filenames = list_profiles()
+        filename = options["profile"] or (filenames[0] if options["latest"] and filenames else None)
+        if filename is None:
+            for filename in filenames:
+                profile = load_profile(filename)
+                self.stdout.write("{}  {}ms  {} queries".format(filename, profile["total_ms"], profile["query_count"]))
+            return
+        if filename not in filenames:
+            raise CommandError("No profile {}".format(filename))
+        profile = load_profile(filename)
+        self.stdout.write("{endpoint} by user {user_id}: {total_ms}ms, {query_count} queries".format(**profile))
+        self.stdout.write("\nCall tree:")
+        self.write_tree(profile["call_tree"])
+        self.stdout.write("\nTop functions by own time:")
+        for row in profile["top_functions"]:
+            self.stdout.write("{own_ms:>8}ms {cumulative_ms:>8}ms {calls:>8}  {function}".format(**row))
+        if options["queries"]:
+            self.stdout.write("\nQueries:")
+            for query in profile["queries"]:
+                self.stdout.write("{:>8}s  {}".format(query["time"], query["sql"]))
+
+    def write_tree(self, node, depth=0):
+        if node is None:
+            return
+        self.stdout.write("{}{}ms {}x {}".format("  " * depth, node["cumulative_ms"], node["calls"], node["function"]))
+        for child in node.get("children", []):
+            self.write_tree(child, depth + 1)
@@ -0,0 +1,189 @@
+from __future__ import unicode_literals
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.utils.crypto import constant_time_compare
+from rest_framework.exceptions import APIException
+from rest_framework.permissions import BasePermission
+
+from servicematcher.utils import get_logging
+
+log = get_logging(__name__)
+
+# time.monotonic does not exist on python 2, time.time is the best we have there
+clock = getattr(time, "monotonic", time.time)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60.)
+REQUEST_TAGS = ("endpoint", "country", "level1_id")
+# The country tag is sent by the client, the ones without an index are tagged "other" so they add no series
+COUNTRIES = frozenset(getattr(settings, "SERVICEMATCHER_COUNTRY_TO_INDEX", {}))
+# Sent by Prometheus as "Authorization: Bearer <token>", without it only the staff users can read the metrics
+METRICS_TOKEN = getattr(settings, "SERVICEMATCHER_METRICS_TOKEN", "")
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+                break
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, str(value).replace('"', '\\"')) for key, value in labels) + "}"
+
+
+class Registry(object):
+    """
+    Latency histograms and counters, aggregated in memory and rendered in the Prometheus text format.
+    Recording is a dict lookup and a few additions under a lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.collectors = []
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def register_collector(self, name, collect):
+        """
+        :param name: str, name of the gauge
+        :param collect: function, returning a dict of the stats of a component, called on each scrape
+        """
+        self.collectors.append((name, collect))
+
+    def render(self):
+        """
+        :return: str, every metric in the Prometheus text format
+        """
+        lines = []
+        with self.lock:
+            histograms = sorted((key, histogram.buckets[:], histogram.count, histogram.sum)
+                                for key, histogram in self.histograms.items())
+            counters = sorted(self.counters.items())
+        for (name, labels), buckets, count, total in histograms:
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, buckets):
+                cumulative += bucket
+                lines.append("{}_bucket{} {}".format(name, format_labels(labels + (("le", bound),)), cumulative))
+            lines.append("{}_bucket{} {}".format(name, format_labels(labels + (("le", "+Inf"),)), count))
+            lines.append("{}_sum{} {}".format(name, format_labels(labels), total))
+            lines.append("{}_count{} {}".format(name, format_labels(labels), count))
+        for (name, labels), value in counters:
+            lines.append("{}{} {}".format(name, format_labels(labels), value))
+        for name, collect in self.collectors:
+            try:
+                stats = collect()
+            except Exception:
+                log.exception("Could not collect the {} metrics".format(name))
+                continue
+            for stat, value in sorted(stats.items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append("{}{} {}".format(name, format_labels((("stat", stat),)), value))
+        return "\n".join(lines) + "\n"
+
+
+class CanReadMetrics(BasePermission):
+    """
+    The staff users, and the scraper sending SERVICEMATCHER_METRICS_TOKEN
+    """
+
+    def has_permission(self, request, view):
+        if request.user and request.user.is_staff:
+            return True
+        authorization = request.META.get("HTTP_AUTHORIZATION", "")
+        return bool(METRICS_TOKEN) and constant_time_compare(authorization, "Bearer {}".format(METRICS_TOKEN))
+
+
+registry = Registry()
+request_tags = threading.local()
+
+
+def get_request_tags():
+    return dict((tag, getattr(request_tags, tag, "")) for tag in REQUEST_TAGS)
+
+
+def set_request_tags(**tags):
+    """
+    Tag the spans of the current request, e.g. with its country and level1_id once the payload is validated
+    """
+    if tags.get("country") and tags["country"] not in COUNTRIES:
+        tags["country"] = "other"
+    for tag, value in tags.items():
+        setattr(request_tags, tag, value)
+
+
+class Span(object):
+
+    def __init__(self):
+        self.start = clock()
+        self.seconds = None
+
+    @property
+    def ms(self):
+        seconds = self.seconds if self.seconds is not None else clock() - self.start
+        return int(seconds * 1000)
+
+
+@contextmanager
+def span(dependency):
+    """
+    Time a call to a dependency ("sql", "warehouse" or "elastic") of the current request
+    """
+    current = Span()
+    try:
+        yield current
+    finally:
+        current.seconds = clock() - current.start
+        registry.observe("servicematcher_dependency_seconds", current.seconds, dependency=dependency,
+                         **get_request_tags())
+
+
+def timed_handler(endpoint):
+    """
+    Decorate the handler of an APIView to record its total time and its responses by status code
+    """
+    def decorator(handler):
+        @wraps(handler)
+        def wrapper(view, request, *args, **kwargs):
+            set_request_tags(endpoint=endpoint, country="", level1_id="")
+            start = clock()
+            status = 500
+            try:
+                response = handler(view, request, *args, **kwargs)
+                status = response.status_code
+                return response
+            except APIException as e:
+                status = e.status_code
+                raise
+            finally:
+                tags = get_request_tags()
+                registry.observe("servicematcher_request_seconds", clock() - start, **tags)
+                registry.increment("servicematcher_requests_total", status=status, **tags)
+        return wrapper
+    return decorator
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    """
+    The tables as they were before the app had migrations, existing databases only record it with
+    ./manage.py migrate servicematcher --fake-initial
+    """
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IndexElement',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('wizard', models.CharField(max_length=29, unique=True)),
+                ('level1_id', models.CharField(max_length=5)),
+                ('level1', models.CharField(max_length=50)),
+                ('level2', models.CharField(max_length=100)),
+                ('level3', models.CharField(max_length=100)),
+                ('level4', models.CharField(max_length=100)),
+                ('level5', models.CharField(max_length=100)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Venue',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('category_name', models.CharField(max_length=100)),
+                ('category_id', models.CharField(max_length=4)),
+                ('wh_key', models.CharField(max_length=200, unique=True)),
+                ('is_chain', models.IntegerField(null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Service',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('description', models.CharField(max_length=200)),
+                ('category', models.CharField(max_length=200)),
+                ('wh_key', models.CharField(max_length=200, unique=True)),
+                ('search_level1_id', models.CharField(max_length=5)),
+                ('search_level1', models.CharField(max_length=50)),
+                ('search_city', models.CharField(max_length=50)),
+                ('search_country', models.CharField(max_length=50)),
+                ('waiting_2nd_match', models.BooleanField(default=True)),
+                ('last_fetch_date', models.DateTimeField(default='2011-11-11 11:11:11')),
+                ('venue', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='servicematcher.Venue')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SessionMetric',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_time', models.DateTimeField(auto_now_add=True)),
+                ('end_time', models.DateTimeField(auto_now_add=True)),
+                ('match_counter', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ServiceMatcherProfile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('general_counter', models.IntegerField(default=0)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Match',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_time', models.DateTimeField(auto_now_add=True)),
+                ('not_enough_info', models.BooleanField(default=False)),
+                ('used_search', models.BooleanField(default=False)),
+                ('search_string', models.CharField(blank=True, default='', max_length=200)),
+                ('time_spent', models.IntegerField()),
+                ('match_backend_version', models.IntegerField()),
+                ('match_index', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='servicematcher.IndexElement')),
+                ('negative_index', models.ManyToManyField(related_name='negative_match', to='servicematcher.IndexElement')),
+                ('service', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='servicematcher.Service')),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='servicematcher.SessionMetric')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
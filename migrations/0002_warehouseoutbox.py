@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servicematcher', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WarehouseOutbox',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('save_data', 'Save datasource'), ('lock_service', 'Lock service')], max_length=20)),
+                ('service_key', models.CharField(db_index=True, max_length=200)),
+                ('datasource', models.TextField(blank=True, default='')),
+                ('created_time', models.DateTimeField(auto_now_add=True)),
+                ('sent_time', models.DateTimeField(db_index=True, null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt_time', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.CharField(blank=True, default='', max_length=200)),
+                ('claim_token', models.CharField(blank=True, db_index=True, default='', max_length=32)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """
+    The existing index elements get the time of the migration as updated_time (auto_now), so they are all
+    loaded by the first refresh of taxonomy.IndexElementCache, like on any start; nothing else to backfill
+    """
+
+    dependencies = [
+        ('servicematcher', '0002_warehouseoutbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='indexelement',
+            name='updated_time',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servicematcher', '0003_indexelement_updated_time'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ServiceCandidates',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('service_key', models.CharField(max_length=200, unique=True)),
+                ('search_country', models.CharField(max_length=50)),
+                ('search_city', models.CharField(max_length=50)),
+                ('search_level1_id', models.CharField(max_length=5)),
+                ('index_elements', models.TextField()),
+                ('computed_time', models.DateTimeField(auto_now=True, db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servicematcher', '0004_servicecandidates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='warehouseoutbox',
+            name='dead',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+    ]
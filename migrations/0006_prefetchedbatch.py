@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('servicematcher', '0005_warehouseoutbox_dead'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PrefetchedBatch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=32)),
+                ('search_data', models.TextField()),
+                ('level1_id', models.CharField(max_length=5)),
+                ('batch_size', models.IntegerField()),
+                ('requested_at', models.BigIntegerField()),
+                ('service_keys', models.TextField()),
+                ('submitted', models.IntegerField(default=0)),
+                ('state', models.CharField(blank=True, choices=[('preparing', 'Preparing'), ('prepared', 'Prepared')], default='', max_length=10)),
+                ('prepared', models.TextField(blank=True, default='')),
+                ('state_time', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_activity', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -22,6 +22,7 @@ class IndexElement(models.Model):
     level3 = models.CharField(max_length=100)
     level4 = models.CharField(max_length=100)
     level5 = models.CharField(max_length=100)
+    updated_time = models.DateTimeField(auto_now=True, db_index=True)
 
 
 class Venue(models.Model):
@@ -43,6 +44,8 @@ class Service(models.Model):
     search_country = models.CharField(max_length=50)
     waiting_2nd_match = models.BooleanField(default=True)
     last_fetch_date = models.DateTimeField(default="2011-11-11 11:11:11")
+    # set by the claim that leased the service last, without SELECT ... SKIP LOCKED
+    claim_token = models.CharField(blank=True, default="", max_length=32)
 
 
 class SessionMetric(models.Model):
@@ -70,3 +73,66 @@ class Match(models.Model):
     time_spent = models.IntegerField()
     match_backend_version = models.IntegerField()
 
+
+
+class WarehouseOutbox(models.Model):
+    """
+    Warehouse write recorded with the match, sent later by outbox.OutboxFlusher
+    """
+    SAVE_DATA = "save_data"
+    LOCK_SERVICE = "lock_service"
+    KIND_CHOICES = (
+        (SAVE_DATA, "Save datasource"),
+        (LOCK_SERVICE, "Lock service"),
+    )
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    service_key = models.CharField(max_length=200, db_index=True)
+    datasource = models.TextField(blank=True, default="")
+    created_time = models.DateTimeField(auto_now_add=True)
+    sent_time = models.DateTimeField(null=True, db_index=True)
+    attempts = models.IntegerField(default=0)
+    next_attempt_time = models.DateTimeField(default=timezone.now)
+    last_error = models.CharField(blank=True, default="", max_length=200)
+    # set by the flush that claimed the entry, next_attempt_time is then the end of its claim
+    claim_token = models.CharField(blank=True, default="", max_length=32, db_index=True)
+    # failed MAX_ATTEMPTS times, not sent anymore
+    dead = models.BooleanField(default=False, db_index=True)
+
+
+class ServiceCandidates(models.Model):
+    """
+    Top3 index elements of a warehouse service computed ahead of matching by prematch_services
+    """
+    service_key = models.CharField(max_length=200, unique=True)
+    search_country = models.CharField(max_length=50)
+    search_city = models.CharField(max_length=50)
+    search_level1_id = models.CharField(max_length=5)
+    index_elements = models.TextField()
+    computed_time = models.DateTimeField(auto_now=True, db_index=True)
+
+
+class PrefetchedBatch(models.Model):
+    """
+    The batch a matcher works on and the next one prepared for them by prefetch.BatchPrefetcher, kept in SQL so
+    every process counts the submits and serves the prepared batch
+    """
+    PREPARING = "preparing"
+    PREPARED = "prepared"
+    STATE_CHOICES = (
+        (PREPARING, "Preparing"),
+        (PREPARED, "Prepared"),
+    )
+    user = models.OneToOneField(Profile)
+    # new for every batch served, a batch prepared for a previous one is released instead of saved
+    token = models.CharField(max_length=32)
+    search_data = models.TextField()
+    level1_id = models.CharField(max_length=5)
+    # the batch_size sent by the frontend
+    batch_size = models.IntegerField()
+    requested_at = models.BigIntegerField()
+    service_keys = models.TextField()
+    submitted = models.IntegerField(default=0)
+    state = models.CharField(blank=True, default="", max_length=10, choices=STATE_CHOICES)
+    prepared = models.TextField(blank=True, default="")
+    state_time = models.DateTimeField(default=timezone.now)
+    last_activity = models.DateTimeField(default=timezone.now, db_index=True)
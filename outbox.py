@@ -0,0 +1,192 @@
+from __future__ import unicode_literals
+import json
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Min
+from django.utils import timezone
+
+from servicematcher import models
+from servicematcher.warehouse_api import get_submit_datasource
+from servicematcher.utils import get_logging
+
+log = get_logging(__name__)
+
+BATCH_SIZE = getattr(settings, "SERVICEMATCHER_OUTBOX_BATCH_SIZE", 100)
+FLUSH_INTERVAL = getattr(settings, "SERVICEMATCHER_OUTBOX_FLUSH_INTERVAL", 2)
+MAX_BACKOFF = getattr(settings, "SERVICEMATCHER_OUTBOX_MAX_BACKOFF", 600)
+# Failed attempts after which an entry is dead: it is not sent anymore and does not hold back its service
+MAX_ATTEMPTS = getattr(settings, "SERVICEMATCHER_OUTBOX_MAX_ATTEMPTS", 10)
+# Seconds before the entries claimed by a flush that did not finish can be claimed again
+CLAIM_TIMEOUT = 300
+
+
+def enqueue_submit(not_enough_info, service_key, venue_key, wizard, venue_category_id, user_email,
+                   previous_match_wizard):
+    """
+    Record what submit_to_warehouse would send, to be called in the transaction saving the match
+    """
+    datasource = get_submit_datasource(not_enough_info, service_key, venue_key, wizard, venue_category_id,
+                                       user_email, previous_match_wizard)
+    if datasource is None:
+        # 1st matcher - lock service in warehouse
+        models.WarehouseOutbox.objects.create(kind=models.WarehouseOutbox.LOCK_SERVICE, service_key=service_key)
+    else:
+        models.WarehouseOutbox.objects.create(
+            kind=models.WarehouseOutbox.SAVE_DATA,
+            service_key=service_key,
+            datasource=json.dumps(datasource),
+        )
+
+
+def get_backlog():
+    """
+    :return: dict, number of entries not sent yet, age in seconds of the oldest one and number of dead entries
+    """
+    unsent = models.WarehouseOutbox.objects.filter(sent_time__isnull=True)
+    pending = unsent.filter(dead=False)
+    oldest = pending.order_by("id").values_list("created_time", flat=True).first()
+    return {
+        "count": pending.count(),
+        "oldest_age": (timezone.now() - oldest).total_seconds() if oldest else 0,
+        "dead": unsent.filter(dead=True).count(),
+    }
+
+
+class OutboxFlusher(object):
+    """
+    Send the pending warehouse writes: all the datasources of a flush in one PUT, one by one if it fails,
+    and the locks together.
+    The entries of a service are sent in the order they were recorded, a failed one holds back the next ones
+    until it is dead after MAX_ATTEMPTS.
+    The entries are claimed before being sent, so the flushers of every process and flush_warehouse_outbox
+    can run at the same time without sending an entry twice.
+    """
+
+    def __init__(self, wh, batch_size=BATCH_SIZE):
+        self.wh = wh
+        self.batch_size = batch_size
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def claim_entries(self):
+        """
+        :return: list of WarehouseOutbox, the ready entries this flush claimed, in the order they were recorded
+        """
+        now = timezone.now()
+        unsent = models.WarehouseOutbox.objects.filter(sent_time__isnull=True, dead=False)
+        ready = list(unsent.filter(next_attempt_time__lte=now).order_by("id")[:self.batch_size * 5])
+        # the oldest entry waiting for a retry or claimed by another flush, of every service
+        waiting_ids = dict(unsent
+                           .filter(service_key__in=set(entry.service_key for entry in ready))
+                           .filter(next_attempt_time__gt=now)
+                           .values("service_key")
+                           .annotate(first_id=Min("id"))
+                           .values_list("service_key", "first_id"))
+        seen_keys = set()
+        entries = []
+        for entry in ready:
+            if entry.service_key in seen_keys or waiting_ids.get(entry.service_key, entry.id) < entry.id:
+                # an older entry of this service is not sent yet
+                continue
+            seen_keys.add(entry.service_key)
+            entries.append(entry)
+            if len(entries) >= self.batch_size:
+                break
+        if not entries:
+            return []
+        # compare-and-set: an entry claimed by another flush meanwhile has a next_attempt_time in the future
+        token = uuid.uuid4().hex
+        models.WarehouseOutbox.objects\
+            .filter(pk__in=[entry.pk for entry in entries])\
+            .filter(sent_time__isnull=True, dead=False)\
+            .filter(next_attempt_time__lte=now)\
+            .update(claim_token=token, next_attempt_time=now + timedelta(seconds=CLAIM_TIMEOUT))
+        return list(models.WarehouseOutbox.objects.filter(claim_token=token).order_by("id"))
+
+    def flush(self):
+        """
+        :return: int, number of entries sent
+        """
+        entries = self.claim_entries()
+        if not entries:
+            return 0
+        datasource_entries = [entry for entry in entries if entry.kind == models.WarehouseOutbox.SAVE_DATA]
+        lock_entries = [entry for entry in entries if entry.kind == models.WarehouseOutbox.LOCK_SERVICE]
+        sent, failed = [], []
+        if datasource_entries:
+            error = self.save_datasources(datasource_entries)
+            if error and len(datasource_entries) > 1:
+                # a datasource rejected by the warehouse must not fail the others
+                log.warning("Sending {} datasources failed, sending them one by one".format(len(datasource_entries)))
+                for entry in datasource_entries:
+                    entry_error = self.save_datasources([entry])
+                    if entry_error:
+                        failed.append((entry, entry_error))
+                    else:
+                        sent.append(entry)
+            elif error:
+                failed += [(entry, error) for entry in datasource_entries]
+            else:
+                sent += datasource_entries
+        if lock_entries:
+            try:
+                locked_keys = set(self.wh.lock_services_matched([entry.service_key for entry in lock_entries]))
+                error = "Lock returned an error"
+            except Exception as e:
+                locked_keys, error = set(), repr(e)
+            for entry in lock_entries:
+                if entry.service_key in locked_keys:
+                    sent.append(entry)
+                else:
+                    failed.append((entry, error))
+        now = timezone.now()
+        models.WarehouseOutbox.objects.filter(pk__in=[entry.pk for entry in sent]).update(sent_time=now)
+        dead = 0
+        for entry, error in failed:
+            entry.attempts += 1
+            entry.next_attempt_time = now + timedelta(seconds=min(2 ** entry.attempts, MAX_BACKOFF))
+            entry.last_error = error[:200]
+            entry.dead = entry.attempts >= MAX_ATTEMPTS
+            dead += entry.dead
+            entry.save(update_fields=["attempts", "next_attempt_time", "last_error", "dead"])
+        if failed:
+            log.warning("{} warehouse writes failed and will be retried".format(len(failed) - dead))
+        if dead:
+            log.error("{} warehouse writes failed {} times and will not be retried".format(dead, MAX_ATTEMPTS))
+        log.info("Sent {} warehouse writes, backlog: {}".format(len(sent), get_backlog()))
+        return len(sent)
+
+    def save_datasources(self, entries):
+        """
+        :param entries: list of WarehouseOutbox, SAVE_DATA entries
+        :return: str, the error, empty if the datasources were saved
+        """
+        try:
+            ok = self.wh.save_datasources([json.loads(entry.datasource) for entry in entries])
+        except Exception as e:
+            return repr(e)
+        return "" if ok else "Upload returned an error code"
+
+    def start(self):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, name="servicematcher-outbox")
+                    self.thread.daemon = True
+                    self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            try:
+                while self.flush() >= self.batch_size:
+                    pass
+            except Exception:
+                log.exception("Flushing the warehouse outbox failed")
+            finally:
+                connection.close()
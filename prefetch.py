@@ -0,0 +1,271 @@
+from __future__ import unicode_literals
+import json
+import math
+import threading
+import time
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from servicematcher import models
+from servicematcher.metrics import set_request_tags
+from servicematcher.utils import get_logging
+
+log = get_logging(__name__)
+
+# Start preparing the next batch once that share of the current one is submitted
+PREFETCH_AFTER = getattr(settings, "SERVICEMATCHER_PREFETCH_AFTER", 0.5)
+# A prepared batch is released when its matcher did nothing for that long
+IDLE_TIME = getattr(settings, "SERVICEMATCHER_PREFETCH_IDLE_TIME", 600)
+# How long fetch_batch waits for a batch still being prepared
+WAIT_TIME = getattr(settings, "SERVICEMATCHER_PREFETCH_WAIT_TIME", 5)
+WORKERS = getattr(settings, "SERVICEMATCHER_PREFETCH_WORKERS", 4)
+POLL_INTERVAL = 30
+# Seconds between two reads of a batch still being prepared, by fetch_batch
+WAIT_POLL_INTERVAL = 0.2
+NEVER_FETCHED = models.Service._meta.get_field("last_fetch_date").default
+
+
+def release_leases(es, spare_queues, search_data, datas):
+    """
+    Give back the services of a batch nobody will match: the SQL and elastic ones can be fetched again at once,
+    the warehouse has no way to release a lease so its services wait in the spare queues for another matcher
+    :param es: ElasticServices,
+    :param spare_queues: ReadyQueues,
+    :param search_data: dict,
+    :param datas: list of dict, services for frontend
+    """
+    sql_ids = [data["service"]["sql_id"] for data in datas if data["origin"] == "sql"]
+    if sql_ids:
+        models.Service.objects.filter(pk__in=sql_ids).update(last_fetch_date=NEVER_FETCHED)
+    for data in datas:
+        if data["origin"] == "elastic":
+            es.release_service(data["service"]["elastic_service_id"], data["wizard"], search_data["country"])
+    warehouse_datas = [data for data in datas if data["origin"] == "warehouse"]
+    if warehouse_datas:
+        spare_queues.put(search_data, warehouse_datas)
+    log.info("Released {} prepared services".format(len(datas)))
+
+
+class BatchPrefetcher(object):
+    """
+    Prepare the next batch of each matcher in the background, claimed and with its top3, once they submitted
+    PREFETCH_AFTER of their current batch, so their next fetch_batch does not wait for SQL, the warehouse or elastic.
+    The batches are kept in PrefetchedBatch, so the submits are counted and the prepared batch is served whichever
+    process answers them; the compare-and-set updates on its token prepare, serve and release a batch only once.
+    """
+
+    def __init__(self, prepare, release, prefetch_after=PREFETCH_AFTER, idle_time=IDLE_TIME, wait_time=WAIT_TIME):
+        """
+        :param prepare: function, called with the search_data, level1_id, user_id and batch_size sent by the
+        frontend of the batch to prepare and returning its services
+        :param release: function, called with the search_data and the services of a batch not used
+        """
+        self.prepare = prepare
+        self.release = release
+        self.prefetch_after = prefetch_after
+        self.idle_time = idle_time
+        self.wait_time = wait_time
+        self.lock = threading.Lock()
+        self.pool = None
+        self.thread = None
+        # of this process
+        self.counters = {
+            "prepared": 0,
+            "served": 0,
+            "late": 0,
+            "released": 0,
+            "failed": 0,
+        }
+
+    @staticmethod
+    def is_same_search(search_data, other):
+        return all(search_data[key] == other[key] for key in ("country", "city", "level1_id"))
+
+    def count(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] += value
+
+    def get_pool(self):
+        # created lazily so importing the views does not start threads
+        if self.pool is None:
+            with self.lock:
+                if self.pool is None:
+                    self.pool = ThreadPool(WORKERS)
+        return self.pool
+
+    def take(self, user_id, search_data, requested_at):
+        """
+        :param user_id: int,
+        :param search_data: dict, from the fetch_batch payload
+        :param requested_at: int, from the fetch_batch payload, a retry of the previous request is not served
+        :return: list of dict or None, the services prepared for this matcher
+        """
+        self.start()
+        batch = models.PrefetchedBatch.objects.filter(user_id=user_id).first()
+        if batch is None or requested_at <= batch.requested_at \
+                or not self.is_same_search(search_data, json.loads(batch.search_data)):
+            return None
+        end = time.time() + self.wait_time
+        while batch is not None and batch.state == models.PrefetchedBatch.PREPARING and time.time() < end:
+            time.sleep(WAIT_POLL_INTERVAL)
+            batch = models.PrefetchedBatch.objects.filter(pk=batch.pk, token=batch.token).first()
+        if batch is None or batch.state != models.PrefetchedBatch.PREPARED:
+            if batch is not None and batch.state == models.PrefetchedBatch.PREPARING:
+                self.count("late")
+            return None
+        # a new token, so the submits racing this fetch_batch do not prepare another batch
+        taken = models.PrefetchedBatch.objects \
+            .filter(pk=batch.pk, token=batch.token, state=models.PrefetchedBatch.PREPARED) \
+            .update(token=uuid4().hex, state="", prepared="", state_time=timezone.now())
+        datas = json.loads(batch.prepared) if taken else None
+        if not datas:
+            return None
+        self.count("served")
+        log.info("Serving {} prepared services to {}".format(len(datas), user_id))
+        return datas
+
+    def served(self, user_id, search_data, level1_id, batch_size, requested_at, datas):
+        """
+        Record the batch a matcher works on now, releasing the batch prepared for them if it was not used
+        :param batch_size: int, the batch_size sent by the frontend
+        """
+        now = timezone.now()
+        fields = {
+            "search_data": json.dumps(search_data),
+            "level1_id": level1_id,
+            "batch_size": batch_size,
+            "requested_at": requested_at,
+            "service_keys": json.dumps([data["service"]["key"] for data in datas]),
+            "submitted": 0,
+            "state": "",
+            "prepared": "",
+            "state_time": now,
+            "last_activity": now,
+        }
+        while True:
+            previous = models.PrefetchedBatch.objects.filter(user_id=user_id).first()
+            if previous is None:
+                try:
+                    with transaction.atomic():
+                        models.PrefetchedBatch.objects.create(user_id=user_id, token=uuid4().hex, **fields)
+                    return
+                except IntegrityError:
+                    # created by a concurrent fetch_batch of the matcher
+                    continue
+            if models.PrefetchedBatch.objects \
+                    .filter(pk=previous.pk, token=previous.token, state=previous.state) \
+                    .update(token=uuid4().hex, **fields):
+                break
+        if previous.state == models.PrefetchedBatch.PREPARED:
+            self.discard(json.loads(previous.search_data), json.loads(previous.prepared))
+
+    def submitted(self, user_id, service_key):
+        """
+        Count a match of the current batch, and start preparing the next one past PREFETCH_AFTER of it
+        """
+        batch = models.PrefetchedBatch.objects.filter(user_id=user_id).first()
+        if batch is None:
+            return
+        service_keys = json.loads(batch.service_keys)
+        if service_key not in service_keys:
+            return
+        now = timezone.now()
+        models.PrefetchedBatch.objects \
+            .filter(pk=batch.pk, token=batch.token) \
+            .update(submitted=F("submitted") + 1, last_activity=now)
+        # the submit reaching the threshold prepares the batch, in whichever process it is answered
+        preparing = models.PrefetchedBatch.objects \
+            .filter(pk=batch.pk, token=batch.token, state="") \
+            .filter(submitted__gte=math.ceil(len(service_keys) * self.prefetch_after)) \
+            .update(state=models.PrefetchedBatch.PREPARING, state_time=now)
+        if preparing:
+            self.get_pool().apply_async(self.prepare_batch, (user_id, batch))
+
+    def prepare_batch(self, user_id, batch):
+        search_data = json.loads(batch.search_data)
+        set_request_tags(endpoint="prefetch", country=search_data["country"], level1_id=batch.level1_id)
+        datas = []
+        saved = 0
+        try:
+            try:
+                datas = self.prepare(search_data, batch.level1_id, user_id, batch.batch_size) or []
+            except Exception:
+                log.exception("Preparing the next batch of {} failed".format(user_id))
+                self.count("failed")
+            # prepared without services when it failed, so it is not prepared again on every submit
+            saved = models.PrefetchedBatch.objects \
+                .filter(pk=batch.pk, token=batch.token, state=models.PrefetchedBatch.PREPARING) \
+                .update(state=models.PrefetchedBatch.PREPARED, prepared=json.dumps(datas, cls=DjangoJSONEncoder),
+                        state_time=timezone.now())
+        except Exception:
+            log.exception("Saving the next batch of {} failed".format(user_id))
+            self.count("failed")
+        finally:
+            connection.close()
+        if not saved and datas:
+            # the matcher fetched another batch or went idle meanwhile
+            self.release_datas(search_data, datas)
+        elif datas:
+            self.count("prepared")
+
+    def discard(self, search_data, datas):
+        if datas:
+            # released on a worker thread, fetch_batch does not wait for it
+            self.get_pool().apply_async(self.release_datas, (search_data, datas))
+
+    def release_datas(self, search_data, datas):
+        try:
+            self.release(search_data, datas)
+        except Exception:
+            log.exception("Releasing {} prepared services failed".format(len(datas)))
+        finally:
+            connection.close()
+        self.count("released", len(datas))
+
+    def start(self):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, name="servicematcher-prefetch")
+                    self.thread.daemon = True
+                    self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(POLL_INTERVAL)
+            try:
+                self.discard_idle()
+            except Exception:
+                log.exception("Discarding the idle prepared batches failed")
+            finally:
+                connection.close()
+
+    def discard_idle(self):
+        """
+        Release the batches prepared for the matchers idle for IDLE_TIME, and forget the preparations of a process
+        that stopped meanwhile
+        """
+        idle_before = timezone.now() - timedelta(seconds=self.idle_time)
+        idle = models.PrefetchedBatch.objects.filter(last_activity__lt=idle_before)
+        for batch in idle.filter(state=models.PrefetchedBatch.PREPARED):
+            if models.PrefetchedBatch.objects \
+                    .filter(pk=batch.pk, token=batch.token, state=models.PrefetchedBatch.PREPARED) \
+                    .update(state="", prepared="", state_time=timezone.now()):
+                self.discard(json.loads(batch.search_data), json.loads(batch.prepared))
+        idle.filter(state=models.PrefetchedBatch.PREPARING, state_time__lt=idle_before).update(state="")
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        active = models.PrefetchedBatch.objects \
+            .filter(last_activity__gte=timezone.now() - timedelta(seconds=self.idle_time))
+        stats["matchers"] = active.count()
+        stats["ready"] = active.filter(state=models.PrefetchedBatch.PREPARED).exclude(prepared="[]").count()
+        return stats
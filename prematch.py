@@ -0,0 +1,157 @@
+from __future__ import unicode_literals
+import json
+import time
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from servicematcher import models
+from servicematcher.mappings import level1_to_warehouse_category_id
+from servicematcher.utils import get_logging
+
+log = get_logging(__name__)
+
+# The candidates computed longer ago than that are computed again
+CANDIDATES_MAX_AGE = getattr(settings, "SERVICEMATCHER_CANDIDATES_MAX_AGE", 7 * 24 * 3600)
+# Seconds the services of a page stay leased, the longer the fewer pages are fetched again once they expire
+PREMATCH_TIME_LIMIT = getattr(settings, "SERVICEMATCHER_PREMATCH_TIME_LIMIT", 600)
+
+
+def load_precomputed_candidates(datas, level1_id, country, max_age=CANDIDATES_MAX_AGE):
+    """
+    Set the "index_elements" of the services whose top3 was computed by prematch_services, in one query
+    :param datas: list of dict, services for frontend
+    :param level1_id: str,
+    :param country: str,
+    :return: int, number of services found
+    """
+    keys = [data["service"]["key"] for data in datas]
+    if not keys:
+        return 0
+    candidates = models.ServiceCandidates.objects\
+        .filter(service_key__in=keys)\
+        .filter(search_country=country)\
+        .filter(search_level1_id=level1_id)\
+        .filter(computed_time__gte=timezone.now() - timedelta(seconds=max_age))\
+        .values_list("service_key", "index_elements")
+    index_elements = dict(candidates)
+    for data in datas:
+        if data["service"]["key"] in index_elements:
+            data["index_elements"] = json.loads(index_elements[data["service"]["key"]])
+    return len(index_elements)
+
+
+class PrematchPipeline(object):
+    """
+    Stream the unmatched services of a city and level1 from the warehouse page by page, compute their top3
+    with one msearch per chunk on a bounded number of threads and save them in ServiceCandidates.
+    The services already computed are skipped, so an interrupted run can be started again.
+    """
+
+    def __init__(self, es, wh, country, city, level1_id, page_size=100, chunk_size=20, concurrency=4,
+                 time_limit=PREMATCH_TIME_LIMIT, max_age=CANDIDATES_MAX_AGE):
+        self.es = es
+        self.wh = wh
+        self.country = country
+        self.city = city
+        self.level1_id = level1_id
+        self.page_size = page_size
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        # the warehouse has no cursor: the leased services are skipped by the next pages
+        self.time_limit = time_limit
+        self.max_age = max_age
+        self.known_keys = set()
+        self.fetched = 0
+        self.computed = 0
+
+    def load_known_keys(self):
+        self.known_keys = set(models.ServiceCandidates.objects
+                              .filter(search_country=self.country)
+                              .filter(search_level1_id=self.level1_id)
+                              .filter(computed_time__gte=timezone.now() - timedelta(seconds=self.max_age))
+                              .values_list("service_key", flat=True))
+
+    def iter_pages(self, limit=None):
+        """
+        The pages of services already computed, by an interrupted run or given back by the warehouse once their
+        lease expired, are skipped. The run stops when the warehouse has nothing left, or once it gave back in a row
+        twice as many services seen earlier in the run as the run has seen: it went round all of them twice.
+        :param limit: int, stop after that many new services
+        :return: generator of list of dict, pages of services not computed yet
+        """
+        category_ids = level1_to_warehouse_category_id[self.level1_id]
+        new = 0
+        seen_keys = set()
+        repeated = 0
+        while limit is None or new < limit:
+            datas = self.wh.get_batch_unmatched_service(self.country, self.city, category_ids=category_ids,
+                                                        size=self.page_size, time_limit=self.time_limit)
+            if not datas:
+                return
+            self.fetched += len(datas)
+            keys = [data["service"]["key"] for data in datas]
+            repeated += len([key for key in keys if key in seen_keys])
+            seen_keys.update(keys)
+            datas = [data for data in datas if data["service"]["key"] not in self.known_keys]
+            if not datas:
+                if repeated >= 2 * len(seen_keys):
+                    log.info("The warehouse only gives back services already computed")
+                    return
+                continue
+            repeated = 0
+            if limit is not None:
+                datas = datas[:limit - new]
+            new += len(datas)
+            self.known_keys.update(data["service"]["key"] for data in datas)
+            yield datas
+
+    def compute(self, datas):
+        top3s = self.es.get_top3_index_elements_from_services(datas, self.level1_id, self.country, get_1st_match=False)
+        return datas, top3s
+
+    def save(self, datas, top3s):
+        keys = [data["service"]["key"] for data in datas]
+        with transaction.atomic():
+            models.ServiceCandidates.objects.filter(service_key__in=keys).delete()
+            models.ServiceCandidates.objects.bulk_create([
+                models.ServiceCandidates(
+                    service_key=data["service"]["key"],
+                    search_country=self.country,
+                    search_city=self.city,
+                    search_level1_id=self.level1_id,
+                    index_elements=json.dumps(hits),
+                )
+                for data, hits in zip(datas, top3s)
+            ])
+        self.computed += len(datas)
+
+    def run(self, limit=None, report_every=10):
+        """
+        :param limit: int, maximum number of services to compute
+        :param report_every: int, log the throughput every that many pages
+        :return: dict, counters and throughput of the run
+        """
+        self.load_known_keys()
+        start = time.time()
+        pool = ThreadPool(self.concurrency)
+        try:
+            for i, page in enumerate(self.iter_pages(limit)):
+                chunks = [page[j:j + self.chunk_size] for j in range(0, len(page), self.chunk_size)]
+                for datas, top3s in pool.imap_unordered(self.compute, chunks):
+                    self.save(datas, top3s)
+                if (i + 1) % report_every == 0:
+                    log.info("Prematched {} services at {:.1f} services/s".format(
+                        self.computed, self.computed / (time.time() - start)))
+        finally:
+            pool.terminate()
+        elapsed = time.time() - start
+        return {
+            "fetched": self.fetched,
+            "computed": self.computed,
+            "seconds": elapsed,
+            "services_per_second": self.computed / elapsed if elapsed else 0.,
+        }
@@ -0,0 +1,188 @@
+from __future__ import unicode_literals
+import cProfile
+import itertools
+import json
+import os
+import pstats
+import re
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from servicematcher.utils import get_logging
+
+log = get_logging(__name__)
+
+# Off by default: the handlers are then not wrapped at all
+PROFILING = getattr(settings, "SERVICEMATCHER_PROFILING", False)
+# Also profile 1 request in SAMPLE_EVERY, 0 to only profile the requests flagged by a staff user
+SAMPLE_EVERY = getattr(settings, "SERVICEMATCHER_PROFILING_SAMPLE_EVERY", 0)
+# Needed by SERVICEMATCHER_PROFILING, a directory only readable by the people allowed to see the queries
+PROFILES_DIR = getattr(settings, "SERVICEMATCHER_PROFILING_DIR", None)
+# The oldest profiles are deleted past that many
+MAX_PROFILES = getattr(settings, "SERVICEMATCHER_PROFILING_MAX_PROFILES", 100)
+HEADER = "HTTP_X_SERVICEMATCHER_PROFILE"
+QUERY_FLAG = "profile"
+TOP_FUNCTIONS = 30
+TREE_DEPTH = 20
+# The branches of the call tree taking less than that share of the request are cut
+TREE_THRESHOLD = 0.01
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r"(?<![\w.\"])\d+(?:\.\d+)?(?![\w\"])")
+
+request_counter = itertools.count(1)
+
+
+def is_flagged(request):
+    flagged = request.META.get(HEADER) == "1" or request.query_params.get(QUERY_FLAG) == "1"
+    return flagged and request.user.is_staff
+
+
+def is_sampled():
+    return SAMPLE_EVERY > 0 and next(request_counter) % SAMPLE_EVERY == 0
+
+
+def get_function_name(function):
+    filename, line, name = function
+    if filename == "~":
+        # built-in functions, e.g. "<method 'execute' of 'psycopg2.extensions.cursor' objects>"
+        return name
+    return "{}:{}({})".format(filename, line, name)
+
+
+def strip_parameters(sql):
+    """
+    "... WHERE "wh_key" = 'abc' LIMIT 21" -> "... WHERE "wh_key" = ? LIMIT ?", the queries are stored without the data
+    """
+    return NUMBER_LITERAL.sub("?", STRING_LITERAL.sub("?", sql))
+
+
+def get_top_functions(stats, size=TOP_FUNCTIONS):
+    """
+    :param stats: pstats.Stats,
+    :return: list of dict, the functions taking the most time by themselves
+    """
+    rows = sorted(stats.stats.items(), key=lambda item: -item[1][2])[:size]
+    return [{
+        "function": get_function_name(function),
+        "calls": calls,
+        "own_ms": int(own_time * 1000),
+        "cumulative_ms": int(cumulative_time * 1000),
+    } for function, (_, calls, own_time, cumulative_time, _) in rows]
+
+
+def get_call_tree(stats, root, total_time):
+    """
+    :param stats: pstats.Stats,
+    :param root: tuple, (filename, line, name) of the profiled handler
+    :param total_time: float, seconds, the branches below TREE_THRESHOLD of it are cut
+    :return: dict, function with its cumulative time and its children
+    """
+    callees = {}
+    for function, (_, _, _, _, callers) in stats.stats.items():
+        for caller, (_, calls, _, cumulative_time) in callers.items():
+            callees.setdefault(caller, []).append((function, calls, cumulative_time))
+
+    def build(function, calls, cumulative_time, path, depth):
+        node = {
+            "function": get_function_name(function),
+            "calls": calls,
+            "cumulative_ms": int(cumulative_time * 1000),
+        }
+        if depth < TREE_DEPTH:
+            children = sorted(callees.get(function, []), key=lambda callee: -callee[2])
+            node["children"] = [build(child, child_calls, child_time, path | {child}, depth + 1)
+                                for child, child_calls, child_time in children
+                                if child not in path and child_time >= total_time * TREE_THRESHOLD]
+        return node
+
+    if root not in stats.stats:
+        return None
+    _, calls, _, cumulative_time, _ = stats.stats[root]
+    return build(root, calls, cumulative_time, {root}, 0)
+
+
+def save_profile(profile):
+    """
+    Write a profile in PROFILES_DIR and delete the oldest ones past MAX_PROFILES
+    :param profile: dict,
+    :return: str, path of the file
+    """
+    if not os.path.isdir(PROFILES_DIR):
+        os.makedirs(PROFILES_DIR)
+    filename = "{}-{}-{}.json".format(int(profile["time"] * 1000), profile["endpoint"], os.getpid())
+    path = os.path.join(PROFILES_DIR, filename)
+    with open(path, "w") as f:
+        json.dump(profile, f)
+    for old_filename in list_profiles()[MAX_PROFILES:]:
+        try:
+            os.remove(os.path.join(PROFILES_DIR, old_filename))
+        except OSError:
+            # already deleted by another process
+            pass
+    return path
+
+
+def list_profiles():
+    """
+    :return: list of str, the file names of the stored profiles, latest first
+    """
+    if PROFILES_DIR is None or not os.path.isdir(PROFILES_DIR):
+        return []
+    return sorted((filename for filename in os.listdir(PROFILES_DIR) if filename.endswith(".json")), reverse=True)
+
+
+def load_profile(filename):
+    with open(os.path.join(PROFILES_DIR, filename)) as f:
+        return json.load(f)
+
+
+def profiled(endpoint):
+    """
+    Decorate the handler of an APIView to profile the requests flagged by a staff user with the
+    X-Servicematcher-Profile: 1 header or ?profile=1, and 1 request in SAMPLE_EVERY.
+    Without SERVICEMATCHER_PROFILING the handler is returned as it is.
+    """
+    def decorator(handler):
+        if not PROFILING:
+            return handler
+        if PROFILES_DIR is None:
+            raise ImproperlyConfigured("SERVICEMATCHER_PROFILING needs a SERVICEMATCHER_PROFILING_DIR")
+        code = getattr(handler, "__code__", None)
+        root = (code.co_filename, code.co_firstlineno, code.co_name) if code else None
+
+        @wraps(handler)
+        def wrapper(view, request, *args, **kwargs):
+            if not is_flagged(request) and not is_sampled():
+                return handler(view, request, *args, **kwargs)
+            profiler = cProfile.Profile()
+            start = time.time()
+            with CaptureQueriesContext(connection) as queries:
+                profiler.enable()
+                try:
+                    return handler(view, request, *args, **kwargs)
+                finally:
+                    profiler.disable()
+                    try:
+                        stats = pstats.Stats(profiler)
+                        total_time = time.time() - start
+                        path = save_profile({
+                            "endpoint": endpoint,
+                            "time": start,
+                            "user_id": request.user.id,
+                            "total_ms": int(total_time * 1000),
+                            "query_count": len(queries),
+                            "queries": [{"sql": strip_parameters(query["sql"])[:500], "time": query["time"]}
+                                        for query in queries.captured_queries],
+                            "top_functions": get_top_functions(stats),
+                            "call_tree": get_call_tree(stats, root, total_time),
+                        })
+                        log.info("Saved the profile of {} in {}".format(endpoint, path))
+                    except Exception:
+                        log.exception("Could not save the profile of {}".format(endpoint))
+        return wrapper
+    return decorator
@@ -1,3 +1,12 @@
+import json
+
+# Bump when the shape of a templated query changes, register_search_templates then stores the new templates
+SEARCH_TEMPLATE_VERSION = 1
+TOP3_TEMPLATE = "servicematcher_top3"
+TOP3_ALIASES_TEMPLATE = "servicematcher_top3_aliases"
+AUTOCOMPLETE_TEMPLATE = "servicematcher_autocomplete"
+
+
 def query_get_index_elements_from_search_string(search_string, size=10, skip=0, level1_id=""):
     query = {
         "query": {
@@ -180,6 +189,79 @@ def query_get_index_elements_from_service(service, venue, level1_id="", size=3):
     return query
 
 
+# Fields of the service children denormalized on their index_element parent
+CHILD_FIELD_TO_ALIAS_FIELD = {
+    "product_description": "alias_descriptions",
+    "product_category": "alias_categories",
+    "venue_category": "alias_venue_categories",
+}
+
+
+def rename_child_field(field):
+    """
+    "product_description.search_analyzer" -> "alias_descriptions.search_analyzer"
+    """
+    name, dot, subfield = field.partition(".")
+    return CHILD_FIELD_TO_ALIAS_FIELD.get(name, name) + dot + subfield
+
+
+def rename_child_fields(query):
+    """
+    Rename the child fields of a query, the searched texts are left as they are
+    """
+    if isinstance(query, dict):
+        renamed = {}
+        for key, value in query.items():
+            if key == "fields":
+                value = [rename_child_field(field) for field in value]
+            else:
+                value = rename_child_fields(value)
+            renamed[rename_child_field(key)] = value
+        return renamed
+    if isinstance(query, list):
+        return [rename_child_fields(value) for value in query]
+    return query
+
+
+def to_alias_query(query):
+    """
+    Replace every has_child clause by the same query on the alias fields of the parent.
+    has_child scores with score_mode none, so the alias clause is a constant score too.
+    """
+    if isinstance(query, dict):
+        if "has_child" in query:
+            return {"constant_score": {"filter": rename_child_fields(query["has_child"]["query"])}}
+        return dict((key, to_alias_query(value)) for key, value in query.items())
+    if isinstance(query, list):
+        return [to_alias_query(value) for value in query]
+    return query
+
+
+def query_get_index_elements_from_aliases(service, venue, level1_id="", size=3):
+    """
+    query_get_index_elements_from_service on the parents only, needs denormalize_aliases to have been run
+    """
+    return to_alias_query(query_get_index_elements_from_service(service, venue, level1_id=level1_id, size=size))
+
+
+def query_add_aliases(aliases):
+    """
+    Update body appending the texts of a new service child to the alias fields of its parent
+    :param aliases: dict, alias field -> normalized text
+    """
+    query = {
+        "script": {
+            "inline": "for (entry in params.aliases.entrySet()) {"
+                      " if (ctx._source[entry.getKey()] == null) { ctx._source[entry.getKey()] = []; }"
+                      " if (!ctx._source[entry.getKey()].contains(entry.getValue())) {"
+                      " ctx._source[entry.getKey()].add(entry.getValue()); } }",
+            "lang": "painless",
+            "params": {"aliases": aliases},
+        }
+    }
+    return query
+
+
 def query_get_unmatched_service(user_id, before_time, level1_id="", size=1):
     query = {
         "query": {
@@ -210,6 +292,118 @@ def query_get_unmatched_service(user_id, before_time, level1_id="", size=1):
     return query
 
 
+def get_search_template_id(name, level1_id="", version=SEARCH_TEMPLATE_VERSION):
+    """
+    The level1 filter is in a separate template, mustache sections would not keep the json valid
+    """
+    if level1_id:
+        name += "_level1"
+    return "{}_v{}".format(name, version)
+
+
+def to_search_template(query):
+    """
+    :param query: dict, query built with "{{param}}" strings as values
+    :return: str, mustache source, the numeric params are not quoted
+    """
+    source = json.dumps(query)
+    for param in ("size", "skip"):
+        source = source.replace('"{{%s}}"' % param, '{{%s}}' % param)
+    return source
+
+
+def get_search_templates():
+    """
+    :return: dict, template id -> mustache source of every templated query
+    """
+    templates = {}
+    for level1_id in ("", "{{level1_id}}"):
+        top3 = query_get_index_elements_from_service(
+            {"description": "{{description}}", "category": "{{category}}"},
+            {"category_name": "{{venue_category}}"},
+            level1_id=level1_id,
+            size="{{size}}",
+        )
+        templates[get_search_template_id(TOP3_TEMPLATE, level1_id)] = to_search_template(top3)
+        templates[get_search_template_id(TOP3_ALIASES_TEMPLATE, level1_id)] = to_search_template(to_alias_query(top3))
+        autocomplete = query_get_index_elements_from_search_string(
+            "{{search_string}}",
+            size="{{size}}",
+            skip="{{skip}}",
+            level1_id=level1_id,
+        )
+        templates[get_search_template_id(AUTOCOMPLETE_TEMPLATE, level1_id)] = to_search_template(autocomplete)
+    return templates
+
+
+def template_get_index_elements_from_service(service, venue, level1_id="", size=3, aliases=False):
+    """
+    Same query as query_get_index_elements_from_service, or query_get_index_elements_from_aliases,
+    through its stored template
+    """
+    params = {
+        "description": service['description'],
+        "category": service['category'],
+        "venue_category": venue['category_name'],
+        "size": size,
+    }
+    if level1_id:
+        params["level1_id"] = level1_id
+    name = TOP3_ALIASES_TEMPLATE if aliases else TOP3_TEMPLATE
+    return {"id": get_search_template_id(name, level1_id), "params": params}
+
+
+def template_get_index_elements_from_search_string(search_string, size=10, skip=0, level1_id=""):
+    """
+    Same query as query_get_index_elements_from_search_string, through its stored template
+    """
+    params = {
+        "search_string": search_string,
+        "size": size,
+        "skip": skip,
+    }
+    if level1_id:
+        params["level1_id"] = level1_id
+    return {"id": get_search_template_id(AUTOCOMPLETE_TEMPLATE, level1_id), "params": params}
+
+
+def query_claim_unmatched_service(user_id, before_time, claim_time, claim_token, level1_id=""):
+    """
+    update_by_query body leasing the unmatched services with a token, the documents updated concurrently
+    by another matcher are version conflicts and are left to him
+    """
+    query = query_get_unmatched_service(user_id, before_time, level1_id=level1_id)
+    del query["size"]
+    query["script"] = {
+        "inline": "ctx._source.last_fetch_date = params.last_fetch_date; ctx._source.lock_token = params.lock_token",
+        "lang": "painless",
+        "params": {
+            "last_fetch_date": claim_time,
+            "lock_token": claim_token,
+        }
+    }
+    return query
+
+
+def query_get_claimed_service(claim_token, size=1):
+    query = {
+        "query": {
+            "constant_score": {
+                "filter": {
+                    "bool": {
+                        "must": [
+                            {"term": {"lock_token": claim_token}},
+                            {"term": {"_type": "service"}},
+                        ],
+                    }
+                }
+            }
+        },
+        "size": size
+    }
+    return query
+
+
 # Test the queries
 if __name__ == "__main__":
     from elasticsearch import Elasticsearch
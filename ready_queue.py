@@ -0,0 +1,196 @@
+from __future__ import unicode_literals
+import math
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+from servicematcher.mappings import level1_to_warehouse_category_id, level1_to_level1_id
+from servicematcher.utils import get_logging
+
+log = get_logging(__name__)
+
+# Worker processes serving the matcher, each one keeps its own queues and leases: the watermarks below are shared
+# between them, a process that stops or fails to refill drops its leases until the warehouse lets them expire
+WORKER_PROCESSES = max(1, getattr(settings, "SERVICEMATCHER_WORKER_PROCESSES", 1))
+# Services of a search queued by all the worker processes together
+LOW_WATERMARK = int(math.ceil(getattr(settings, "SERVICEMATCHER_READY_QUEUE_LOW_WATERMARK", 10)
+                              / float(WORKER_PROCESSES)))
+HIGH_WATERMARK = int(math.ceil(getattr(settings, "SERVICEMATCHER_READY_QUEUE_HIGH_WATERMARK", 40)
+                               / float(WORKER_PROCESSES)))
+# How long a queued service can wait, it must stay well below the lease of the warehouse so the
+# matcher still has the time to match it once it is served
+MAX_AGE = getattr(settings, "SERVICEMATCHER_READY_QUEUE_MAX_AGE", 600)
+# Stop refilling a queue nobody fetched from for that long
+IDLE_TIME = getattr(settings, "SERVICEMATCHER_READY_QUEUE_IDLE_TIME", 900)
+POLL_INTERVAL = 5
+
+
+class ReadyQueue(object):
+    """
+    Services of one (country, city, level1_id) already leased in the warehouse and with their top3
+    """
+
+    def __init__(self, search_data):
+        self.search_data = search_data
+        self.items = deque()
+        self.last_used = time.time()
+
+    def push(self, datas):
+        now = time.time()
+        self.items.extend((now, data) for data in datas)
+
+    def pop(self, size):
+        self.last_used = time.time()
+        datas = []
+        while self.items and len(datas) < size:
+            datas.append(self.items.popleft()[1])
+        return datas
+
+    def expire(self, max_age):
+        """
+        :param max_age: float, seconds
+        :return: int, number of services dropped because their lease is about to end
+        """
+        limit = time.time() - max_age
+        expired = 0
+        while self.items and self.items[0][0] < limit:
+            self.items.popleft()
+            expired += 1
+        return expired
+
+    def __len__(self):
+        return len(self.items)
+
+
+class ReadyQueues(object):
+    """
+    Keep a bounded queue of ready-to-serve warehouse services for every (country, city, level1_id) being matched,
+    refilled in a background thread between LOW_WATERMARK and HIGH_WATERMARK.
+    """
+
+    def __init__(self, es, wh, low_watermark=LOW_WATERMARK, high_watermark=HIGH_WATERMARK, max_age=MAX_AGE):
+        self.es = es
+        self.wh = wh
+        self.low_watermark = low_watermark
+        self.high_watermark = high_watermark
+        self.max_age = 20 if settings.SERVICEMATCHER_IN_TEST_MODE else max_age
+        self.queues = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.counters = {
+            "served": 0,
+            "missed": 0,
+            "expired": 0,
+            "refilled": 0,
+        }
+
+    @staticmethod
+    def get_key(search_data):
+        return search_data["country"], search_data["city"], search_data["level1_id"]
+
+    def pop(self, search_data, size):
+        """
+        :param search_data: dict, from the fetch_batch payload
+        :param size: int,
+        :return: list of dict, services with their "index_elements", can be shorter than size
+        """
+        self.start()
+        key = self.get_key(search_data)
+        with self.lock:
+            queue = self.queues.get(key)
+            if queue is None:
+                queue = self.queues[key] = ReadyQueue(dict(search_data))
+            self.counters["expired"] += queue.expire(self.max_age)
+            datas = queue.pop(size)
+            self.counters["served"] += len(datas)
+            self.counters["missed"] += size - len(datas)
+            if len(queue) < self.low_watermark:
+                self.wakeup.set()
+        return datas
+
+    def depth(self, search_data):
+        """
+        :return: int, number of services queued for this search, some may be about to expire
+        """
+        with self.lock:
+            queue = self.queues.get(self.get_key(search_data))
+            return len(queue) if queue is not None else 0
+
+    def put(self, search_data, datas):
+        """
+        Give back leased services that were not used, they are served to the next request
+        """
+        key = self.get_key(search_data)
+        with self.lock:
+            queue = self.queues.get(key)
+            if queue is None:
+                queue = self.queues[key] = ReadyQueue(dict(search_data))
+            queue.push(datas)
+
+    def start(self):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, name="servicematcher-ready-queue")
+                    self.thread.daemon = True
+                    self.thread.start()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(POLL_INTERVAL)
+            self.wakeup.clear()
+            try:
+                self.refill_all()
+            except Exception:
+                log.exception("Refilling the ready queues failed")
+
+    def refill_all(self):
+        idle_before = time.time() - IDLE_TIME
+        with self.lock:
+            for key, queue in list(self.queues.items()):
+                self.counters["expired"] += queue.expire(self.max_age)
+                if queue.last_used < idle_before:
+                    # nobody is matching there anymore, let the leases of the warehouse expire
+                    del self.queues[key]
+            to_refill = [
+                (queue.search_data, self.high_watermark - len(queue))
+                for queue in self.queues.values()
+                if len(queue) < self.low_watermark
+            ]
+        for search_data, size in to_refill:
+            self.refill(search_data, size)
+
+    def refill(self, search_data, size):
+        """
+        Lease size services in the warehouse and compute their top3 outside of any request
+        """
+        datas = self.wh.get_batch_unmatched_service(
+            search_data["country"],
+            search_data["city"],
+            category_ids=level1_to_warehouse_category_id[search_data["level1_id"]],
+            size=size,
+        )
+        if not datas:
+            return
+        level1_id = level1_to_level1_id[search_data["level1"]]
+        top3s = self.es.get_top3_index_elements_from_services(datas, level1_id, search_data["country"])
+        for data, hits in zip(datas, top3s):
+            data["index_elements"] = hits
+        self.put(search_data, datas)
+        with self.lock:
+            self.counters["refilled"] += len(datas)
+        log.info("Refilled the ready queue {} with {} services".format(self.get_key(search_data), len(datas)))
+
+    def stats(self):
+        """
+        :return: dict, counters and the depth of every queue
+        """
+        with self.lock:
+            stats = dict(self.counters)
+            requested = stats["served"] + stats["missed"]
+            stats["hit_rate"] = stats["served"] / float(requested) if requested else 0.
+            stats["depths"] = dict((":".join(key), len(queue)) for key, queue in self.queues.items())
+        return stats
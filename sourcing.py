@@ -0,0 +1,177 @@
+from __future__ import unicode_literals
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connection
+
+from servicematcher.mappings import level1_to_warehouse_category_id
+from servicematcher.metrics import clock, get_request_tags, set_request_tags, span
+from servicematcher.prematch import load_precomputed_candidates
+from servicematcher.utils import get_logging
+
+log = get_logging(__name__)
+
+# Seconds a speculative fetch_batch waits for the warehouse, its services arriving later are kept for the next one
+FETCH_DEADLINE = getattr(settings, "SERVICEMATCHER_FETCH_DEADLINE", 10)
+WORKERS = getattr(settings, "SERVICEMATCHER_SPECULATIVE_WORKERS", 8)
+
+
+def add_candidates(es, datas, level1_id, country):
+    """
+    Set the "index_elements" of the services that do not have them yet: the ones of the warehouse may have been
+    prematched, the others get their top3 in one batch
+    :param es: ElasticServices,
+    :param datas: list of dict, services for frontend
+    :param level1_id: str,
+    :param country: str,
+    """
+    with span("sql"):
+        load_precomputed_candidates([data for data in datas if data["origin"] == "warehouse" and "index_elements" not in data],
+                                    level1_id, country)
+    missing_datas = [data for data in datas if "index_elements" not in data]
+    with span("elastic") as s:
+        top3s = es.get_top3_index_elements_from_services(missing_datas, level1_id, country)
+    for data, hits in zip(missing_datas, top3s):
+        data["index_elements"] = hits
+    log.info("Fetching top3 from batch of size {size} took: {total}ms or {average}ms/service".format(
+        size=len(missing_datas),
+        total=s.ms,
+        average=s.ms/float(max(len(missing_datas), 1)))
+    )
+
+
+class WarehouseFetch(object):
+    """
+    Warehouse services leased with their top3 on a worker thread while the request claims the ones of SQL.
+    If the request stops waiting for them, they are put in the spare queues when they arrive.
+    """
+
+    def __init__(self, sourcing, search_data, level1_id, size):
+        self.sourcing = sourcing
+        self.search_data = search_data
+        self.level1_id = level1_id
+        self.size = size
+        self.tags = get_request_tags()
+        self.datas = []
+        self.abandoned = False
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+    def run(self):
+        set_request_tags(**self.tags)
+        datas = []
+        try:
+            with span("warehouse") as s:
+                datas = self.sourcing.wh.get_batch_unmatched_service(
+                    self.search_data['country'],
+                    self.search_data['city'],
+                    category_ids=level1_to_warehouse_category_id[self.search_data['level1_id']],
+                    size=self.size,
+                )
+            log.info("Fetching the Warehouse took: {}ms to find {} services".format(s.ms, len(datas)))
+            add_candidates(self.sourcing.es, datas, self.level1_id, self.search_data['country'])
+        except Exception:
+            log.exception("The speculative fetch of the warehouse failed")
+            datas = [data for data in datas if "index_elements" in data]
+        finally:
+            connection.close()
+        with self.lock:
+            if self.abandoned:
+                if datas:
+                    self.sourcing.spare_queues.put(self.search_data, datas)
+            else:
+                self.datas = datas
+            self.done.set()
+
+    def take(self, timeout):
+        """
+        :param timeout: float, seconds
+        :return: list of dict, the services, empty if they were not there in time
+        """
+        self.done.wait(timeout)
+        with self.lock:
+            if not self.done.is_set():
+                self.abandoned = True
+                log.warning("The warehouse did not answer in time, its services are kept for the next fetch")
+                return []
+            return self.datas
+
+    def abandon(self):
+        """
+        The request failed before taking the services: they go to the spare queues now or when they arrive
+        """
+        with self.lock:
+            self.abandoned = True
+            datas, self.datas = self.datas, []
+        if datas:
+            self.sourcing.spare_queues.put(self.search_data, datas)
+
+
+class SpeculativeSourcing(object):
+    """
+    fetch_batch with the warehouse fetch and its top3 started at the same time as the claim of the services
+    waiting for their 2nd match, instead of after it. The warehouse is asked for the batch minus what the spare
+    queues already hold, and the services it leased that do not fit in the batch are kept in the spare queues
+    for the next request, so nothing is leased for nothing, even when the request fails.
+    The deadline only bounds the wait for the warehouse: the claim of SQL or elastic and its top3 run on the
+    request thread with their own timeouts.
+    """
+
+    def __init__(self, es, wh, spare_queues, deadline=FETCH_DEADLINE, workers=WORKERS):
+        """
+        :param spare_queues: ReadyQueues, where the leased services not used yet wait for the next request
+        """
+        self.es = es
+        self.wh = wh
+        self.spare_queues = spare_queues
+        self.deadline = deadline
+        self.workers = workers
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def get_pool(self):
+        # created lazily so importing the views does not start threads
+        if self.pool is None:
+            with self.lock:
+                if self.pool is None:
+                    self.pool = ThreadPool(self.workers)
+        return self.pool
+
+    def fetch(self, claim, search_data, level1_id, batch_size):
+        """
+        :param claim: function, called with a size, claiming the services waiting for their 2nd match
+        :param search_data: dict, from the fetch_batch payload
+        :param level1_id: str,
+        :param batch_size: int,
+        :return: list of dict, at most batch_size services with their "index_elements"
+        """
+        end = clock() + self.deadline
+        warehouse_fetch = None
+        size = batch_size - min(self.spare_queues.depth(search_data), batch_size)
+        if size > 0:
+            warehouse_fetch = WarehouseFetch(self, search_data, level1_id, size)
+            self.get_pool().apply_async(warehouse_fetch.run)
+
+        try:
+            datas = claim(batch_size)
+            if datas:
+                add_candidates(self.es, datas, level1_id, search_data['country'])
+        except Exception:
+            if warehouse_fetch is not None:
+                # the services leased meanwhile are kept for the next request
+                warehouse_fetch.abandon()
+            raise
+        if len(datas) < batch_size:
+            queued_datas = self.spare_queues.pop(search_data, batch_size - len(datas))
+            log.info("Took {} services from the spare queue".format(len(queued_datas)))
+            datas += queued_datas
+
+        if warehouse_fetch is not None:
+            wh_datas = warehouse_fetch.take(max(0, end - clock()))
+            missing = batch_size - len(datas)
+            if len(wh_datas) > missing:
+                self.spare_queues.put(search_data, wh_datas[missing:])
+                log.info("Kept {} speculatively leased services for the next fetch".format(len(wh_datas) - missing))
+            datas += wh_datas[:missing]
+        return datas
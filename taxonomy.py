@@ -0,0 +1,152 @@
+from __future__ import unicode_literals
+import threading
+import time
+
+from django.conf import settings
+
+from servicematcher import models
+from servicematcher.utils import get_logging
+
+log = get_logging(__name__)
+
+REFRESH_INTERVAL = getattr(settings, "SERVICEMATCHER_INDEX_ELEMENT_REFRESH_INTERVAL", 300)
+
+
+class IndexElementCache(object):
+    """
+    Process-local copy of the IndexElement table, looked up by id or by wizard.
+    The table is loaded on first use, then only the rows updated since the last load are read again.
+    The values not found in the table are remembered until the next refresh, so an unknown or empty wizard
+    does not query it on every request.
+    Index elements are never deleted, the matches protect them.
+    """
+
+    def __init__(self, refresh_interval=REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self.by_id = {}
+        self.by_wizard = {}
+        # (field, value) not found since the last refresh
+        self.unknown = set()
+        self.version = 0
+        self.last_updated_time = None
+        self.last_refresh = 0
+        self.lock = threading.Lock()
+        self.warming = None
+        self.warming_lock = threading.Lock()
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "reloads": 0,
+            "last_reload_ms": 0.,
+        }
+
+    def refresh(self, force=False):
+        if not force and time.time() - self.last_refresh < self.refresh_interval:
+            return
+        with self.lock:
+            if not force and time.time() - self.last_refresh < self.refresh_interval:
+                return
+            start = time.time()
+            rows = models.IndexElement.objects.all()
+            if self.last_updated_time is not None:
+                rows = rows.filter(updated_time__gte=self.last_updated_time)
+            changed = 0
+            for row in rows:
+                if self.store(row):
+                    changed += 1
+                if self.last_updated_time is None or row.updated_time > self.last_updated_time:
+                    self.last_updated_time = row.updated_time
+            if changed:
+                self.version += 1
+                log.info("Loaded {} index elements, catalogue version {}".format(changed, self.version))
+            # the rows created since then are loaded now
+            self.unknown = set()
+            self.last_refresh = time.time()
+            self.counters["reloads"] += 1
+            self.counters["last_reload_ms"] = (self.last_refresh - start) * 1000
+
+    def warm_up(self):
+        """
+        Load the table in a background thread so the first submit does not pay for it.
+        Called by the first fetch_batch rather than on import, so the management commands and the migrations
+        do not query the table; the next calls do nothing.
+        """
+        if self.warming is not None:
+            return
+
+        def load():
+            try:
+                self.refresh(force=True)
+            except Exception:
+                log.exception("Could not load the index elements")
+        with self.warming_lock:
+            if self.warming is not None:
+                return
+            self.warming = threading.Thread(target=load, name="servicematcher-index-elements")
+            self.warming.daemon = True
+            self.warming.start()
+
+    def store(self, row):
+        """
+        :return: Boolean, True if the row is new or changed
+        """
+        previous = self.by_id.get(row.pk)
+        if previous is not None and previous.updated_time == row.updated_time:
+            return False
+        if previous is not None and previous.wizard != row.wizard:
+            self.by_wizard.pop(previous.wizard, None)
+        self.by_id[row.pk] = row
+        self.by_wizard[row.wizard] = row
+        return True
+
+    def get_by_id(self, pk):
+        """
+        :param pk: int,
+        :return: IndexElement or None
+        """
+        return self.get_many_by("pk", [pk], self.by_id).get(pk)
+
+    def get_by_wizard(self, wizard):
+        """
+        :param wizard: str,
+        :return: IndexElement or None
+        """
+        return self.get_by_wizards([wizard]).get(wizard)
+
+    def get_by_wizards(self, wizards):
+        """
+        :param wizards: list of str,
+        :return: dict, wizard -> IndexElement, the unknown wizards are missing
+        """
+        return self.get_many_by("wizard", wizards, self.by_wizard)
+
+    def get_many_by(self, field, values, lookup):
+        self.refresh()
+        found = {}
+        missing = []
+        unknown = self.unknown
+        for value in values:
+            if value in lookup:
+                found[value] = lookup[value]
+            elif value and (field, value) not in unknown:
+                missing.append(value)
+        self.counters["hits"] += len(values) - len(missing)
+        self.counters["misses"] += len(missing)
+        if missing:
+            # created since the last refresh
+            rows = models.IndexElement.objects.filter(**{"{}__in".format(field): missing})
+            with self.lock:
+                for row in rows:
+                    self.store(row)
+                    found[getattr(row, field)] = row
+                self.unknown.update((field, value) for value in missing if value not in found)
+        return found
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats["size"] = len(self.by_id)
+        stats["version"] = self.version
+        return stats
+
+
+index_elements = IndexElementCache()
@@ -0,0 +1,429 @@
+from __future__ import unicode_literals
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from servicematcher import models
+from servicematcher.metrics import get_request_tags, set_request_tags
+from servicematcher.outbox import MAX_ATTEMPTS, OutboxFlusher
+from servicematcher.benchmarks.fakes import FakeWarehouse, build_url, generate_warehouse_services
+from servicematcher.benchmarks.matcher import StressTest
+from servicematcher.prefetch import BatchPrefetcher
+from servicematcher.prematch import PrematchPipeline
+from servicematcher.sourcing import SpeculativeSourcing
+from servicematcher.taxonomy import IndexElementCache, index_elements
+from servicematcher.validation import FetchServiceSerializer, SubmitServiceSerializer, create_or_increment_smprofile
+from servicematcher.warehouse_api import (WarehouseServiceMatcherAPI, format_service_for_frontend_from_warehouse_data,
+                                          get_submit_datasource, iter_json_array)
+
+SEARCH_DATA = {
+    "city": "London",
+    "level1_id": "01000",
+    "level1": "Hair & Beauty",
+    "country": "gb",
+}
+WIZARDS = ["01000_00100_01000_00100_{:05d}".format(i) for i in range(1, 6)]
+
+
+def create_user(name):
+    User = get_user_model()
+    email = "{}@tests.local".format(name)
+    fields = {User.USERNAME_FIELD: email}
+    if User.USERNAME_FIELD != "email":
+        fields["email"] = email
+    return User.objects.create(**fields)
+
+
+class Top3(object):
+
+    def get_top3_index_elements_from_services(self, datas, level1_id, country, get_1st_match=True):
+        return [[{"wizard": "{}_00100_00100_00100_00100".format(level1_id)}] for _ in datas]
+
+
+class ScriptedWarehouse(object):
+    """
+    Gives the pages of services in the order of the script, e.g. some of them again once their lease expired
+    """
+
+    def __init__(self, pages):
+        self.pages = list(pages)
+
+    def get_batch_unmatched_service(self, country, city, category_ids=None, size=10, time_limit=None):
+        return self.pages.pop(0) if self.pages else []
+
+
+class WarehouseTestCase(TestCase):
+    """
+    Runs the warehouse api against FakeWarehouse
+    """
+
+    def setUp(self):
+        self.services = generate_warehouse_services(SEARCH_DATA["level1_id"], 250)
+        self.warehouse = FakeWarehouse(self.services)
+        self.warehouse.start()
+        self.addCleanup(self.warehouse.stop)
+        warehouse_settings = override_settings(SERVICEMATCHER_IN_TEST_MODE=False,
+                                               WAREHOUSE_HOST="127.0.0.1",
+                                               WAREHOUSE_PORT=self.warehouse.port,
+                                               BUILD_URL=build_url)
+        warehouse_settings.enable()
+        self.addCleanup(warehouse_settings.disable)
+
+
+class VenueCountsTest(WarehouseTestCase):
+
+    def test_one_deadline_for_both_counts(self):
+        self.warehouse.latency = 0.4
+        wh = WarehouseServiceMatcherAPI()
+        start = time.time()
+        # the single count endpoint does not answer a json list: the multi category count fails after 0.4s
+        with override_settings(WAREHOUSE_UNMATCHED_VENUE_COUNTS_PATH=settings.WAREHOUSE_UNMATCHED_VENUE_COUNT_PATH):
+            counts = wh.get_venue_counts(SEARCH_DATA["city"], [SEARCH_DATA["level1_id"]] * 3, deadline=0.5)
+        self.assertEqual(counts, {})
+        self.assertLess(time.time() - start, 0.75)
+
+
+class PrematchPipelineTest(WarehouseTestCase):
+
+    def get_pipeline(self, wh=None):
+        return PrematchPipeline(Top3(), wh or WarehouseServiceMatcherAPI(), SEARCH_DATA["country"],
+                                SEARCH_DATA["city"], SEARCH_DATA["level1_id"], page_size=100, concurrency=2)
+
+    def get_page(self, start, end):
+        return [format_service_for_frontend_from_warehouse_data(service, SEARCH_DATA["country"])
+                for service in self.services[start:end]]
+
+    def test_resume_interrupted_run(self):
+        report = self.get_pipeline().run(limit=150)
+        self.assertEqual(report["computed"], 150)
+        # the run was stopped long enough for its leases to expire: the warehouse gives the computed services first
+        self.warehouse.leases.clear()
+        report = self.get_pipeline().run()
+        self.assertEqual(report["computed"], 100)
+        self.assertEqual(models.ServiceCandidates.objects.count(), 250)
+
+    def test_skip_services_given_back_after_their_lease(self):
+        wh = ScriptedWarehouse([self.get_page(0, 100), self.get_page(0, 100), self.get_page(100, 200),
+                                self.get_page(0, 100), self.get_page(100, 200), self.get_page(200, 250)])
+        report = self.get_pipeline(wh).run()
+        self.assertEqual(report["computed"], 250)
+        self.assertEqual(models.ServiceCandidates.objects.count(), 250)
+
+    def test_stop_when_every_service_was_given_back(self):
+        wh = ScriptedWarehouse([self.get_page(0, 100), self.get_page(100, 200)] + [self.get_page(0, 100)] * 10)
+        report = self.get_pipeline(wh).run()
+        self.assertEqual(report["computed"], 200)
+        self.assertEqual(report["fetched"], 600)
+
+
+class IterJsonArrayTest(TestCase):
+
+    def setUp(self):
+        self.services = generate_warehouse_services(SEARCH_DATA["level1_id"], 20)
+        self.body = json.dumps(self.services).encode("utf-8")
+
+    def test_items_split_across_chunks(self):
+        for size in (1, 7, 100, len(self.body)):
+            chunks = [self.body[i:i + size] for i in range(0, len(self.body), size)]
+            self.assertEqual(list(iter_json_array(chunks)), self.services)
+
+    def test_empty_body(self):
+        self.assertEqual(list(iter_json_array([])), [])
+        self.assertEqual(list(iter_json_array([b"[]"])), [])
+
+    def test_cut_array(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_array([self.body[:-10]]))
+
+
+class OutboxWarehouse(object):
+    """
+    Rejects the uploads with a "poison" datasource, and cannot lock any service
+    """
+
+    def __init__(self):
+        self.uploads = []
+
+    def save_datasources(self, datasources):
+        self.uploads.append(datasources)
+        return not any(datasource.get("poison") for datasource in datasources)
+
+    def lock_services_matched(self, service_keys):
+        raise IOError("Connection refused")
+
+
+class OutboxFlushTest(TestCase):
+
+    def create_entry(self, service_key, poison=False, **fields):
+        return models.WarehouseOutbox.objects.create(kind=models.WarehouseOutbox.SAVE_DATA, service_key=service_key,
+                                                     datasource=json.dumps({"poison": poison}), **fields)
+
+    def test_poison_datasource_does_not_fail_the_batch(self):
+        poison = self.create_entry("service-0", poison=True)
+        self.create_entry("service-1")
+        self.create_entry("service-2")
+        lock = models.WarehouseOutbox.objects.create(kind=models.WarehouseOutbox.LOCK_SERVICE, service_key="service-3")
+        wh = OutboxWarehouse()
+        self.assertEqual(OutboxFlusher(wh).flush(), 2)
+        self.assertEqual(len(wh.uploads), 4)
+        poison.refresh_from_db()
+        lock.refresh_from_db()
+        self.assertEqual((poison.attempts, poison.sent_time), (1, None))
+        self.assertEqual(lock.attempts, 1)
+        self.assertIn("Connection refused", lock.last_error)
+
+    def test_dead_entry_stops_holding_back_its_service(self):
+        poison = self.create_entry("service-0", poison=True, attempts=MAX_ATTEMPTS - 1)
+        newer = self.create_entry("service-0")
+        flusher = OutboxFlusher(OutboxWarehouse())
+        self.assertEqual(flusher.flush(), 0)
+        poison.refresh_from_db()
+        self.assertTrue(poison.dead)
+        self.assertEqual(flusher.flush(), 1)
+        newer.refresh_from_db()
+        self.assertIsNotNone(newer.sent_time)
+
+    def test_entry_waiting_for_a_retry_holds_back_its_service(self):
+        self.create_entry("service-0", next_attempt_time=models.timezone.now() + models.timezone.timedelta(hours=1))
+        self.create_entry("service-0")
+        self.create_entry("service-1")
+        self.assertEqual(OutboxFlusher(OutboxWarehouse()).flush(), 1)
+
+
+class SubmitToWarehouseTest(TestCase):
+    """
+    What the warehouse receives for a submit, inline and through the outbox
+    """
+
+    def setUp(self):
+        self.user = create_user("matcher1")
+        self.wh = WarehouseServiceMatcherAPI()
+        self.saved = []
+        self.wh.save_data = lambda *args: self.saved.append(args) or True
+
+    def submit(self, not_enough_info, wizard, previous_match_wizard):
+        args = (not_enough_info, "service-1", "venue-1", wizard, "1000")
+        self.assertTrue(self.wh.submit_to_warehouse(*args + (self.user, previous_match_wizard)))
+        self.assertEqual(get_submit_datasource(*args + (self.user.email, previous_match_wizard))["data"],
+                         self.saved[-1][-1])
+        return self.saved[-1]
+
+    def test_agreeing_matchers(self):
+        # the wizard and the venue category id used to be swapped
+        _, _, user_email, source, data = self.submit(False, WIZARDS[0], WIZARDS[0])
+        self.assertEqual((user_email, source, data), (self.user.email, "matcher_qc", {"wizard_index": WIZARDS[0]}))
+
+    def test_disagreeing_matchers(self):
+        _, _, _, source, data = self.submit(False, WIZARDS[0], WIZARDS[1])
+        self.assertEqual((source, data["wizard_index"]), ("matcher", "01000_00100_01000_00100_00000"))
+
+    def test_not_enough_info(self):
+        # save_flagged_service used to get the email of the user instead of the user
+        _, _, user_email, source, data = self.submit(True, "", WIZARDS[0])
+        self.assertEqual(user_email, self.user.email)
+        self.assertEqual((source, data["matcher_flags"]), ("matcher", ["not_enough_info"]))
+
+
+class SpareQueues(object):
+
+    def __init__(self):
+        self.datas = []
+        self.put_event = threading.Event()
+
+    def depth(self, search_data):
+        return len(self.datas)
+
+    def pop(self, search_data, size):
+        datas, self.datas = self.datas[:size], self.datas[size:]
+        return datas
+
+    def put(self, search_data, datas):
+        self.datas += datas
+        self.put_event.set()
+
+
+class SpeculativeSourcingTest(WarehouseTestCase):
+
+    def test_keep_the_warehouse_services_when_the_claim_fails(self):
+        spare_queues = SpareQueues()
+        sourcing = SpeculativeSourcing(Top3(), WarehouseServiceMatcherAPI(), spare_queues)
+
+        def claim(size):
+            raise IOError("Connection refused")
+
+        with self.assertRaises(IOError):
+            sourcing.fetch(claim, SEARCH_DATA, SEARCH_DATA["level1_id"], 5)
+        self.assertTrue(spare_queues.put_event.wait(5))
+        self.assertEqual(len(spare_queues.datas), 5)
+
+
+class BatchPrefetcherTest(TransactionTestCase):
+    """
+    Two prefetchers sharing the database, like the ones of two processes
+    """
+
+    def setUp(self):
+        self.user = create_user("matcher1")
+        self.prepared = []
+        self.released = []
+        self.prefetchers = [BatchPrefetcher(self.prepare, self.release) for _ in range(2)]
+
+    def prepare(self, search_data, level1_id, user_id, batch_size):
+        keys = ["service-{}".format(i) for i in range(len(self.prepared) * 10, len(self.prepared) * 10 + batch_size)]
+        self.prepared.append(keys)
+        return [{"service": {"key": key}, "origin": "warehouse"} for key in keys]
+
+    def release(self, search_data, datas):
+        self.released += [data["service"]["key"] for data in datas]
+
+    def serve(self, prefetcher, requested_at):
+        datas = self.prepare(SEARCH_DATA, SEARCH_DATA["level1_id"], self.user.id, 4)
+        prefetcher.served(self.user.id, SEARCH_DATA, SEARCH_DATA["level1_id"], 4, requested_at, datas)
+        return datas
+
+    def submit_half(self, prefetcher, datas):
+        for data in datas[:2]:
+            prefetcher.submitted(self.user.id, data["service"]["key"])
+        self.wait(prefetcher)
+
+    @staticmethod
+    def wait(prefetcher):
+        prefetcher.pool.close()
+        prefetcher.pool.join()
+        prefetcher.pool = None
+
+    def test_serve_the_batch_prepared_by_another_process(self):
+        datas = self.serve(self.prefetchers[0], 1000)
+        self.submit_half(self.prefetchers[1], datas)
+        self.assertEqual(len(self.prepared), 2)
+        self.assertIsNone(self.prefetchers[0].take(self.user.id, SEARCH_DATA, 1000))
+        prepared = self.prefetchers[0].take(self.user.id, SEARCH_DATA, 2000)
+        self.assertEqual([data["service"]["key"] for data in prepared], self.prepared[1])
+        self.assertIsNone(self.prefetchers[1].take(self.user.id, SEARCH_DATA, 3000))
+
+    def test_release_the_prepared_batch_not_used(self):
+        datas = self.serve(self.prefetchers[0], 1000)
+        self.submit_half(self.prefetchers[1], datas)
+        # fetched again without the prepared batch, e.g. for another city
+        self.serve(self.prefetchers[1], 2000)
+        self.wait(self.prefetchers[1])
+        self.assertEqual(self.released, self.prepared[1])
+
+
+class LeaseStatsTest(TestCase):
+
+    def get_lease_stats(self, fetched, submitted):
+        stress_test = StressTest(services=10, lease_length=10)
+        stress_test.fetched = [(user_id, "service-1", "warehouse", fetched_time) for user_id, fetched_time in fetched]
+        stress_test.submitted = [(user_id, "service-1", submitted_time) for user_id, submitted_time in submitted]
+        return stress_test.get_lease_stats(60)
+
+    def test_claim_after_an_expired_lease(self):
+        stats = self.get_lease_stats([(1, 0), (2, 20)], [(2, 25)])
+        self.assertEqual((stats["duplicate_claims"], stats["abandoned_leases"]), (0, 1))
+
+    def test_claim_during_a_lease(self):
+        self.assertEqual(self.get_lease_stats([(1, 0), (2, 5)], [(1, 8), (2, 9)])["duplicate_claims"], 1)
+        self.assertEqual(self.get_lease_stats([(1, 0), (2, 5)], [])["duplicate_claims"], 1)
+
+    def test_claim_after_a_submit(self):
+        self.assertEqual(self.get_lease_stats([(1, 0), (2, 5)], [(1, 4)])["duplicate_claims"], 0)
+
+
+class RequestTagsTest(TestCase):
+
+    def test_unknown_country(self):
+        set_request_tags(country="x" * 200, level1_id="01000")
+        self.assertEqual(get_request_tags()["country"], "other")
+        set_request_tags(country="")
+        self.assertEqual(get_request_tags()["country"], "")
+
+
+class IndexElementCacheTest(TestCase):
+
+    def test_unknown_wizard_queried_once_until_the_refresh(self):
+        cache = IndexElementCache()
+        cache.refresh(force=True)
+        with self.assertNumQueries(1):
+            self.assertIsNone(cache.get_by_wizard(WIZARDS[0]))
+            self.assertIsNone(cache.get_by_wizard(WIZARDS[0]))
+            self.assertIsNone(cache.get_by_wizard(""))
+        models.IndexElement.objects.create(wizard=WIZARDS[0], level1_id="01000", level1="Hair & Beauty",
+                                           level2="Hair", level3="Cut", level4="Ladies", level5="Cut")
+        cache.refresh(force=True)
+        self.assertEqual(cache.get_by_wizard(WIZARDS[0]).level1_id, "01000")
+
+
+class SaveMatchTest(TestCase):
+
+    def setUp(self):
+        self.users = [create_user("matcher1"), create_user("matcher2")]
+        models.IndexElement.objects.bulk_create([
+            models.IndexElement(wizard=wizard, level1_id="01000", level1="Hair & Beauty", level2="Hair",
+                                level3="Cut", level4="Ladies", level5="Cut {}".format(i))
+            for i, wizard in enumerate(WIZARDS)
+        ])
+        # the submit reads the index elements from the process cache
+        index_elements.refresh(force=True)
+
+    def save(self, user, service_key, negatives):
+        return SubmitServiceSerializer().save_match_to_sql(
+            {"key": "venue-1", "name": "Salon", "category_id": "1000", "category_name": "Hair", "is_chain": -1},
+            {"key": service_key, "description": "Ladies cut", "category": "Hair"},
+            SEARCH_DATA,
+            {
+                "matched_index_element_id": WIZARDS[0],
+                "unmatched_index_element_ids": WIZARDS[1:1 + negatives],
+                "used_search": False,
+                "wizard": WIZARDS[0],
+                "not_enough_info": False,
+                "time_spent": "5000",
+                "search_string": "",
+            },
+            user,
+        )
+
+    def test_first_match_query_count(self):
+        self.save(self.users[0], "service-0", 1)
+        # the venue, the service and its savepoint, the session and profile counters, the match, its negatives,
+        # and the savepoint of the transaction
+        with self.assertNumQueries(12):
+            self.save(self.users[0], "service-1", 1)
+
+    def test_query_count_does_not_depend_on_negatives(self):
+        self.save(self.users[0], "service-0", 1)
+        with self.assertNumQueries(12):
+            self.save(self.users[0], "service-1", 4)
+
+    def test_second_match_query_count(self):
+        self.save(self.users[0], "service-1", 2)
+        self.save(self.users[1], "service-0", 2)
+        # the service is known: flagged as matched twice and its 1st match read instead of created
+        with self.assertNumQueries(11):
+            previous_match_wizard = self.save(self.users[1], "service-1", 2)
+        self.assertEqual(previous_match_wizard, WIZARDS[0])
+        self.assertFalse(models.Service.objects.get(wh_key="service-1").waiting_2nd_match)
+
+    def claim(self, user, size):
+        return FetchServiceSerializer().get_batch_unmatch_service(SEARCH_DATA["country"], SEARCH_DATA["level1_id"],
+                                                                  user.id, size)
+
+    def test_claim_query_count_does_not_depend_on_the_batch(self):
+        for i in range(6):
+            self.save(self.users[0], "service-{}".format(i), 1)
+        # the savepoint, the candidates, their lease, the leased ones and their 1st matches
+        with self.assertNumQueries(6):
+            self.assertEqual(len(self.claim(self.users[1], 2)), 2)
+        with self.assertNumQueries(6):
+            self.assertEqual(len(self.claim(self.users[1], 4)), 4)
+        # every service is leased
+        self.assertEqual(self.claim(self.users[1], 4), [])
+
+    def test_profile_counter(self):
+        create_or_increment_smprofile(self.users[0])
+        create_or_increment_smprofile(self.users[0])
+        self.assertEqual(models.ServiceMatcherProfile.objects.get(user=self.users[0]).general_counter, 2)
@@ -7,4 +7,5 @@ urlpatterns = [
     url(r'^fetch_batch', views.FetchBatchService.as_view()),
     url(r'^submit', views.SubmitService.as_view()),
     url(r'^index_elements', views.SearchService.as_view()),
+    url(r'^metrics', views.MetricsView.as_view()),
 ]
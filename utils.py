@@ -1,8 +1,13 @@
 import logging
-from datetime import datetime
-import time
+from unidecode import unidecode
+from servicematcher.cache import LRUCache
 from servicematcher.mappings import warehouse_category_id_level1_wizard
 
+TRANSLITERATION_CACHE_SIZE = 50000
+transliterations = LRUCache(max_size=TRANSLITERATION_CACHE_SIZE)
+# not locked, a lost increment under concurrency only makes the stats approximate
+transliteration_counters = {"ascii": 0}
+
 
 def get_logging(logger_name):
     logging.basicConfig()
@@ -11,11 +16,33 @@ def get_logging(logger_name):
     return log
 
 
-def get_unix_time():
-    current_time = str(datetime.utcnow())
-    ts, ms = current_time.split('.')
-    dt = datetime.strptime(ts, '%Y-%m-%d %H:%M:%S')
-    return int(time.mktime(dt.timetuple()) * 1000) + int(ms[:3])
+def transliterate(text):
+    """
+    unidecode, skipping the strings already in ascii and caching the others, as the same venue names
+    and categories come back in every batch of a city
+    :param text: str,
+    :return: str, in ascii
+    """
+    try:
+        text.encode("ascii")
+        transliteration_counters["ascii"] += 1
+        return text
+    except UnicodeError:
+        pass
+    ascii_text = transliterations.get(text)
+    if ascii_text is None:
+        ascii_text = unidecode(text)
+        transliterations.set(text, ascii_text)
+    return ascii_text
+
+
+def get_transliteration_stats():
+    """
+    :return: dict, size and hit ratio of the cache, and the number of strings already in ascii
+    """
+    stats = transliterations.stats()
+    stats["ascii"] = transliteration_counters["ascii"]
+    return stats
 
 
 def get_wizard_for_wh(venue_category_id, wizard="", previous_match_wizard=""):
@@ -1,11 +1,15 @@
 from collections import namedtuple
 from datetime import datetime, timedelta
+import uuid
 
 from rest_framework import serializers
-from django.db import transaction
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
 from django.conf import settings
 
 from servicematcher import models
+from servicematcher import outbox
+from servicematcher.taxonomy import index_elements as index_element_cache
 from utils import get_logging
 
 
@@ -63,20 +67,48 @@ class FetchServiceSerializer(serializers.Serializer):
             else:
                 query_before = (datetime.utcnow() - timedelta(hours=1)).strftime("%Y-%m-%d %H:%M:%S")
 
-            matchs = models.Match.objects\
-                .all()\
-                .exclude(user__id=user_id)\
-                .filter(service__search_country=country)\
-                .filter(service__search_level1_id=level1_id)\
-                .filter(service__waiting_2nd_match=True)\
-                .filter(service__last_fetch_date__lte=query_before)
-
-            matchs = matchs[:size]
-            fetched_service_keys = [match.service.id for match in matchs]
+            services = models.Service.objects\
+                .filter(search_country=country)\
+                .filter(search_level1_id=level1_id)\
+                .filter(waiting_2nd_match=True)\
+                .filter(last_fetch_date__lte=query_before)\
+                .exclude(pk__in=models.Match.objects.filter(user__id=user_id).values("service_id"))
+            skip_locked = connection.features.has_select_for_update_skip_locked
+            if skip_locked:
+                # the services being claimed by another matcher are skipped instead of waited for
+                services = services.select_for_update(skip_locked=True)
+            fetched_service_keys = list(services.values_list("pk", flat=True)[:size])
+            if not fetched_service_keys:
+                return []
+
+            if skip_locked:
+                models.Service.objects\
+                    .filter(pk__in=fetched_service_keys)\
+                    .update(last_fetch_date=current_time)
+            else:
+                # without row locks, lease the services still free with one compare-and-set and keep the ones
+                # carrying the token of this call: current_time has a 1 second resolution, 2 claims in the same
+                # second can't be told apart by it
+                claim_token = uuid.uuid4().hex
+                models.Service.objects\
+                    .filter(pk__in=fetched_service_keys)\
+                    .filter(last_fetch_date__lte=query_before)\
+                    .update(last_fetch_date=current_time, claim_token=claim_token)
+                fetched_service_keys = list(models.Service.objects
+                                            .filter(pk__in=fetched_service_keys)
+                                            .filter(claim_token=claim_token)
+                                            .values_list("pk", flat=True))
+                if not fetched_service_keys:
+                    return []
 
-            models.Service.objects\
-                .filter(pk__in=fetched_service_keys)\
-                .update(last_fetch_date=current_time)
+            matchs = models.Match.objects\
+                .select_related("service__venue", "match_index")\
+                .filter(service__pk__in=fetched_service_keys)\
+                .order_by("id")
+            first_matchs = {}
+            for match in matchs:
+                first_matchs.setdefault(match.service_id, match)
+            matchs = list(first_matchs.values())
 
         if not matchs:
             return []
@@ -136,7 +168,8 @@ class SubmitServiceSerializer(serializers.Serializer):
     search_data = InitialSearchSerializer()
     match_data = MatchDataSerializer()
 
-    def save_match_to_sql(self, venue_dict, service_dict, search_data_dict, match_data_dict, user):
+    def save_match_to_sql(self, venue_dict, service_dict, search_data_dict, match_data_dict, user,
+                          warehouse_outbox=False):
         with transaction.atomic():
             log.info("START saving to sql")
             venue = get_or_create_venue(venue_dict)
@@ -144,69 +177,88 @@ class SubmitServiceSerializer(serializers.Serializer):
             session = update_or_create_session(user)
             create_or_increment_smprofile(user)
             create_match(service, session, user, match_data_dict)
+            if warehouse_outbox:
+                # sent to the warehouse by outbox.OutboxFlusher once the match is committed
+                outbox.enqueue_submit(match_data_dict["not_enough_info"],
+                                      service_dict["key"],
+                                      venue_dict["key"],
+                                      match_data_dict["wizard"],
+                                      venue_dict["category_id"],
+                                      user.email,
+                                      previous_match_wizard)
             log.info("STOP saving to sql")
         return previous_match_wizard
 
 
 def get_or_create_venue(venue_dict):
-    try:
-        venue = models.Venue.objects.get(wh_key=venue_dict["key"])
-    except models.Venue.DoesNotExist:
-        venue = models.Venue.objects.create(
-            wh_key=venue_dict["key"],
-            category_id=venue_dict["category_id"],
-            category_name=venue_dict["category_name"],
-            name=venue_dict["name"],
-            is_chain=venue_dict["is_chain"],
-        )
+    venue, _ = models.Venue.objects.get_or_create(
+        wh_key=venue_dict["key"],
+        defaults={
+            "category_id": venue_dict["category_id"],
+            "category_name": venue_dict["category_name"],
+            "name": venue_dict["name"],
+            "is_chain": venue_dict["is_chain"],
+        },
+    )
     log.info("Saved the venue")
     return venue
 
 
 def get_or_create_service(venue, service_dict, search_data):
-    try:
-        service = models.Service.objects.get(wh_key=service_dict["key"])
+    service, created = models.Service.objects.get_or_create(
+        wh_key=service_dict["key"],
+        defaults={
+            "venue": venue,
+            "description": service_dict["description"],
+            "category": service_dict["category"],
+            "search_level1_id": search_data["level1_id"],
+            "search_level1": search_data["level1"],
+            "search_city": search_data["city"],
+            "search_country": search_data["country"],
+            "waiting_2nd_match": True,
+            "last_fetch_date": "2011-11-11 11:11:11",
+        },
+    )
+    previous_match_wizard = None
+    if not created:
         service.waiting_2nd_match = False
-        service.save()
-        previous_match = service.match_set.all()[0]
-        previous_match_wizard = previous_match.match_index.wizard
-    except models.Service.DoesNotExist:
-        service = models.Service.objects.create(
-            venue=venue,
-            description=service_dict["description"],
-            category=service_dict["category"],
-            wh_key=service_dict["key"],
-            search_level1_id=search_data["level1_id"],
-            search_level1=search_data["level1"],
-            search_city=search_data["city"],
-            search_country=search_data["country"],
-            waiting_2nd_match=True,
-            last_fetch_date="2011-11-11 11:11:11",
-        )
-        previous_match_wizard = None
+        models.Service.objects.filter(pk=service.pk).update(waiting_2nd_match=False)
+        previous_match_wizard = models.Match.objects\
+            .filter(service=service)\
+            .order_by("id")\
+            .values_list("match_index__wizard", flat=True)\
+            .first()
     log.info("Saved the service")
     return service, previous_match_wizard
 
 
 def update_or_create_session(user):
-    try:
-        one_hour_before = models.timezone.now() - models.timezone.timedelta(hours=1)
-        session = models.SessionMetric.objects \
-            .filter(user=user) \
-            .filter(end_time__gt=one_hour_before)[0]
-    except IndexError:
-        session = models.SessionMetric.objects.create(user=user)
-    session.set_end_time()
+    one_hour_before = models.timezone.now() - models.timezone.timedelta(hours=1)
+    session = models.SessionMetric.objects \
+        .filter(user=user) \
+        .filter(end_time__gt=one_hour_before) \
+        .order_by("-end_time") \
+        .first()
+    if session is None:
+        session = models.SessionMetric.objects.create(user=user, match_counter=1)
+    else:
+        models.SessionMetric.objects\
+            .filter(pk=session.pk)\
+            .update(match_counter=F("match_counter") + 1, end_time=models.timezone.now())
     log.info("Saved the session")
     return session
 
 
 def create_or_increment_smprofile(user):
-    try:
-        profile = models.ServiceMatcherProfile.objects.get(user=user)
-    except models.ServiceMatcherProfile.DoesNotExist:
-        profile = models.ServiceMatcherProfile.objects.create(user=user)
-    profile.increment()
+    profiles = models.ServiceMatcherProfile.objects.filter(user=user)
+    updated = profiles.update(general_counter=F("general_counter") + 1)
+    if not updated:
+        try:
+            with transaction.atomic():
+                models.ServiceMatcherProfile.objects.create(user=user, general_counter=1)
+        except IntegrityError:
+            # created by a concurrent 1st submit of the same user
+            profiles.update(general_counter=F("general_counter") + 1)
     log.info("Saved the profile")
 
 
@@ -214,14 +266,21 @@ def create_match(service, session, user, match_data):
     not_enough_info = match_data["not_enough_info"]
     if not_enough_info:
         wizard = "00000_00000_00000_00000_00000"
-        service.waiting_2nd_match=False
-        service.save()
+        service.waiting_2nd_match = False
+        models.Service.objects.filter(pk=service.pk).update(waiting_2nd_match=False)
     else:
         wizard = match_data["wizard"]
-    index_element = models.IndexElement.objects.filter(wizard=wizard).get()
+    negative_wizards = []
+    for negative_wizard in match_data["unmatched_index_element_ids"]:
+        if negative_wizard not in negative_wizards:
+            negative_wizards.append(negative_wizard)
+    index_elements = index_element_cache.get_by_wizards([wizard] + negative_wizards)
+    missing_wizards = [w for w in [wizard] + negative_wizards if w not in index_elements]
+    if missing_wizards:
+        raise models.IndexElement.DoesNotExist("No index element for the wizards {}".format(missing_wizards))
     match = models.Match.objects.create(
         service=service,
-        match_index=index_element,
+        match_index=index_elements[wizard],
         not_enough_info=match_data["not_enough_info"],
         used_search=match_data["used_search"],
         time_spent=match_data["time_spent"],
@@ -230,8 +289,9 @@ def create_match(service, session, user, match_data):
         match_backend_version=MATCH_BACKEND_VERSION,
         search_string=match_data["search_string"],
     )
-    for wizard in match_data["unmatched_index_element_ids"]:
-        index_element = models.IndexElement.objects.get(wizard=wizard)
-        match.negative_index.add(index_element)
-    match.save()
+    NegativeIndex = models.Match.negative_index.through
+    NegativeIndex.objects.bulk_create([
+        NegativeIndex(match_id=match.pk, indexelement_id=index_elements[negative_wizard].pk)
+        for negative_wizard in negative_wizards
+    ])
     log.info("Saved the match")
@@ -2,25 +2,69 @@ from __future__ import unicode_literals
 
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.permissions import IsAuthenticated
 from rest_framework.decorators import permission_classes
+from django.conf import settings
+from django.http import HttpResponse
 
 from servicematcher.warehouse_api import WarehouseServiceMatcherAPI
 from servicematcher.elastic_api import ElasticServices
+from servicematcher.ready_queue import ReadyQueues
+from servicematcher.outbox import OutboxFlusher
+from servicematcher.taxonomy import index_elements
+from servicematcher.sourcing import SpeculativeSourcing, add_candidates
+from servicematcher.prefetch import BatchPrefetcher, release_leases
+from servicematcher.batch_sizing import BatchSizer
+from servicematcher.metrics import CanReadMetrics, registry, set_request_tags, span, timed_handler
+from servicematcher.profiling import profiled
+from servicematcher import outbox
 from servicematcher import validation
 from servicematcher.mappings import level1_to_warehouse_category_id, level1s, level1_to_level1_id
-from servicematcher.utils import get_logging, get_unix_time
+from servicematcher.utils import get_logging, get_transliteration_stats
 
 
 log = get_logging(__name__)
 es = ElasticServices()
 wh = WarehouseServiceMatcherAPI()
+ready_queues = ReadyQueues(es, wh) if getattr(settings, "SERVICEMATCHER_READY_QUEUE", False) else None
+# "sequential": SQL, then the ready queue, then the warehouse, then the top3s
+# "speculative": the warehouse and its top3s at the same time as SQL, see sourcing.SpeculativeSourcing
+FETCH_MODE = getattr(settings, "SERVICEMATCHER_FETCH_MODE", "sequential")
+# Prepare the next batch of every matcher while they match the current one, see prefetch.BatchPrefetcher
+PREFETCH = getattr(settings, "SERVICEMATCHER_PREFETCH", False)
+# Where the leased warehouse services not used yet wait for the next fetch_batch, only refilled with the ready queue.
+# Only the speculative fetch and the prefetch leave services unused, None without them and the ready queue
+spare_queues = ready_queues
+if spare_queues is None and (FETCH_MODE == "speculative" or PREFETCH):
+    spare_queues = ReadyQueues(es, wh, low_watermark=0, high_watermark=0)
+# Where the services waiting for their 2nd match are claimed: "sql" or "elastic"
+SECOND_MATCH_SOURCE = getattr(settings, "SERVICEMATCHER_SECOND_MATCH_SOURCE", "sql")
+# Send the matches to the warehouse in the background instead of during the submit
+WAREHOUSE_OUTBOX = getattr(settings, "SERVICEMATCHER_WAREHOUSE_OUTBOX", False)
+outbox_flusher = OutboxFlusher(wh) if WAREHOUSE_OUTBOX else None
+if outbox_flusher is not None:
+    # also sends the backlog left by the previous run without waiting for a submit
+    outbox_flusher.start()
+sourcing = SpeculativeSourcing(es, wh, spare_queues) if FETCH_MODE == "speculative" else None
+batch_sizer = BatchSizer()
+
+registry.register_collector("servicematcher_top3_cache", es.top3_cache.stats)
+registry.register_collector("servicematcher_autocomplete_cache", es.autocomplete_cache.stats)
+registry.register_collector("servicematcher_index_elements_cache", index_elements.stats)
+registry.register_collector("servicematcher_transliteration_cache", get_transliteration_stats)
+registry.register_collector("servicematcher_batch_sizer", batch_sizer.stats)
+if ready_queues is not None:
+    registry.register_collector("servicematcher_ready_queue", ready_queues.stats)
+if outbox_flusher is not None:
+    registry.register_collector("servicematcher_warehouse_outbox", outbox.get_backlog)
 
 
 @permission_classes((IsAuthenticated,))
 class FetchBusinessType(APIView):
     serializer_class = validation.FetchBusinessTypeSerializer
 
+    @timed_handler("business_types")
+    @profiled("business_types")
     def get(self, request):
         """
         The matcher logs in the servicematcher - automatic request for the level1s and count per city
@@ -30,96 +74,159 @@ class FetchBusinessType(APIView):
         payload = serializer.validated_data
 
         city = payload["city"]
+        with span("warehouse"):
+            counts = wh.get_venue_counts(city, [level1["id"] for level1 in level1s])
+        business_types = [dict(level1) for level1 in level1s]
         total = 0
-        for level1 in level1s:
-            try:
-                count = wh.get_venue_count(city, level1["id"])
-                level1["venue_count"] = count
+        for level1 in business_types:
+            count = counts.get(level1["id"], -1)
+            level1["venue_count"] = count
+            if count > 0:
                 total += count
-            except:
-                level1["venue_count"] = -1
-        level1s[-1]["venue_count"] = total
+        business_types[-1]["venue_count"] = total
         log.info("Returning business types")
-        return Response(level1s)
+        return Response(business_types)
 
 
 @permission_classes((IsAuthenticated,))
 class FetchBatchService(APIView):
     serializer_class = validation.FetchServiceSerializer
 
+    @timed_handler("fetch_batch")
+    @profiled("fetch_batch")
     def post(self, request):
         """
         New function to make the fetch quicker with batch of services
         """
+        # the matcher submits only after a fetch_batch, the index elements are loaded meanwhile
+        index_elements.warm_up()
         serializer = self.serializer_class(data=request.data)
         serializer.is_valid(raise_exception=True)
         payload = serializer.validated_data
-        batch_size = payload["batch_size"]
         search_data = payload["search_data"]
         level1_id = level1_to_level1_id[search_data['level1']]
+        set_request_tags(country=search_data['country'], level1_id=level1_id)
+        batch_size, sizing_mode = batch_sizer.get_batch_size(request.user.id, payload["batch_size"])
 
-        log.info("START fetching batch of size {} from SQL".format(batch_size))
-        time = get_unix_time()
-        datas = serializer.get_batch_unmatch_service(
-            search_data['country'],
-            level1_id=level1_id,
-            user_id=request.user.id,
-            size=batch_size,
-        )
-        log.info("STOP fetching SQL. It took: {}ms to find {} services".format(get_unix_time() - time, len(datas)))
-
-        # log.info("START fetching batch of size {} from elastic".format(batch_size))
-        # time = get_unix_time()
-        # datas = es.get_batch_unmatched_service(
-        #     search_data['country'],
-        #     level1_id=level1_id,
-        #     user_id=request.user.id,
-        #     size=batch_size,
-        # )
-        # log.info("STOP fetching elastic. It took: {}ms to find {} services".format(get_unix_time() - time, len(datas)))
-        #
-        if len(datas) < batch_size:
-            batch_size -= len(datas)
-            log.info("START fetching batch of size {} from the Warehouse".format(batch_size))
-            time = get_unix_time()
-            wh_datas = wh.get_batch_unmatched_service(
-                search_data['country'],
-                search_data['city'],
-                category_ids=level1_to_warehouse_category_id[search_data['level1_id']],
-                size=batch_size,
-            )
-            log.info("STOP fetching the Warehouse. It took: {}ms to find {} services".format(
-                get_unix_time() - time,
-                len(wh_datas))
-            )
-            datas += wh_datas
+        datas = None
+        if prefetcher is not None:
+            datas = prefetcher.take(request.user.id, search_data, payload["requested_at"])
+        if datas is None:
+            datas = prepare_batch(search_data, level1_id, request.user.id, batch_size, serializer)
+        if prefetcher is not None:
+            prefetcher.served(request.user.id, search_data, level1_id, payload["batch_size"], payload["requested_at"],
+                              datas)
+        batch_sizer.served(request.user.id, datas, sizing_mode)
 
         if not datas:
             log.info("No batch service were found in SQL or in the warehouse")
             return Response("No batch service were found in SQL or in the warehouse")
 
-        # Get the top3 match from the corresponding service
-        log.info("START fetching top3 from batch of size {}".format(len(datas)))
-        time = get_unix_time()
         for data in datas:
-            hits = es.get_top3_index_elements_from_service(data, level1_id, search_data['country'])
-            data["index_elements"] = hits
             data["search_data"] = search_data
-        log.info("STOP fetching top3 from batch. It took: {total}ms or {average}ms/service".format(
-            total=get_unix_time() - time,
-            average=(get_unix_time() - time)/float(len(datas)))
-        )
         res = {
             "requested_at": payload["requested_at"],
+            "batch_size": batch_size,
             "results": datas,
         }
         return Response(res)
 
+    @staticmethod
+    def claim(serializer, country, level1_id, user_id, size):
+        """
+        :return: list of dict, services waiting for their 2nd match, leased for this matcher
+        """
+        if SECOND_MATCH_SOURCE == "elastic":
+            with span("elastic") as s:
+                datas = es.get_batch_unmatched_service(
+                    country,
+                    level1_id=level1_id,
+                    user_id=user_id,
+                    size=size,
+                )
+            log.info("Fetching elastic took: {}ms to find {} services".format(s.ms, len(datas)))
+        else:
+            with span("sql") as s:
+                datas = serializer.get_batch_unmatch_service(
+                    country,
+                    level1_id=level1_id,
+                    user_id=user_id,
+                    size=size,
+                )
+            log.info("Fetching SQL took: {}ms to find {} services".format(s.ms, len(datas)))
+        return datas
+
+    @staticmethod
+    def fetch(claim, search_data, level1_id, batch_size):
+        """
+        :return: list of dict, services with their "index_elements", from SQL, the ready queue and the warehouse
+        """
+        datas = claim(batch_size)
+
+        if spare_queues is not None and len(datas) < batch_size:
+            queued_datas = spare_queues.pop(search_data, batch_size - len(datas))
+            log.info("Took {} services from the ready queue".format(len(queued_datas)))
+            datas += queued_datas
+
+        if len(datas) < batch_size:
+            batch_size -= len(datas)
+            with span("warehouse") as s:
+                wh_datas = wh.get_batch_unmatched_service(
+                    search_data['country'],
+                    search_data['city'],
+                    category_ids=level1_to_warehouse_category_id[search_data['level1_id']],
+                    size=batch_size,
+                )
+            log.info("Fetching the Warehouse took: {}ms to find {} services".format(s.ms, len(wh_datas)))
+            datas += wh_datas
+
+        # Get the top3 match from the corresponding service
+        # the services from the ready queue already have theirs, the ones from the warehouse may have been prematched
+        if datas:
+            add_candidates(es, datas, level1_id, search_data['country'])
+        return datas
+
+
+def prepare_batch(search_data, level1_id, user_id, batch_size, serializer=None):
+    """
+    :return: list of dict, services with their "index_elements", claimed for the user
+    """
+    if serializer is None:
+        serializer = validation.FetchServiceSerializer()
+
+    def claim(size):
+        return FetchBatchService.claim(serializer, search_data['country'], level1_id, user_id, size)
+
+    if sourcing is not None:
+        return sourcing.fetch(claim, search_data, level1_id, batch_size)
+    return FetchBatchService.fetch(claim, search_data, level1_id, batch_size)
+
+
+def prefetch_batch(search_data, level1_id, user_id, requested_size):
+    """
+    :param requested_size: int, the batch_size sent by the frontend with the current batch
+    :return: list of dict, the next batch of the user
+    """
+    # sized like the fetch_batch it replaces, the pace of the matcher may have changed since the current batch
+    batch_size, _ = batch_sizer.get_batch_size(user_id, requested_size)
+    return prepare_batch(search_data, level1_id, user_id, batch_size)
+
+
+def release_batch(search_data, datas):
+    release_leases(es, spare_queues, search_data, datas)
+
+
+prefetcher = BatchPrefetcher(prefetch_batch, release_batch) if PREFETCH else None
+if prefetcher is not None:
+    registry.register_collector("servicematcher_prefetch", prefetcher.stats)
+
 
 @permission_classes((IsAuthenticated,))
 class SearchService(APIView):
     serializer_class = validation.SearchServiceSerializer
 
+    @timed_handler("index_elements")
+    @profiled("index_elements")
     def get(self, request):
         """
         The matcher uses the search box in the frontend to search for an index_element
@@ -130,13 +237,15 @@ class SearchService(APIView):
         level1_id = level1_to_level1_id[payload['level1']]
         range_size = payload['range_size']
         skip = payload['skip']
-        hits = es.autocompleter(
-            payload['country'],
-            payload['search_string'],
-            range_size,
-            skip,
-            level1_id=level1_id
-        )
+        set_request_tags(country=payload['country'], level1_id=level1_id)
+        with span("elastic"):
+            hits = es.autocompleter(
+                payload['country'],
+                payload['search_string'],
+                range_size,
+                skip,
+                level1_id=level1_id
+            )
         res = {
             "index_elements": hits,
             "range_size": range_size,
@@ -150,6 +259,8 @@ class SearchService(APIView):
 class SubmitService(APIView):
     serializer_class = validation.SubmitServiceSerializer
 
+    @timed_handler("submit")
+    @profiled("submit")
     def post(self, request):
         """
         The matcher sends data back to save in the database
@@ -161,28 +272,58 @@ class SubmitService(APIView):
         venue = payload["venue"]
         match_data = payload["match_data"]
         user = request.user
+        # the level1 of a known index element, the wizard comes from the client
+        index_element = index_elements.get_by_wizard(match_data["wizard"]) if match_data["wizard"] else None
+        set_request_tags(country=payload["country"], level1_id=index_element.level1_id if index_element else "")
 
         # Save to SQL DB
-        previous_match_wizard = serializer.save_match_to_sql(venue,
-                                                             service,
-                                                             payload["search_data"],
-                                                             match_data,
-                                                             user)
+        with span("sql"):
+            previous_match_wizard = serializer.save_match_to_sql(venue,
+                                                                 service,
+                                                                 payload["search_data"],
+                                                                 match_data,
+                                                                 user,
+                                                                 warehouse_outbox=WAREHOUSE_OUTBOX)
         # Save to elastic
-        es.save_service(service, venue, user, payload["country"],
-                        matched_index_element_id=match_data["matched_index_element_id"],
-                        unmatched_index_element_ids=match_data["unmatched_index_element_ids"],
-                        time_spent=match_data["time_spent"],
-                        used_search=match_data["used_search"],
-                        not_enough_info=match_data["not_enough_info"])
+        # with the elastic queue, only the 1st match is flagged to be fetched by a 2nd matcher
+        check_flag = SECOND_MATCH_SOURCE == "elastic" and previous_match_wizard is None
+        with span("elastic"):
+            es.save_service(service, venue, user, payload["country"],
+                            matched_index_element_id=match_data["matched_index_element_id"],
+                            unmatched_index_element_ids=match_data["unmatched_index_element_ids"],
+                            time_spent=match_data["time_spent"],
+                            used_search=match_data["used_search"],
+                            not_enough_info=match_data["not_enough_info"],
+                            check_flag=check_flag)
+            if "elastic_service_id" in service and "elastic_index_element_id" in service:
+                # 2nd matcher - the 1st match can't be fetched anymore
+                es.update_1st_match_flag(service["elastic_service_id"], service["elastic_index_element_id"], payload["country"])
+        batch_sizer.submitted(user.id, service["key"])
+        if prefetcher is not None:
+            prefetcher.submitted(user.id, service["key"])
         # Save to warehouse
-        return wh.submit_to_warehouse(match_data["not_enough_info"],
-                                      service["key"],
-                                      venue["key"],
-                                      match_data["wizard"],
-                                      venue["category_id"],
-                                      user,
-                                      previous_match_wizard)
+        if outbox_flusher is not None:
+            rep = "Service {} queued for the warehouse".format(service["key"])
+            log.info(rep)
+            return Response(rep)
+        with span("warehouse"):
+            return wh.submit_to_warehouse(match_data["not_enough_info"],
+                                          service["key"],
+                                          venue["key"],
+                                          match_data["wizard"],
+                                          venue["category_id"],
+                                          user,
+                                          previous_match_wizard)
+
+
+@permission_classes((CanReadMetrics,))
+class MetricsView(APIView):
+
+    def get(self, request):
+        """
+        Latency histograms, request counters and cache stats, scraped by Prometheus
+        """
+        return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4")
 
 
 
@@ -1,17 +1,47 @@
 from __future__ import unicode_literals
+import codecs
+import gzip
 import json
-from unidecode import unidecode
+import threading
+import time
+from decimal import Decimal
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
 
 from rest_framework.response import Response
 from django.conf import settings
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 from backend.models import get_token
-from servicematcher.utils import get_logging, get_wizard_for_wh
+from servicematcher.utils import get_logging, get_wizard_for_wh, transliterate
 from servicematcher.mappings import id_to_industry, level1_to_warehouse_category_id
 
 log = get_logging(__name__)
 
+VENUE_COUNT_WORKERS = getattr(settings, "WAREHOUSE_VENUE_COUNT_WORKERS", 4)
+VENUE_COUNT_DEADLINE = getattr(settings, "WAREHOUSE_VENUE_COUNT_DEADLINE", 2)
+POOL_SIZE = getattr(settings, "WAREHOUSE_POOL_SIZE", 10)
+GET_RETRIES = getattr(settings, "WAREHOUSE_GET_RETRIES", 2)
+RETRY_BACKOFF = getattr(settings, "WAREHOUSE_RETRY_BACKOFF", 0.2)
+GZIP_UPLOADS = getattr(settings, "WAREHOUSE_GZIP_UPLOADS", False)
+# (connect, read) timeouts in seconds of every endpoint
+TIMEOUTS = {
+    "venue_count": (0.5, 1),
+    "unmatched_services": (1, 60),
+    "upload": (1, 60),
+    "lock_service": (1, 60),
+}
+TIMEOUTS.update(getattr(settings, "WAREHOUSE_TIMEOUTS", {}))
+# Bytes read at once from the batches of unmatched services
+STREAM_CHUNK_SIZE = 8192
+
 
 def format_service_for_frontend_from_warehouse_data(data_from_wh, country):
     """
@@ -31,14 +61,14 @@ def format_service_for_frontend_from_warehouse_data(data_from_wh, country):
             venue_category = ""
     data = {
         "service": {
-            "description": unidecode(data_from_wh.get("description", "")),
-            "category": unidecode(data_from_wh.get("category", "")),
+            "description": transliterate(data_from_wh.get("description", "")),
+            "category": transliterate(data_from_wh.get("category", "")),
             "key": data_from_wh["key"],
         },
         "venue": {
-            "category_name": unidecode(venue_category),
+            "category_name": transliterate(venue_category),
             "category_id": venue_category_id,
-            "name": unidecode(data_from_wh.get("venue_name", "")),
+            "name": transliterate(data_from_wh.get("venue_name", "")),
             "key": data_from_wh["subdomain"],
         },
         "origin": "warehouse",
@@ -46,10 +76,198 @@ def format_service_for_frontend_from_warehouse_data(data_from_wh, country):
     return data
 
 
+def gzip_data(data):
+    """
+    :param data: str, body of a request
+    :return: bytes, gzipped body
+    """
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def convert_decimals(value):
+    """
+    ijson gives the numbers with a fraction as Decimal, json as float
+    :param value: an item of a json array parsed by ijson
+    :return: the item with floats instead of Decimals
+    """
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, dict):
+        return dict((key, convert_decimals(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [convert_decimals(item) for item in value]
+    return value
+
+
+def iter_json_array(chunks):
+    """
+    Parse a json array while its chunks are received, without ijson
+    :param chunks: iterable of bytes, utf-8 encoded
+    :return: generator of the items of the array, nothing for an empty body, ValueError if the array is cut
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = 0
+    started = False
+    for chunk in chunks:
+        buffer = buffer[position:] + text_decoder.decode(chunk)
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n" + ("," if started else ""):
+                position += 1
+            if position == len(buffer):
+                break
+            if not started:
+                if buffer[position] != "[":
+                    raise ValueError("Expected a json array")
+                started = True
+                position += 1
+                continue
+            if buffer[position] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # the item is not received to its end yet
+                break
+            if end == len(buffer):
+                # a number could go on in the next chunk
+                break
+            position = end
+            yield item
+    buffer = buffer[position:] + text_decoder.decode(b"", True)
+    if started or buffer.strip():
+        raise ValueError("The json array was cut")
+
+
+def format_datasource_for_warehouse(service_key, venue_key, user_email, source, data):
+    """
+    :param service_key: str,
+    :param venue_key: str,
+    :param user_email: str,
+    :param source: str, the ref for warehouse
+    :param data: dict, the data of the datasource
+    :return: dict, datasource for warehouse
+    """
+    datasource = {
+        'source': source,
+        'source_ref': user_email,
+        'data': data,
+        'informs': [service_key, venue_key],  # venu_key -> GUID ? GUID is more robust, key can be deleted
+        'data_kind': 'service'
+    }
+    return datasource
+
+
+def get_matched_service_data(venue_category_id, wizard, previous_match_wizard):
+    """
+    :param venue_category_id: int,
+    :param wizard: str, the wizard found by the 2nd matcher
+    :param previous_match_wizard: str, the wizard found by the 1st matcher
+    :return: tuple, source and data of the datasource
+    """
+    if wizard != previous_match_wizard:
+        # The two juniors don't agree
+        source = "matcher"
+    else:
+        # The two juniors agree
+        source = "matcher_qc"
+    data = {
+        "wizard_index": get_wizard_for_wh(venue_category_id, wizard, previous_match_wizard)
+    }
+    return source, data
+
+
+def get_flagged_service_data(venue_category_id):
+    """
+    :param venue_category_id: int,
+    :return: tuple, source and data of the datasource
+    """
+    source = "matcher"
+    # if the flag is chosen, we match to a level1 in the warehouse with the flag
+    data = {
+        "matcher_flags": ["not_enough_info"],
+        "wizard_index": get_wizard_for_wh(venue_category_id),
+    }
+    return source, data
+
+
+def get_submit_datasource(not_enough_info, service_key, venue_key, wizard, venue_category_id, user_email,
+                          previous_match_wizard):
+    """
+    What submit_to_warehouse sends, without sending it
+    :return: dict or None, the datasource to save, None if the service only has to be locked
+    """
+    if not_enough_info:
+        source, data = get_flagged_service_data(venue_category_id)
+    elif previous_match_wizard:
+        source, data = get_matched_service_data(venue_category_id, wizard, previous_match_wizard)
+    else:
+        return None
+    return format_datasource_for_warehouse(service_key, venue_key, user_email, source, data)
+
+
 class WarehouseServiceMatcherAPI:
 
     def __init__(self):
-        pass
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        self.local = threading.local()
+        # The connection pools live in the adapters, they are thread safe and shared by the sessions of every thread
+        self.adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=POOL_SIZE,
+            max_retries=Retry(
+                total=GET_RETRIES,
+                backoff_factor=RETRY_BACKOFF,
+                status_forcelist=(502, 503, 504),
+                method_whitelist=frozenset(['GET']),
+                raise_on_status=False,
+            ),
+        )
+        # Fetching unmatched services leases them, so only retry when the request could not be sent
+        self.lease_adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=POOL_SIZE,
+            max_retries=Retry(total=GET_RETRIES, connect=GET_RETRIES, read=0, status=0,
+                              backoff_factor=RETRY_BACKOFF),
+        )
+
+    def get_session(self):
+        """
+        :return: requests.Session, one per thread, keeping its connections alive to the warehouse
+        """
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            session.mount('http://', self.adapter)
+            session.mount('https://', self.adapter)
+            session.mount(self.get_url(settings.WAREHOUSE_UNMATCHED_SERVICES_PATH), self.lease_adapter)
+            self.local.session = session
+        return session
+
+    @staticmethod
+    def get_url(path):
+        return settings.BUILD_URL(
+            settings.WAREHOUSE_HOST,
+            settings.WAREHOUSE_PORT,
+            path,
+        )
+
+    def get_pool(self):
+        # created lazily so importing the views does not start threads
+        if self.pool is None:
+            with self.pool_lock:
+                if self.pool is None:
+                    self.pool = ThreadPool(VENUE_COUNT_WORKERS)
+        return self.pool
 
     def submit_to_warehouse(self, not_enough_info, service_key, venue_key, wizard, venue_category_id, user, previous_match_wizard):
         if not_enough_info:
@@ -58,14 +276,14 @@ class WarehouseServiceMatcherAPI:
                 service_key,
                 venue_key,
                 venue_category_id,
-                user.email)
+                user)
         if previous_match_wizard:
             # 2nd matcher - save match to warehouse
             return self.save_matched_service(
                 service_key,
                 venue_key,
-                wizard,
                 venue_category_id,
+                wizard,
                 user.email,
                 previous_match_wizard)
         else:
@@ -88,19 +306,91 @@ class WarehouseServiceMatcherAPI:
             'limit': 100,
             'model': 'protodomain',
         }
-        r = requests.get(url, params=params, timeout=1)
+        r = self.get_session().get(url, params=params, timeout=TIMEOUTS["venue_count"])
         venue_count = int(r.content)
         return venue_count
 
-    def get_batch_unmatched_service(self, country, city, category_ids=None, size=10):
+    def get_venue_counts(self, city, level1s, deadline=VENUE_COUNT_DEADLINE):
+        """
+        Count the venues of every level1 at once, within one overall deadline
+        :param city: str,
+        :param level1s: list of str, level1 ids
+        :param deadline: float, seconds to wait for all the counts
+        :return: dict, level1 id -> venue count, the level1s that failed or timed out are missing
+        """
+        end = time.time() + deadline
+        if getattr(settings, "WAREHOUSE_UNMATCHED_VENUE_COUNTS_PATH", None):
+            try:
+                # on the pool, so its retries do not go past the deadline either
+                result = self.get_pool().apply_async(self.get_multi_category_venue_counts, (city, level1s, deadline))
+                return result.get(timeout=deadline)
+            except Exception as e:
+                log.warning("Multi category venue count failed, counting one level1 at a time: {}".format(e))
+            # the fallback only has what is left of the deadline
+            if time.time() >= end:
+                return {}
+        pool = self.get_pool()
+        pending = [(level1, pool.apply_async(self.get_venue_count, (city, level1))) for level1 in level1s]
+        counts = {}
+        for level1, result in pending:
+            try:
+                counts[level1] = result.get(timeout=max(0, end - time.time()))
+            except Exception as e:
+                log.warning("Could not count the venues of {} in {}: {!r}".format(level1, city, e))
+        return counts
+
+    def get_multi_category_venue_counts(self, city, level1s, deadline=VENUE_COUNT_DEADLINE):
+        """
+        Count the venues of several level1s in one request, each level1 being a group of warehouse categories.
+        The protocol is assumed, the warehouse does not document it yet: the groups are sent in "category_groups",
+        separated by ";" and their category ids by ",", and the counts come back as a json list in the same order.
+        :param city: str,
+        :param level1s: list of str, level1 ids
+        :param deadline: float, timeout of the request
+        :return: dict, level1 id -> venue count
+        """
+        level1s = [level1 for level1 in level1s if level1 != "-1"]
+        url = settings.BUILD_URL(
+            settings.WAREHOUSE_HOST,
+            settings.WAREHOUSE_PORT,
+            settings.WAREHOUSE_UNMATCHED_VENUE_COUNTS_PATH,
+        )
+        category_groups = [
+            ",".join([str(category_id) for category_id in level1_to_warehouse_category_id[level1]])
+            for level1 in level1s
+        ]
+        params = {
+            'ueni_token': get_token(),
+            'major_city': city,
+            'category_groups': ";".join(category_groups),
+            'limit': 100,
+            'model': 'protodomain',
+        }
+        r = self.get_session().get(url, params=params, timeout=deadline)
+        r.raise_for_status()
+        counts = dict(zip(level1s, [int(count) for count in json.loads(r.content)]))
+        counts["-1"] = 0
+        return counts
+
+    def get_batch_unmatched_service(self, country, city, category_ids=None, size=10, time_limit=None):
         """
         Fetch a service from the frontend
         :param country: str,
         :param city: str,
         :param category_ids: list of int, e.g. [1077, 1078. 1099 ...]
         :param size: int, size of the batch to return
+        :param time_limit: int, length of the lease of the services, the default one of the warehouse if None
         :return: dict or None, service for frontend
         """
+        return list(self.iter_batch_unmatched_service(country, city, category_ids, size, time_limit))
+
+    def iter_batch_unmatched_service(self, country, city, category_ids=None, size=10, time_limit=None):
+        """
+        Streaming version of get_batch_unmatched_service: the response is parsed while it is read (with ijson
+        when it is installed, iter_json_array otherwise) and a service is only formatted when it is consumed,
+        so the memory does not grow with the batch and stopping early skips the rest of the batch
+        :return: generator of dict, services for frontend
+        """
         url = settings.BUILD_URL(
             settings.WAREHOUSE_HOST,
             settings.WAREHOUSE_PORT,
@@ -115,17 +405,35 @@ class WarehouseServiceMatcherAPI:
         if settings.SERVICEMATCHER_IN_TEST_MODE:
             # shorter temporary lock during test mode because nothing is saved anyway
             params["time_limit"] = 1
+        if time_limit is not None:
+            params["time_limit"] = time_limit
         if category_ids:
             params['category_id'] = ",".join([str(category_id) for category_id in category_ids])
-        r = requests.get(url, params=params, timeout=60)
-        if r.status_code != 200:
-            log.warning("Connection with the warehouse {} returned code {}".format(url, r.status_code))
-            return []
-        if r.content:
-            datas = json.loads(r.content)
-            datas = [format_service_for_frontend_from_warehouse_data(data, country) for data in datas]
-            return datas
-        return []
+        r = self.get_session().get(url, params=params, timeout=TIMEOUTS["unmatched_services"], stream=True)
+        try:
+            if r.status_code != 200:
+                log.warning("Connection with the warehouse {} returned code {}".format(url, r.status_code))
+                return
+            if ijson is None:
+                datas = iter_json_array(r.iter_content(STREAM_CHUNK_SIZE))
+                cut_errors = (ValueError,)
+            else:
+                r.raw.decode_content = True
+                # use_float only exists since ijson 3.1
+                datas = (convert_decimals(data) for data in ijson.items(r.raw, "item"))
+                cut_errors = (ijson.common.IncompleteJSONError,)
+            count = 0
+            try:
+                for data in datas:
+                    count += 1
+                    yield format_service_for_frontend_from_warehouse_data(data, country)
+            except cut_errors:
+                if count:
+                    log.warning("The batch of the warehouse was cut after {} services".format(count))
+                # otherwise the warehouse had no service and sent an empty body
+        finally:
+            # the connection is dropped instead of going back to the pool when the batch was not read to its end
+            r.close()
 
     def save_matched_service(self, service_key, venue_key, venue_category_id, wizard, user_email, previous_match_wizard):
         """
@@ -137,15 +445,7 @@ class WarehouseServiceMatcherAPI:
         :param previous_match_wizard: str, the wizard found by the 1st matcher
         :return: Boolean, did everything go well
         """
-        if wizard != previous_match_wizard:
-            # The two juniors don't agree
-            source = "matcher"
-        else:
-            # The two juniors agree
-            source = "matcher_qc"
-        data = {
-            "wizard_index": get_wizard_for_wh(venue_category_id, wizard, previous_match_wizard)
-        }
+        source, data = get_matched_service_data(venue_category_id, wizard, previous_match_wizard)
         if self.save_data(service_key, venue_key, user_email, source, data):
             rep = "Service from 2nd matcher saved in the warehouse"
             log_level = log.info
@@ -163,12 +463,7 @@ class WarehouseServiceMatcherAPI:
         :param user: user obj,
         :return: Boolean, did everything go well
         """
-        source = "matcher"
-        data = {
-            "matcher_flags": ["not_enough_info"],
-            "wizard_index": get_wizard_for_wh(venue_category_id),
-        }
-        # if the flag is chosen, we match to a level1 in the warehouse with the flag
+        source, data = get_flagged_service_data(venue_category_id)
         if self.save_data(service_key, venue_key, user.email, source, data):
             rep = "Service {} saved in warehouse".format(service_key)
             log_level = log.info
@@ -187,25 +482,30 @@ class WarehouseServiceMatcherAPI:
         :param data: str, the datasource for warehouse
         :return: Boolean, did everything go well
         """
-        datasource = {
-            'source': source,
-            'source_ref': user_email,
-            'data': data,
-            'informs': [service_key, venue_key],  # venu_key -> GUID ? GUID is more robust, key can be deleted
-            'data_kind': 'service'
-        }
+        datasource = format_datasource_for_warehouse(service_key, venue_key, user_email, source, data)
+        return self.save_datasources([datasource])
+
+    def save_datasources(self, datasources):
+        """
+        Send several datasources in one request
+        :param datasources: list of dict, from format_datasource_for_warehouse
+        :return: Boolean, did everything go well
+        """
         if settings.SERVICEMATCHER_IN_TEST_MODE:
             log.info("Dont send to warehouse as it is in test mode")
             return True
         headers = {'X_UENI_TOKEN': get_token()}
         params = {'priority': 1}
-        data = json.dumps([datasource], encoding='utf-8')
+        data = json.dumps(datasources, encoding='utf-8')
         url = settings.BUILD_URL(
             settings.WAREHOUSE_HOST,
             settings.WAREHOUSE_PORT,
             settings.WAREHOUSE_UPLOAD_PATH
         )
-        r = requests.put(url, data=data, headers=headers, params=params, timeout=60)
+        if GZIP_UPLOADS:
+            headers['Content-Encoding'] = 'gzip'
+            data = gzip_data(data)
+        r = self.get_session().put(url, data=data, headers=headers, params=params, timeout=TIMEOUTS["upload"])
         if r.status_code != 200:
             return False
         else:
@@ -231,7 +531,7 @@ class WarehouseServiceMatcherAPI:
             rep = "Dont send to warehouse as it is in test mode"
             log_level = log.info
         else:
-            r = requests.get(url, params=params, timeout=60)
+            r = self.get_session().get(url, params=params, timeout=TIMEOUTS["lock_service"])
             if r.status_code != 200:
                 rep = "Locking service {} in warehouse returned error code {}".format(service_key, r.status_code)
                 log_level = log.warning
@@ -240,3 +540,39 @@ class WarehouseServiceMatcherAPI:
                 log_level = log.info
         log_level(rep)
         return Response(rep)
+
+    def lock_services_matched(self, service_keys):
+        """
+        Lock several services matched by the 1st matcher, reusing the same kept-alive connection,
+        or in one request if the warehouse accepts several product keys (WAREHOUSE_LOCK_SERVICE_BATCH)
+        :param service_keys: list of str,
+        :return: list of str, the keys of the services locked
+        """
+        if settings.SERVICEMATCHER_IN_TEST_MODE:
+            log.info("Dont send to warehouse as it is in test mode")
+            return list(service_keys)
+        url = settings.BUILD_URL(
+            settings.WAREHOUSE_HOST,
+            settings.WAREHOUSE_PORT,
+            settings.WAREHOUSE_LOCK_SERVICE_PATH
+        )
+        if getattr(settings, "WAREHOUSE_LOCK_SERVICE_BATCH", False):
+            key_groups = [service_keys]
+        else:
+            key_groups = [[service_key] for service_key in service_keys]
+        locked = []
+        for keys in key_groups:
+            params = {
+                'ueni_token': get_token(),
+                'product_key': ",".join(keys),
+            }
+            try:
+                r = self.get_session().get(url, params=params, timeout=TIMEOUTS["lock_service"])
+            except requests.RequestException as e:
+                log.warning("Locking services {} in warehouse failed: {!r}".format(keys, e))
+                continue
+            if r.status_code != 200:
+                log.warning("Locking services {} in warehouse returned error code {}".format(keys, r.status_code))
+            else:
+                locked += keys
+        return locked